@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+"""Micro-benchmark of decorators.lru_cache against the deque/refcount
+implementation it replaced.
+
+    python benchmarks/bench_lru_cache.py [calls]
+"""
+import os
+import sys
+import time
+import random
+from collections import deque
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'ec2utils'))
+from decorators import lru_cache
+
+
+def old_lru_cache(maxsize):
+    '''Previous implementation, kept here for comparison only.'''
+    def decorating_function(f):
+        cache = {}
+        queue = deque()
+        refcount = {}
+        def wrapper(*args):
+            _cache=cache; _len=len; _refcount=refcount; _maxsize=maxsize
+            queue_append=queue.append; queue_popleft = queue.popleft
+            try:
+                result = _cache[args]
+                wrapper.hits += 1
+            except KeyError:
+                result = _cache[args] = f(*args)
+                wrapper.misses += 1
+            queue_append(args)
+            _refcount[args] = _refcount.get(args, 0) + 1
+            while _len(_cache) > _maxsize:
+                k = queue_popleft()
+                _refcount[k] -= 1
+                if not _refcount[k]:
+                    del _cache[k]
+                    del _refcount[k]
+            if _len(queue) > _maxsize * 4:
+                for i in [None] * _len(queue):
+                    k = queue_popleft()
+                    if _refcount[k] == 1:
+                        queue_append(k)
+                    else:
+                        _refcount[k] -= 1
+                assert len(queue) == len(cache) == len(refcount) == sum(refcount.itervalues())
+            return result
+        wrapper.hits = wrapper.misses = 0
+        return wrapper
+    return decorating_function
+
+
+def run(name, decorator, keys):
+    cached = decorator(lambda x, y: 3 * x + y)
+    start = time.time()
+    for x, y in keys:
+        cached(x, y)
+    elapsed = time.time() - start
+    print '{0:<28} {1:>8.3f}s {2:>8.2f}us/call  hits={3} misses={4}'.format(
+        name, elapsed, elapsed / len(keys) * 1e6, cached.hits, cached.misses)
+
+
+def main(argv):
+    calls = int(argv[0]) if argv else 200000
+    random.seed(42)
+    for maxsize, domain in ((100, 12), (1000, 40), (10000, 150)):
+        keys = [(random.randrange(domain), random.randrange(domain))
+                for i in xrange(calls)]
+        print 'maxsize={0} distinct keys={1} calls={2}'.format(
+            maxsize, domain * domain, calls)
+        run('old deque/refcount', old_lru_cache(maxsize), keys)
+        run('lru_cache', lru_cache(maxsize), keys)
+        run('lru_cache(concurrent)', lru_cache(maxsize, concurrent=True), keys)
+        run('lru_cache(ttl=60)', lru_cache(maxsize, ttl=60), keys)
+        print
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+"""Cold-start wall time of the ec2utils command.
+
+    python benchmarks/bench_startup.py [runs]
+
+Every case runs ec2utils.py in a new interpreter against a local fake
+endpoint and reports the median and fastest wall time, next to a bare
+interpreter start, and which of the heavy modules (boto, tabulate,
+multiprocessing) the case imported.
+"""
+import os
+import sys
+import shutil
+import tempfile
+import subprocess
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+from fake_ec2 import FakeEC2
+
+PACKAGE = os.path.join(HERE, '..', 'ec2utils')
+SCRIPT = os.path.join(PACKAGE, 'ec2utils.py')
+HEAVY = ('boto', 'tabulate', 'multiprocessing')
+
+# case name -> ec2utils arguments
+CASES = [
+    ('help', ['-h']),
+    ('images_cached', ['-i']),
+    ('images_uncached', ['-i', '--no-cache']),
+    ('zones', ['-z']),
+]
+
+# runs main() like the script does, then lists the heavy modules imported
+PROBE = """
+import sys
+sys.path.insert(0, %r)
+import ec2utils
+try:
+    ec2utils.main(%r)
+except SystemExit:
+    pass
+sys.stdout.flush()
+sys.stderr.write(' '.join(m for m in %r if m in sys.modules))
+"""
+
+
+def wall_times(command, env, runs):
+    times = []
+    with open(os.devnull, 'w') as devnull:
+        for i in range(runs):
+            start = time.time()
+            subprocess.call(command, stdout=devnull, stderr=devnull, env=env)
+            times.append(time.time() - start)
+    return sorted(times)
+
+
+def imported(args, env):
+    probe = subprocess.Popen([sys.executable, '-c', PROBE % (PACKAGE, args, HEAVY)],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+    out, err = probe.communicate()
+    return err.strip().splitlines()[-1] if err.strip() else '-'
+
+
+def main(argv):
+    runs = int(argv[0]) if argv else 20
+    fake = FakeEC2(catalog_size=2000)
+    url = fake.start()
+    cache_dir = tempfile.mkdtemp(prefix='ec2utils-bench-')
+    env = dict(os.environ, EC2_URL=url, EC2_ACCESS_KEY='fake',
+               EC2_SECRET_KEY='fake', EC2UTILS_CACHE_DIR=cache_dir)
+    try:
+        # fill the catalog cache for images_cached
+        subprocess.call([sys.executable, SCRIPT, '-i'], env=env,
+                        stdout=open(os.devnull, 'w'))
+        print '{0:<18} {1:>9} {2:>9}  {3}'.format('case', 'p50 ms', 'min ms', 'imports')
+        times = wall_times([sys.executable, '-c', 'pass'], env, runs)
+        print '{0:<18} {1:>9.1f} {2:>9.1f}  {3}'.format(
+            'interpreter', times[len(times) // 2] * 1e3, times[0] * 1e3, '-')
+        for name, args in CASES:
+            times = wall_times([sys.executable, SCRIPT] + args, env, runs)
+            print '{0:<18} {1:>9.1f} {2:>9.1f}  {3}'.format(
+                name, times[len(times) // 2] * 1e3, times[0] * 1e3,
+                imported(args, env))
+    finally:
+        fake.stop()
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+"""Per-call overhead of the decorators.timeout modes.
+
+    python benchmarks/bench_timeout.py [calls]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'ec2utils'))
+from decorators import timeout
+
+
+def work(x):
+    return x + 1
+
+process_work = timeout(5, mode='process')(work)
+thread_work = timeout(5, mode='thread')(work)
+
+@timeout(5, mode='pool')
+def pool_work(x):
+    return x + 1
+
+
+def run(name, function, calls):
+    function(0)  # warm up pools
+    start = time.time()
+    for i in xrange(calls):
+        function(i)
+    elapsed = time.time() - start
+    print '{0:<10} {1:>6} calls {2:>10.1f}us/call'.format(
+        name, calls, elapsed / calls * 1e6)
+
+
+def main(argv):
+    calls = int(argv[0]) if argv else 2000
+    run('direct', work, calls)
+    run('thread', thread_work, calls)
+    run('pool', pool_work, calls)
+    # a fork per call, keep the count down
+    run('process', process_work, max(1, calls / 20))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
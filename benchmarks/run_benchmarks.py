@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+"""Offline benchmarks of ec2utils against a local fake EC2 endpoint.
+
+    python benchmarks/run_benchmarks.py [options] [scenario ...]
+
+Options:
+    --images=N            images in the fake catalog (default 2000)
+    --latency=SECONDS     added to every fake response (default 0)
+    --error-rate=P        probability of a 500 InternalError (default 0)
+    --throttle-rate=P     probability of a 503 RequestLimitExceeded (default 0)
+    --iterations=N        runs per scenario (default 20)
+    --json=FILE           write the results as json
+    --baseline=FILE       compare with results written by --json earlier
+    --max-regression=F    fail when p50 or peak memory grow by more than
+                          this fraction over the baseline (default 0.25)
+
+Every scenario runs in its own forked process so peak memory is measured
+per scenario. Scenarios: {scenarios}
+"""
+import os
+import sys
+import json
+import time
+import getopt
+import resource
+import multiprocessing
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.join(HERE, '..', 'ec2utils'))
+
+import ec2
+import ec2utils
+from fake_ec2 import FakeEC2
+
+LABEL = 'NeCTAR'
+
+
+def _connect(url):
+    return ec2.get_connection(LABEL, 'fake', 'fake', url, False)
+
+
+# scenario name -> function(url, fake) returning the callable to time
+def scenario_connect(url, fake):
+    def run():
+        conn = _connect(url)
+        conn.get_all_zones()
+        conn.close()
+    return run
+
+def scenario_pooled_connect(url, fake):
+    def run():
+        ec2.get_pooled_connection(LABEL, 'fake', 'fake', url, False).get_all_zones()
+    return run
+
+def scenario_list_ami_ids(url, fake):
+    conn = _connect(url)
+    return lambda: ec2utils.list_ami_ids(conn)
+
+def scenario_stream_ami_ids(url, fake):
+    conn = _connect(url)
+    return lambda: ec2utils.stream_ami_ids(conn)
+
+def scenario_get_ami(url, fake):
+    conn = _connect(url)
+    ids = [image['id'] for image in fake.images[:50]]
+    state = {'i': 0}
+    def run():
+        state['i'] += 1
+        ec2.get_ami(conn, ids[state['i'] % len(ids)])
+    return run
+
+def scenario_get_azs(url, fake):
+    conn = _connect(url)
+    return lambda: ec2.get_azs(conn)
+
+def scenario_keypair_exists(url, fake):
+    conn = _connect(url)
+    ec2.create_keypair(conn, 'bench')
+    return lambda: ec2.keypair_exists(conn, 'bench')
+
+def scenario_getcreate_sec_group(url, fake):
+    conn = _connect(url)
+    return lambda: ec2.getcreate_sec_group(conn, 'bench')
+
+def scenario_block_till_running(url, fake):
+    conn = _connect(url)
+    image_id = fake.images[1]['id']
+    def run():
+        reservation = conn.run_instances(image_id, min_count=20, max_count=20)
+        ec2.blockTillRunning(reservation, 60)
+    return run
+
+SCENARIOS = [
+    ('connect', scenario_connect),
+    ('pooled_connect', scenario_pooled_connect),
+    ('list_ami_ids', scenario_list_ami_ids),
+    ('stream_ami_ids', scenario_stream_ami_ids),
+    ('get_ami', scenario_get_ami),
+    ('get_azs', scenario_get_azs),
+    ('keypair_exists', scenario_keypair_exists),
+    ('getcreate_sec_group', scenario_getcreate_sec_group),
+    ('block_till_running', scenario_block_till_running),
+]
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+    return values[index]
+
+
+def _peak_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _run_scenario(queue, name, factory, url, fake, iterations):
+    try:
+        # keep listings out of the report
+        sys.stdout = open(os.devnull, 'w')
+        fake.reset_counters()
+        run = factory(url, fake)
+        rss_before = _peak_rss_kb()
+        latencies = []
+        start = time.time()
+        for i in range(iterations):
+            t = time.time()
+            run()
+            latencies.append(time.time() - t)
+        total = time.time() - start
+        queue.put({'scenario': name, 'iterations': iterations,
+                   'p50': percentile(latencies, 0.5),
+                   'p90': percentile(latencies, 0.9),
+                   'p99': percentile(latencies, 0.99),
+                   'max': max(latencies),
+                   'throughput': iterations / total if total else 0.0,
+                   'peak_rss_kb': _peak_rss_kb(),
+                   'rss_growth_kb': _peak_rss_kb() - rss_before})
+    except Exception as e:
+        queue.put({'scenario': name, 'error': '{0}: {1}'.format(type(e).__name__, e)})
+
+
+def run_scenarios(names, fake, url, iterations):
+    factories = dict(SCENARIOS)
+    results = []
+    for name in names:
+        queue = multiprocessing.Queue()
+        process = multiprocessing.Process(
+            target=_run_scenario,
+            args=(queue, name, factories[name], url, fake, iterations))
+        process.start()
+        result = queue.get()
+        process.join()
+        results.append(result)
+    return results
+
+
+def print_results(results):
+    print '{0:<22} {1:>9} {2:>9} {3:>9} {4:>9} {5:>10} {6:>10}'.format(
+        'scenario', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms', 'ops/s', 'peak MB')
+    for r in results:
+        if 'error' in r:
+            print '{0:<22} error: {1}'.format(r['scenario'], r['error'])
+            continue
+        print '{0:<22} {1:>9.2f} {2:>9.2f} {3:>9.2f} {4:>9.2f} {5:>10.1f} {6:>10.1f}'.format(
+            r['scenario'], r['p50'] * 1e3, r['p90'] * 1e3, r['p99'] * 1e3,
+            r['max'] * 1e3, r['throughput'], r['peak_rss_kb'] / 1024.0)
+
+
+def regressions(results, baseline, max_regression):
+    """Scenarios whose p50 or peak memory grew beyond max_regression."""
+    previous = dict((r['scenario'], r) for r in baseline if 'error' not in r)
+    found = []
+    for r in results:
+        old = previous.get(r['scenario'])
+        if old is None or 'error' in r:
+            continue
+        for metric in ('p50', 'peak_rss_kb'):
+            if old[metric] and r[metric] > old[metric] * (1 + max_regression):
+                found.append('{0} {1}: {2:.4g} -> {3:.4g}'.format(
+                    r['scenario'], metric, old[metric], r[metric]))
+    return found
+
+
+def main(argv):
+    usage = __doc__.format(scenarios=', '.join(n for n, _ in SCENARIOS))
+    try:
+        opts, args = getopt.getopt(argv, 'h', [
+            'help', 'images=', 'latency=', 'error-rate=', 'throttle-rate=',
+            'iterations=', 'json=', 'baseline=', 'max-regression='])
+    except getopt.GetoptError as err:
+        print str(err)
+        print usage
+        return 2
+    settings = {'images': '2000', 'latency': '0', 'error_rate': '0',
+                'throttle_rate': '0', 'iterations': '20', 'max_regression': '0.25'}
+    for o, a in opts:
+        if o in ('-h', '--help'):
+            print usage
+            return 0
+        settings[o[2:].replace('-', '_')] = a
+    names = args or [n for n, _ in SCENARIOS]
+    unknown = [n for n in names if n not in dict(SCENARIOS)]
+    if unknown:
+        print 'unknown scenario(s):', ', '.join(unknown)
+        return 2
+
+    fake = FakeEC2(catalog_size=int(settings['images']),
+                   latency=float(settings['latency']),
+                   error_rate=float(settings['error_rate']),
+                   throttle_rate=float(settings['throttle_rate']),
+                   boot_time=0.5)
+    url = fake.start()
+    try:
+        results = run_scenarios(names, fake, url, int(settings['iterations']))
+    finally:
+        fake.stop()
+    print_results(results)
+
+    if 'json' in settings:
+        with open(settings['json'], 'w') as f:
+            json.dump(results, f, indent=2)
+    if 'baseline' in settings:
+        with open(settings['baseline']) as f:
+            found = regressions(results, json.load(f), float(settings['max_regression']))
+        for line in found:
+            print 'REGRESSION', line
+        if found:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,3 @@
+#
+# ec2 utilities
+#
@@ -0,0 +1,502 @@
+#
+# ec2 utilities - bulk keypair and security group provisioning and teardown
+#
+
+import os
+import time
+import errno
+import threading
+import Queue
+from boto.exception import BotoServerError, EC2ResponseError
+
+from secgroups import SecurityGroups, group_rules
+
+DEFAULT_WORKERS = 16
+# names per filtered Describe* call
+MAX_FILTER_VALUES = 200
+# the service hands out a private key once, when its keypair is created
+NO_KEY_DIR = 'not created: no key directory to save its private key in'
+
+KEYPAIR = 'keypair'
+SECGROUP = 'secgroup'
+
+
+def error_text(error):
+    """Error code and message of a service error, str(error) otherwise."""
+    if isinstance(error, BotoServerError) and error.error_code:
+        return '{0}: {1}'.format(error.error_code, error.error_message)
+    return str(error)
+
+
+class BulkReport(object):
+    """Outcome of a bulk operation, per label and resource.
+
+    Statuses are created, recreated, exists, updated (rules changed),
+    deleted, absent, mismatch (fingerprint differs, not replaced) and
+    failed, the latter with the error in errors.
+    """
+
+    def __init__(self, labels):
+        self.labels = list(labels)
+        self.statuses = {}
+        self.errors = {}
+        self.elapsed = 0.0
+        self._lock = threading.Lock()
+
+    def set(self, label, resource, status, error=None):
+        with self._lock:
+            self.statuses.setdefault(label, {})[resource] = status
+            if error is not None:
+                self.errors.setdefault(label, []).append(
+                    '{0}: {1}'.format(resource, error_text(error)))
+
+    def status(self, label, resource):
+        return self.statuses.get(label, {}).get(resource)
+
+    @property
+    def failed(self):
+        return [label for label in self.labels
+                if label in self.errors or 'mismatch' in
+                self.statuses.get(label, {}).values()]
+
+    def counts(self):
+        """status -> number of label/resource pairs with it"""
+        counts = {}
+        for statuses in self.statuses.values():
+            for status in statuses.values():
+                counts[status] = counts.get(status, 0) + 1
+        return counts
+
+    def rows(self, resources=(KEYPAIR, SECGROUP)):
+        return [[label] + [self.status(label, r) or '' for r in resources] +
+                ['; '.join(self.errors.get(label, []))]
+                for label in self.labels]
+
+    def to_dicts(self):
+        records = []
+        for label in self.labels:
+            record = {'label': label}
+            record.update(self.statuses.get(label, {}))
+            if label in self.errors:
+                record['errors'] = self.errors[label]
+            records.append(record)
+        return records
+
+    def summary(self):
+        counts = self.counts()
+        return '{0} labels in {1:.2f}s: {2}'.format(
+            len(self.labels), self.elapsed,
+            ', '.join('{0} {1}'.format(counts[s], s) for s in sorted(counts))
+            or 'nothing to do')
+
+
+def for_each(endpoint, items, function, max_workers=DEFAULT_WORKERS):
+    """Call function(conn, item) for every item on at most max_workers
+    threads, each borrowing one connection from ec2.connections for its
+    whole run.
+
+    @type   endpoint: fanout.Endpoint
+    @param  endpoint: where to send the calls
+
+    @rtype Dict
+    @return item -> (True, result) or (False, exception)
+    """
+    items = list(items)
+    results = {}
+    if not items:
+        return results
+    todo = Queue.Queue()
+    for item in items:
+        todo.put(item)
+    lock = threading.Lock()
+
+    def work():
+        conn = None
+        try:
+            conn = endpoint.checkout()
+            while True:
+                try:
+                    item = todo.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    result = (True, function(conn, item))
+                except Exception as e:
+                    result = (False, e)
+                with lock:
+                    results[item] = result
+        except Exception as e:
+            # no connection: fail what is left
+            while True:
+                try:
+                    item = todo.get_nowait()
+                except Queue.Empty:
+                    return
+                with lock:
+                    results[item] = (False, e)
+        finally:
+            if conn is not None:
+                endpoint.checkin(conn)
+
+    threads = []
+    for i in range(min(max_workers, len(items))):
+        thread = threading.Thread(target=work)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def _chunks(items, size):
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def describe_keypairs(conn, names):
+    """Keypairs among names, one filtered call per MAX_FILTER_VALUES names.
+    @rtype Dict
+    @return name -> fingerprint
+    """
+    import ec2
+    found = {}
+    describe = ec2.ec2_retry(3, deadline=60)(conn.get_all_key_pairs)
+    for chunk in _chunks(list(names), MAX_FILTER_VALUES):
+        for keypair in describe(filters={'key-name': chunk}):
+            found[keypair.name] = keypair.fingerprint
+    return found
+
+
+def describe_security_groups(conn, names):
+    """Security groups among names, one filtered call per MAX_FILTER_VALUES
+    names.
+    @rtype Dict
+    @return name -> boto SecurityGroup
+    """
+    from paginate import iter_security_groups
+    found = {}
+    for chunk in _chunks(list(names), MAX_FILTER_VALUES):
+        for group in iter_security_groups(conn, filters={'group-name': chunk}):
+            found[group.name] = group
+    return found
+
+
+def _save_key(key_dir, keypair):
+    if not os.path.isdir(key_dir):
+        os.makedirs(key_dir, 0700)
+    path = os.path.join(key_dir, keypair.name + '.pem')
+    fd = os.open(path + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+    with os.fdopen(fd, 'w') as f:
+        f.write(keypair.material)
+    os.rename(path + '.tmp', path)
+    with open(os.path.join(key_dir, keypair.name + '.fingerprint'), 'w') as f:
+        f.write(keypair.fingerprint + '\n')
+
+
+def saved_fingerprints(key_dir, labels):
+    """Fingerprints of the keys _save_key left in key_dir, by label."""
+    fingerprints = {}
+    for label in labels:
+        try:
+            with open(os.path.join(key_dir, label + '.fingerprint')) as f:
+                fingerprints[label] = f.read().strip()
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+    return fingerprints
+
+
+def ensure_keypairs(endpoint, labels, fingerprints=None, replace=False,
+                    key_dir=None, max_workers=DEFAULT_WORKERS, report=None):
+    """Make sure a keypair exists for every label.
+
+    Existing keypairs are left alone, so a repeated run makes a single
+    DescribeKeyPairs call, unless fingerprints has another fingerprint
+    for the label: then the keypair is deleted and created again when
+    replace is set, and reported as a mismatch otherwise. The private keys
+    of the keypairs created are saved in key_dir as LABEL.pem, next to
+    their fingerprint in LABEL.fingerprint; without key_dir no keypair is
+    created, as its private key could not be kept, and those labels fail.
+
+    @type   fingerprints: Dict
+    @param  fingerprints: label -> expected fingerprint
+
+    @rtype BulkReport
+    """
+    import ec2
+    start = time.time()
+    report = report or BulkReport(labels)
+    fingerprints = fingerprints or {}
+    conn = endpoint.checkout()
+    try:
+        existing = describe_keypairs(conn, labels)
+    finally:
+        endpoint.checkin(conn)
+    create = []
+    for label in labels:
+        expected = fingerprints.get(label)
+        if label not in existing:
+            create.append(label)
+        elif expected is None or expected == existing[label]:
+            report.set(label, KEYPAIR, 'exists')
+        elif replace:
+            create.append(label)
+        else:
+            report.set(label, KEYPAIR, 'mismatch',
+                       'fingerprint {0}, expected {1}'.format(existing[label], expected))
+    if create and not key_dir:
+        for label in create:
+            report.set(label, KEYPAIR, 'failed', NO_KEY_DIR)
+        create = []
+
+    @ec2.ec2_retry(3, deadline=60)
+    def create_keypair(conn, label):
+        if label in existing:
+            conn.delete_key_pair(label)
+        keypair = conn.create_key_pair(label)
+        if key_dir:
+            _save_key(key_dir, keypair)
+        return 'recreated' if label in existing else 'created'
+
+    for label, (success, value) in for_each(endpoint, create, create_keypair,
+                                            max_workers).items():
+        if success:
+            report.set(label, KEYPAIR, value)
+        else:
+            report.set(label, KEYPAIR, 'failed', value)
+    report.elapsed += time.time() - start
+    return report
+
+
+def delete_keypairs(endpoint, labels, max_workers=DEFAULT_WORKERS,
+                    report=None):
+    """Delete the keypairs of labels; the absent ones cost no call.
+    @rtype BulkReport
+    """
+    import ec2
+    start = time.time()
+    report = report or BulkReport(labels)
+    conn = endpoint.checkout()
+    try:
+        existing = describe_keypairs(conn, labels)
+    finally:
+        endpoint.checkin(conn)
+    for label in labels:
+        if label not in existing:
+            report.set(label, KEYPAIR, 'absent')
+    delete = [label for label in labels if label in existing]
+    for label, (success, value) in for_each(endpoint, delete, ec2.del_keypair,
+                                            max_workers).items():
+        if success:
+            report.set(label, KEYPAIR, 'deleted')
+        else:
+            report.set(label, KEYPAIR, 'failed', value)
+    report.elapsed += time.time() - start
+    return report
+
+
+class _ThreadConnection(threading.local):
+    conn = None
+
+
+def ensure_security_groups(endpoint, labels, rules=None, exclusive=True,
+                           max_workers=DEFAULT_WORKERS, report=None):
+    """Make sure a security group exists for every label and, when rules
+    is given, that its ingress rules are exactly those (see
+    SecurityGroups.reconcile). Groups already in the desired state cost no
+    call beyond the single DescribeSecurityGroups.
+
+    @type   rules: List
+    @param  rules: secgroups.Rule list applied to every group, None to
+                   leave rules alone
+
+    @rtype BulkReport
+    """
+    import ec2
+    start = time.time()
+    report = report or BulkReport(labels)
+    local = _ThreadConnection()
+    groups = SecurityGroups(lambda: local.conn)
+    conn = endpoint.checkout()
+    try:
+        existing = describe_security_groups(conn, labels)
+    finally:
+        endpoint.checkin(conn)
+    for group in existing.values():
+        groups.remember(group)
+
+    @ec2.ec2_retry(3, deadline=60)
+    def create_group(conn, label):
+        try:
+            # a new group has no rules, no need to describe it
+            group = conn.create_security_group(
+                label, unicode('n' + repr(int(time.time()))))
+        except EC2ResponseError as e:
+            if e.error_code != 'InvalidGroup.Duplicate':
+                raise
+            return groups.get(label)
+        groups.remember(group)
+        return group
+
+    def ensure(conn, label):
+        local.conn = conn
+        status = 'exists'
+        group = existing.get(label)
+        if group is None:
+            group = create_group(conn, label)
+            status = 'created'
+        if rules is not None:
+            changes = groups.reconcile(group, rules, exclusive)
+            if changes['calls'] and status == 'exists':
+                status = 'updated'
+        return status
+
+    for label, (success, value) in for_each(endpoint, labels, ensure,
+                                            max_workers).items():
+        if success:
+            report.set(label, SECGROUP, value)
+        else:
+            report.set(label, SECGROUP, 'failed', value)
+    report.elapsed += time.time() - start
+    return report
+
+
+def deletion_waves(groups):
+    """Order groups for deletion: a group referenced by another group's
+    rules cannot be deleted before that group.
+
+    @type   groups: Dict
+    @param  groups: name -> boto SecurityGroup
+
+    @rtype Tuple
+    @return (waves, cycles): waves is a list of name lists, each deletable
+            once the previous ones are gone; cycles lists the names left
+            over because they reference each other
+    """
+    by_id = dict((g.id, name) for name, g in groups.items() if g.id)
+    references = {}
+    for name, group in groups.items():
+        targets = set()
+        for rule in group_rules(group):
+            target = by_id.get(rule.source, rule.source)
+            if target in groups and target != name:
+                targets.add(target)
+        references[name] = targets
+    remaining = set(groups)
+    waves = []
+    while remaining:
+        referenced = set()
+        for name in remaining:
+            referenced.update(references[name] & remaining)
+        wave = sorted(remaining - referenced)
+        if not wave:
+            break
+        waves.append(wave)
+        remaining.difference_update(wave)
+    return waves, sorted(remaining)
+
+
+def delete_security_groups(endpoint, labels, max_workers=DEFAULT_WORKERS,
+                           report=None):
+    """Delete the security groups of labels in dependency order.
+
+    Each wave of deletion_waves is deleted concurrently. Groups that
+    reference each other in a cycle first have those rules revoked. A
+    group whose referencing group could not be deleted is reported failed
+    without trying.
+
+    @rtype BulkReport
+    """
+    import ec2
+    start = time.time()
+    report = report or BulkReport(labels)
+    conn = endpoint.checkout()
+    try:
+        existing = describe_security_groups(conn, labels)
+    finally:
+        endpoint.checkin(conn)
+    for label in labels:
+        if label not in existing:
+            report.set(label, SECGROUP, 'absent')
+    waves, cycles = deletion_waves(existing)
+    if cycles:
+        local = _ThreadConnection()
+        groups = SecurityGroups(lambda: local.conn)
+        cyclic = set(cycles)
+        ids = set(existing[name].id for name in cycles)
+
+        def untangle(conn, name):
+            local.conn = conn
+            group = existing[name]
+            keep = [rule for rule in group_rules(group)
+                    if rule.source not in ids and rule.source not in cyclic]
+            groups.reconcile(group, keep)
+
+        failed = set()
+        for name, (success, value) in for_each(endpoint, cycles, untangle,
+                                               max_workers).items():
+            if not success:
+                failed.add(name)
+                report.set(name, SECGROUP, 'failed', value)
+        waves.append([name for name in cycles if name not in failed])
+
+    blocked = set()
+    for wave in waves:
+        # a group still referenced by a group that failed stays in use
+        runnable = []
+        for name in wave:
+            holders = [other for other in blocked
+                       if name in _referenced_names(existing, other)]
+            if holders:
+                blocked.add(name)
+                report.set(name, SECGROUP, 'failed',
+                           'still referenced by ' + ', '.join(sorted(holders)))
+            else:
+                runnable.append(name)
+        for name, (success, value) in for_each(endpoint, runnable,
+                                               ec2.del_sec_group,
+                                               max_workers).items():
+            if success:
+                report.set(name, SECGROUP, 'deleted')
+            else:
+                blocked.add(name)
+                report.set(name, SECGROUP, 'failed', value)
+    report.elapsed += time.time() - start
+    return report
+
+
+def _referenced_names(groups, name):
+    by_id = dict((g.id, n) for n, g in groups.items() if g.id)
+    return set(by_id.get(rule.source, rule.source)
+               for rule in group_rules(groups[name]))
+
+
+def provision(endpoint, labels, keypairs=True, secgroups=True, rules=None,
+              fingerprints=None, replace=False, key_dir=None,
+              max_workers=DEFAULT_WORKERS):
+    """Keypair and security group for every label, see ensure_keypairs and
+    ensure_security_groups.
+    @rtype BulkReport
+    """
+    report = BulkReport(labels)
+    if keypairs:
+        ensure_keypairs(endpoint, labels, fingerprints, replace, key_dir,
+                        max_workers, report)
+    if secgroups:
+        ensure_security_groups(endpoint, labels, rules, True, max_workers,
+                               report)
+    return report
+
+
+def teardown(endpoint, labels, keypairs=True, secgroups=True,
+             max_workers=DEFAULT_WORKERS):
+    """Delete the keypair and security group of every label, see
+    delete_keypairs and delete_security_groups.
+    @rtype BulkReport
+    """
+    report = BulkReport(labels)
+    if keypairs:
+        delete_keypairs(endpoint, labels, max_workers, report)
+    if secgroups:
+        delete_security_groups(endpoint, labels, max_workers, report)
+    return report
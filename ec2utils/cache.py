@@ -0,0 +1,314 @@
+#
+# ec2 utilities - on-disk image catalog cache
+#
+
+import os
+import json
+import time
+import errno
+import hashlib
+import tempfile
+import threading
+
+DEFAULT_TTL = 3600
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.ec2utils', 'cache')
+# a refresh lock older than this is assumed to belong to a dead process
+STALE_LOCK_AGE = 600
+
+# fields kept from each boto Image
+IMAGE_FIELDS = ('id', 'name', 'state', 'owner_id', 'is_public',
+                'architecture', 'creation_date', 'tags')
+
+
+def cache_key(label, access_key, ec2_url):
+    """Build the cache key for an endpoint.
+    @type   label: String
+    @param  label: region label
+
+    @type   access_key: String
+    @param  access_key: access key id
+
+    @type   ec2_url: String
+    @param  ec2_url: Ec2 Service URL
+
+    @rtype String
+    @return hex digest identifying the catalog
+    """
+    h = hashlib.sha1()
+    for part in (ec2_url, access_key, label):
+        h.update((part or '').encode('utf-8'))
+        h.update('\0')
+    return h.hexdigest()
+
+
+def image_record(image):
+    """Convert a boto Image into a plain dict that can be cached.
+    @type   image: boto Image
+    @param  image: image returned by get_all_images
+
+    @rtype Dict
+    @return image record
+    """
+    return {'id': image.id,
+            'name': image.name,
+            'state': image.state,
+            'owner_id': image.owner_id,
+            'is_public': image.is_public,
+            'architecture': image.architecture,
+            'creation_date': getattr(image, 'creationDate', None),
+            'tags': dict(getattr(image, 'tags', None) or {})}
+
+
+def fetch_image_records(connection):
+    """Fetch the whole image catalog as a list of records.
+
+    The response is parsed straight into records (see stream.iter_images)
+    instead of boto Image objects.
+
+    @type   connection: EC2 connection
+    @param  connection: EC2 connection
+    """
+    from stream import iter_images
+    return list(iter_images(connection))
+
+
+def _write_json(path, data):
+    """Atomically replace path with the json encoding of data."""
+    directory = os.path.dirname(path)
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        f = os.fdopen(fd, 'w')
+        try:
+            json.dump(data, f)
+        finally:
+            f.close()
+        os.rename(tmp, path)
+    except:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+
+
+def _read_json(path):
+    try:
+        f = open(path)
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            return None
+        raise
+    try:
+        try:
+            return json.load(f)
+        except ValueError:
+            # truncated or corrupted file, treat as missing
+            return None
+    finally:
+        f.close()
+
+
+# path -> ((inode, mtime, size), entry) of the cache files read so far
+_loaded = {}
+_loaded_lock = threading.Lock()
+
+
+class ImageCatalogCache(object):
+    """Image catalog cached on disk, one file per endpoint.
+
+    Lookup results are reported as one of 'hit' (fresh entry), 'stale'
+    (expired entry served while a background refresh runs), 'miss' (no
+    entry) and 'refresh' (forced refetch).
+    """
+
+    def __init__(self, label, access_key, ec2_url, ttl=DEFAULT_TTL,
+                 cache_dir=None):
+        if ttl < 0:
+            raise ValueError("ttl must be >= 0")
+        self.ttl = ttl
+        self.cache_dir = cache_dir or os.environ.get('EC2UTILS_CACHE_DIR') \
+            or DEFAULT_CACHE_DIR
+        self.key = cache_key(label, access_key, ec2_url)
+        self.path = os.path.join(self.cache_dir, self.key + '.images.json')
+        self.stats_path = os.path.join(self.cache_dir, self.key + '.stats.json')
+        # name index of the catalog, see nameindex.image_index
+        self.index_path = os.path.join(self.cache_dir, self.key + '.names.json')
+        self.lock_path = os.path.join(self.cache_dir, self.key + '.lock')
+        self.status = None
+        self.age = None
+        self.refresh_thread = None
+
+    def _ensure_dir(self):
+        try:
+            os.makedirs(self.cache_dir, 0700)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def load(self):
+        """Load the cached entry.
+        @rtype Dict
+        @return {'fetched_at': float, 'images': [record, ...]} or None
+        """
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        # long running processes (the daemon) parse the file once per change
+        signature = (st.st_ino, st.st_mtime, st.st_size)
+        with _loaded_lock:
+            loaded = _loaded.get(self.path)
+        if loaded is not None and loaded[0] == signature:
+            return loaded[1]
+        entry = _read_json(self.path)
+        if entry is None or 'images' not in entry:
+            return None
+        with _loaded_lock:
+            _loaded[self.path] = (signature, entry)
+        return entry
+
+    def store(self, images):
+        """Write images to the cache.
+        @type   images: List
+        @param  images: image records
+        """
+        self._ensure_dir()
+        fetched_at = time.time()
+        _write_json(self.path, {'fetched_at': fetched_at, 'images': images})
+        self._update_index(images, fetched_at)
+
+    def _update_index(self, images, fetched_at):
+        # keep an existing name index in step with the catalog, changing
+        # only the images that differ; none is built until one is asked for
+        if not os.path.exists(self.index_path):
+            return
+        from nameindex import NameIndex
+        try:
+            index = NameIndex.load(self.index_path)
+            if index is None:
+                os.unlink(self.index_path)
+                return
+            index, _ = index.updated(images, fetched_at)
+            index.save(self.index_path)
+        except (IOError, OSError):
+            # rebuilt from the catalog the next time it is needed
+            try:
+                os.unlink(self.index_path)
+            except OSError:
+                pass
+
+    def invalidate(self):
+        for path in (self.path, self.index_path):
+            try:
+                os.unlink(path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+    def _acquire_refresh_lock(self):
+        """Make sure only one process refreshes the catalog at a time."""
+        self._ensure_dir()
+        try:
+            fd = os.open(self.lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            try:
+                if time.time() - os.path.getmtime(self.lock_path) < STALE_LOCK_AGE:
+                    return False
+                os.unlink(self.lock_path)
+            except OSError:
+                return False
+            return self._acquire_refresh_lock()
+        os.write(fd, str(os.getpid()))
+        os.close(fd)
+        return True
+
+    def _release_refresh_lock(self):
+        try:
+            os.unlink(self.lock_path)
+        except OSError:
+            pass
+
+    def _refresh(self, fetch):
+        if not self._acquire_refresh_lock():
+            return
+        try:
+            self.store(fetch())
+        finally:
+            self._release_refresh_lock()
+
+    def get(self, fetch, refresh=False, stale_ok=False):
+        """Return the image catalog, calling fetch() when it is not cached.
+        @type   fetch: callable
+        @param  fetch: returns the list of image records
+
+        @type   refresh: Boolean
+        @param  refresh: ignore the cached entry and refetch
+
+        @type   stale_ok: Boolean
+        @param  stale_ok: return an expired entry immediately and refresh
+                          it in a background thread (see wait_refresh)
+
+        @rtype List
+        @return image records
+        """
+        entry = None if refresh else self.load()
+        if entry is not None:
+            self.age = max(0.0, time.time() - entry['fetched_at'])
+            if self.age <= self.ttl:
+                self.status = 'hit'
+                self._record_stats()
+                return entry['images']
+            if stale_ok:
+                self.status = 'stale'
+                self._record_stats()
+                self.refresh_thread = threading.Thread(target=self._refresh,
+                                                       args=(fetch,))
+                self.refresh_thread.start()
+                return entry['images']
+        self.status = 'refresh' if refresh else 'miss'
+        self.age = None
+        images = fetch()
+        self.store(images)
+        self._record_stats()
+        return images
+
+    def wait_refresh(self, timeout=None):
+        """Wait for a background refresh started by get() to finish."""
+        if self.refresh_thread is not None:
+            self.refresh_thread.join(timeout)
+
+    def _record_stats(self):
+        try:
+            self._ensure_dir()
+            stats = _read_json(self.stats_path) or {}
+            stats[self.status] = stats.get(self.status, 0) + 1
+            if self.age is not None:
+                stats['last_age'] = self.age
+            _write_json(self.stats_path, stats)
+        except (IOError, OSError):
+            # statistics are best effort, never fail a listing for them
+            pass
+
+    def stats(self):
+        """Cumulative lookup counters for this endpoint.
+        @rtype Dict
+        @return counters keyed by 'hit', 'stale', 'miss' and 'refresh'
+        """
+        stats = _read_json(self.stats_path) or {}
+        for status in ('hit', 'stale', 'miss', 'refresh'):
+            stats.setdefault(status, 0)
+        return stats
+
+    def report(self):
+        """One line summary of the last lookup and the cumulative counters."""
+        stats = self.stats()
+        if self.age is None:
+            age = '-'
+        else:
+            age = '{0:.0f}s'.format(self.age)
+        return ('cache {0} (age {1}, ttl {2}s); totals: hit={3} stale={4} '
+                'miss={5} refresh={6}').format(self.status, age, self.ttl,
+                                                stats['hit'], stats['stale'],
+                                                stats['miss'], stats['refresh'])
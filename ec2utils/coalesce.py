@@ -0,0 +1,198 @@
+#
+# ec2 utilities - coalesced image lookups
+#
+
+import time
+import threading
+from boto.exception import EC2ResponseError
+
+DEFAULT_WINDOW = 0.02
+MAX_BATCH = 200
+# errors that only concern some of the ids in a batch
+BAD_ID_CODES = ('InvalidAMIID.NotFound', 'InvalidAMIID.Malformed',
+                'InvalidAMIID.Unavailable')
+
+
+class _Call(object):
+    """One in-flight lookup, shared by every caller asking for the id."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+    def finish(self, result=None, error=None):
+        self.result = result
+        self.error = error
+        self.done.set()
+
+
+class ImageResolver(object):
+    """Resolve AMI ids with as few DescribeImages calls as possible.
+
+    Concurrent get() calls for the same id wait on a single in-flight
+    lookup. The first caller of a batch waits `window` seconds for other
+    ids to arrive, then describes all of them with one
+    get_all_images(image_ids=[...]) call per max_batch ids and hands each
+    caller its image. With a plain connection, which serves one batch at a
+    time, ids arriving while it is busy go together in the next batch.
+    Calls are retried with ec2_retry, and a batch the service rejects for
+    a bad id is halved till the bad ids are on their own, so a single bad
+    id does not fail the whole batch.
+    """
+
+    def __init__(self, connection, window=DEFAULT_WINDOW, max_batch=MAX_BATCH,
+                 tries=3):
+        """
+        @type   connection: EC2 connection or callable
+        @param  connection: connection, or a callable returning the calling
+                            thread's connection (see ConnectionManager.provider)
+
+        @type   window: float
+        @param  window: seconds to collect ids before sending a batch
+
+        @type   max_batch: int
+        @param  max_batch: maximum ids per DescribeImages call
+
+        @type   tries: int
+        @param  tries: calls per DescribeImages request at most
+        """
+        from ec2 import ec2_retry
+        if window < 0:
+            raise ValueError("window must be >= 0")
+        if max_batch < 1:
+            raise ValueError("max_batch must be 1 or greater")
+        self.connection = connection
+        self.window = window
+        self.max_batch = max_batch
+        self._describe = ec2_retry(tries, deadline=60)(self._describe_once)
+        self._lock = threading.Lock()
+        # a plain connection must not be used by two batches at once
+        self._conn_lock = threading.Lock()
+        self._inflight = {}
+        self._pending = []
+        self._leader = False
+        self.stats = {'lookups': 0, 'coalesced': 0, 'requests': 0}
+
+    def get(self, ami_id, timeout=None):
+        """Image for ami_id, None if it does not exist.
+        @type   ami_id: String
+        @param  ami_id: image id
+
+        @type   timeout: float
+        @param  timeout: seconds to wait for a shared lookup
+        """
+        leader = False
+        with self._lock:
+            self.stats['lookups'] += 1
+            call = self._inflight.get(ami_id)
+            if call is not None:
+                self.stats['coalesced'] += 1
+            else:
+                call = self._inflight[ami_id] = _Call()
+                self._pending.append(ami_id)
+                if not self._leader:
+                    self._leader = leader = True
+        if leader:
+            self._lead()
+        if not call.done.wait(timeout) and not call.done.is_set():
+            raise RuntimeError('timed out waiting for {0}'.format(ami_id))
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def get_many(self, ami_ids):
+        """Images for several ids, in the same order, None where missing."""
+        calls = []
+        with self._lock:
+            for ami_id in ami_ids:
+                self.stats['lookups'] += 1
+                call = self._inflight.get(ami_id)
+                if call is not None:
+                    self.stats['coalesced'] += 1
+                else:
+                    call = self._inflight[ami_id] = _Call()
+                    self._pending.append(ami_id)
+                calls.append(call)
+            leader = not self._leader and bool(self._pending)
+            if leader:
+                self._leader = True
+        if leader:
+            self._lead(wait=False)
+        results = []
+        for call in calls:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            results.append(call.result)
+        return results
+
+    def _lead(self, wait=True):
+        if wait and self.window:
+            time.sleep(self.window)
+        if callable(self.connection):
+            self._take_batch()
+            return
+        # the ids arriving till the connection is free join this batch
+        with self._conn_lock:
+            self._take_batch()
+
+    def _take_batch(self):
+        with self._lock:
+            ids, self._pending = self._pending, []
+            # later arrivals elect a new leader for the next batch
+            self._leader = False
+        for i in range(0, len(ids), self.max_batch):
+            self._resolve(ids[i:i + self.max_batch])
+
+    def _finish(self, ami_id, result=None, error=None):
+        with self._lock:
+            call = self._inflight.pop(ami_id)
+        call.finish(result, error)
+
+    def _describe_once(self, ids):
+        with self._lock:
+            self.stats['requests'] += 1
+        if callable(self.connection):
+            return self.connection().get_all_images(image_ids=ids)
+        return self.connection.get_all_images(image_ids=ids)
+
+    def _resolve(self, ids):
+        try:
+            images = self._describe(ids)
+        except EC2ResponseError as e:
+            if e.error_code in BAD_ID_CODES and len(ids) > 1:
+                half = len(ids) // 2
+                self._resolve(ids[:half])
+                self._resolve(ids[half:])
+                return
+            if e.error_code in BAD_ID_CODES:
+                self._finish(ids[0])
+                return
+            for ami_id in ids:
+                self._finish(ami_id, error=e)
+            return
+        except Exception as e:
+            for ami_id in ids:
+                self._finish(ami_id, error=e)
+            return
+        found = dict((image.id, image) for image in images)
+        for ami_id in ids:
+            self._finish(ami_id, found.get(ami_id))
+
+
+# kept on the connection, like lookup.index_for, so that it lives as long
+# as the connection does
+_RESOLVER_ATTRIBUTE = '_image_resolver'
+_resolvers_lock = threading.Lock()
+
+def resolver_for(connection):
+    """The ImageResolver kept for a connection as long as it lives. It
+    does not wait for more ids (window=0): callers of one connection are
+    batched while it is busy."""
+    with _resolvers_lock:
+        resolver = getattr(connection, _RESOLVER_ATTRIBUTE, None)
+        if resolver is None:
+            resolver = ImageResolver(connection, window=0)
+            setattr(connection, _RESOLVER_ATTRIBUTE, resolver)
+        return resolver
@@ -0,0 +1,303 @@
+#
+# ec2 utilities - resident daemon answering CLI invocations over a Unix socket
+#
+
+import os
+import sys
+import json
+import errno
+import socket
+import signal
+import hashlib
+import threading
+
+DEFAULT_SOCKET = os.path.join(os.path.expanduser('~'), '.ec2utils',
+                              'daemon.sock')
+DEFAULT_RESULT_TTL = 60
+PROTOCOL = 1
+
+
+def socket_path():
+    return os.environ.get('EC2UTILS_SOCKET') or DEFAULT_SOCKET
+
+
+def credentials_fingerprint(environ=None):
+    """Digest of the ec2rc.sh variables; the daemon only answers clients
+    holding the credentials it was started with, and never sees theirs."""
+    environ = os.environ if environ is None else environ
+    parts = [environ.get(name) or '' for name in
+             ('EC2_URL', 'EC2_ACCESS_KEY', 'EC2_SECRET_KEY')]
+    return hashlib.sha1('\0'.join(parts)).hexdigest()
+
+
+def _send(sock, message):
+    sock.sendall(json.dumps(message) + '\n')
+
+
+def _receive(sock):
+    data = []
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            break
+        data.append(chunk)
+        if chunk.endswith('\n'):
+            break
+    if not data:
+        return None
+    return json.loads(''.join(data))
+
+
+class DaemonUnavailable(Exception):
+    pass
+
+
+def request(argv, path=None, timeout=None):
+    """Run a CLI invocation on the daemon.
+
+    Raises DaemonUnavailable when no daemon listens on path or it does not
+    hold the caller's credentials; the caller then runs the command itself.
+    Once the request is sent, failures are raised as socket errors instead,
+    so a command is never run twice.
+
+    @type   argv: List
+    @param  argv: ec2utils arguments
+
+    @rtype Tuple
+    @return (exit status, stdout, stderr)
+    """
+    path = path or socket_path()
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            sock.connect(path)
+        except socket.error as e:
+            raise DaemonUnavailable(str(e))
+        sock.settimeout(timeout)
+        _send(sock, {'protocol': PROTOCOL, 'argv': argv,
+                     'credentials': credentials_fingerprint()})
+        reply = _receive(sock)
+    finally:
+        sock.close()
+    if reply is None:
+        raise socket.error('daemon closed the connection')
+    if 'unavailable' in reply:
+        raise DaemonUnavailable(reply['unavailable'])
+    return reply['status'], reply['stdout'], reply['stderr']
+
+
+def stop(path=None):
+    """Ask the daemon on path to exit. Returns False when none runs."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            sock.connect(path or socket_path())
+        except socket.error:
+            return False
+        _send(sock, {'protocol': PROTOCOL, 'stop': True,
+                     'credentials': credentials_fingerprint()})
+        reply = _receive(sock) or {}
+        return 'unavailable' not in reply
+    finally:
+        sock.close()
+
+
+class _Buffer(object):
+
+    def __init__(self):
+        self.parts = []
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        self.parts.append(data)
+
+    def getvalue(self):
+        return ''.join(self.parts).decode('utf-8', 'replace')
+
+
+class _OutputRouter(object):
+    """Stands in for sys.stdout/sys.stderr so that every request thread
+    writes into its own buffer."""
+
+    def __init__(self, default):
+        self._default = default
+        self._local = threading.local()
+
+    def capture(self):
+        self._local.buffer = _Buffer()
+        return self._local.buffer
+
+    def release(self):
+        self._local.buffer = None
+
+    def _target(self):
+        return getattr(self._local, 'buffer', None) or self._default
+
+    def write(self, data):
+        self._target().write(data)
+
+    def flush(self):
+        if self._target() is self._default:
+            self._default.flush()
+
+    def isatty(self):
+        return False
+
+    def __getattr__(self, name):
+        return getattr(self._default, name)
+
+
+class _Failed(Exception):
+    # carries the output of a failed command past the result cache
+    def __init__(self, result):
+        Exception.__init__(self)
+        self.result = result
+
+
+class Daemon(object):
+    """Serve CLI invocations from one long running process.
+
+    handler(argv) runs a command and returns its exit status, writing to
+    sys.stdout and sys.stderr. The handlers run on worker threads that are
+    kept between requests, so their pooled connections (ec2.connections)
+    stay warm, and so do the rate limiter, the caches and everything else
+    living at module level. Successful results of commands for which
+    cacheable(argv) is true are reused for result_ttl seconds.
+    """
+
+    def __init__(self, handler, path=None, cacheable=None,
+                 result_ttl=DEFAULT_RESULT_TTL, max_workers=8):
+        from decorators import WorkerPool, lru_cache
+        self.handler = handler
+        self.path = path or socket_path()
+        self.cacheable = cacheable or (lambda argv: False)
+        self.credentials = credentials_fingerprint()
+        self.workers = WorkerPool(max_workers)
+        self._stopping = False
+        self._listener = None
+        self._stdout = _OutputRouter(sys.stdout)
+        self._stderr = _OutputRouter(sys.stderr)
+        self._cached = None
+        if result_ttl > 0:
+            self._cached = lru_cache(maxsize=64, ttl=result_ttl,
+                                     concurrent=True)(self._execute_or_raise)
+
+    def _execute(self, argv):
+        out = self._stdout.capture()
+        err = self._stderr.capture()
+        try:
+            try:
+                status = self.handler(list(argv)) or 0
+            except SystemExit as e:
+                if e.code is None or isinstance(e.code, int):
+                    status = e.code or 0
+                else:
+                    err.write('{0}\n'.format(e.code))
+                    status = 1
+            except Exception as e:
+                status = 1
+                err.write('{0}: {1}\n'.format(type(e).__name__, e))
+        finally:
+            self._stdout.release()
+            self._stderr.release()
+        return status, out.getvalue(), err.getvalue()
+
+    def _execute_or_raise(self, argv):
+        result = self._execute(argv)
+        if result[0] != 0:
+            raise _Failed(result)
+        return result
+
+    def run_command(self, argv):
+        if self._cached is None or not self.cacheable(argv):
+            return self._execute(argv)
+        try:
+            return self._cached(tuple(argv))
+        except _Failed as e:
+            return e.result
+
+    def _handle(self, sock):
+        try:
+            message = _receive(sock)
+            if message is None:
+                return
+            if message.get('protocol') != PROTOCOL:
+                _send(sock, {'unavailable': 'protocol mismatch'})
+            elif message.get('credentials') != self.credentials:
+                _send(sock, {'unavailable': 'started with other credentials'})
+            elif message.get('stop'):
+                _send(sock, {'stopping': True})
+                self.stop()
+            else:
+                status, out, err = self.run_command(message['argv'])
+                _send(sock, {'status': status, 'stdout': out, 'stderr': err})
+        except Exception as e:
+            print >> self._stderr, 'ec2utils daemon: {0}'.format(e)
+        finally:
+            sock.close()
+
+    def _listen(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory, 0700)
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(self.path)
+        except socket.error as e:
+            if e.errno not in (errno.ENOENT, errno.ECONNREFUSED):
+                raise
+            if e.errno == errno.ECONNREFUSED:
+                # left over by a daemon that died
+                os.unlink(self.path)
+        else:
+            raise RuntimeError('a daemon already listens on ' + self.path)
+        finally:
+            probe.close()
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0177)
+        try:
+            listener.bind(self.path)
+        finally:
+            os.umask(umask)
+        listener.listen(64)
+        return listener
+
+    def serve_forever(self):
+        """Accept requests till stop() is called or SIGTERM/SIGINT arrives."""
+        self._listener = self._listen()
+        sys.stdout, sys.stderr = self._stdout, self._stderr
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, lambda *args: self.stop())
+        try:
+            while not self._stopping:
+                try:
+                    sock, _ = self._listener.accept()
+                except socket.error as e:
+                    if e.errno == errno.EINTR:
+                        continue
+                    raise
+                if self._stopping:
+                    sock.close()
+                    break
+                self.workers.submit(self._handle, sock)
+        finally:
+            self._listener.close()
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+            sys.stdout, sys.stderr = self._stdout._default, self._stderr._default
+
+    def stop(self):
+        if self._stopping:
+            return
+        self._stopping = True
+        # wake up accept()
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.path)
+        except socket.error:
+            pass
+        finally:
+            sock.close()
@@ -1,6 +1,6 @@
 # vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
 
-import time, math
+import time, math, random, sys, threading, traceback
 
 # Retry decorator with exponential backoff
 def retry(tries, delay=2, backoff=2):
@@ -109,11 +109,7 @@ def retry_with_catch(retries, delay=2, backoff=2, delay_ceiling=0,
                         raise
                     else:
                         pass
-                finally:
-                    time.sleep(mdelay)
-                    mdelay *= backoff
-                   #print 'retry'
-                    mtries -= 1
+                if mtries > 0:
                     time.sleep(mdelay)
                     mdelay *= backoff
 
@@ -177,6 +173,142 @@ def ioretry(tries, delay=2, backoff=2):
         return f_retry # true decorator -> decorated function
     return deco_retry  # @retry(arg[, ...]) -> true decorator
 
+# Outcome classes for retry_policy
+THROTTLED = 'throttled'     # back off hard, with full jitter
+TRANSIENT = 'transient'     # retry quickly
+PERMANENT = 'permanent'     # retrying will not help, fail at once
+
+retry_metrics = {}          # function name -> counters, see retry_policy
+_retry_metrics_lock = threading.Lock()
+
+def _count_retry(name, **counts):
+    with _retry_metrics_lock:
+        metrics = retry_metrics.get(name)
+        if metrics is None:
+            metrics = retry_metrics[name] = {
+                'calls': 0, 'attempts': 0, 'retries': 0, 'throttled': 0,
+                'transient': 0, 'permanent': 0, 'gave_up': 0, 'sleep': 0.0}
+        for key, value in counts.items():
+            metrics[key] += value
+
+_attempts = threading.local()
+
+class single_attempts(object):
+    '''Within the block, functions decorated with retry_policy make one
+    attempt on this thread and fail at once, never sleeping: for callers
+    that schedule the retries of the outer call themselves.'''
+    def __enter__(self):
+        self.outer = getattr(_attempts, 'single', False)
+        _attempts.single = True
+        return self
+    def __exit__(self, *exc):
+        _attempts.single = self.outer
+        return False
+
+def retry_delay(outcome, attempt, delay=0.5, backoff=2, max_delay=20,
+                throttle_delay=1, throttle_max_delay=60):
+    """Seconds to wait before retrying a call that failed for the
+    attempt-th time with outcome, see retry_policy."""
+    if outcome == THROTTLED:
+        return random.uniform(
+            0, min(throttle_max_delay, throttle_delay * 2 ** (attempt - 1)))
+    return min(max_delay, delay * backoff ** (attempt - 1)) * random.uniform(0.5, 1.5)
+
+def retry_policy(tries, deadline=None, classify=None, retry_false=False,
+                 delay=0.5, backoff=2, max_delay=20, throttle_delay=1,
+                 throttle_max_delay=60, on_retry=None):
+    """Retries a function or method, backing off according to why it failed.
+
+    classify(exception) returns THROTTLED, TRANSIENT or PERMANENT and
+    defaults to treating every exception as TRANSIENT. Throttled calls
+    sleep a random time between 0 and throttle_delay * 2**n (capped at
+    throttle_max_delay) so that many clients do not come back together;
+    transient failures, and False results when retry_false is set, sleep
+    delay * backoff**n (capped at max_delay) with +/-50% jitter; permanent
+    failures are raised at once.
+
+    tries bounds the number of calls and deadline, if given, the total
+    seconds spent: no retry is started that would sleep past it. When the
+    retries run out the last exception is raised (or False returned).
+    on_retry(exception_or_None, outcome, sleep) is called before each sleep.
+    The decorated function keeps the original as __wrapped__ and the
+    policy as retry_policy, for callers that schedule retries themselves;
+    calls nested in such a caller's attempt run once, see single_attempts.
+
+    Counters per function are kept in retry_metrics: calls, attempts,
+    retries, throttled, transient, permanent, gave_up and sleep (seconds).
+
+    Usage:
+        @retry_policy(5, deadline=60, classify=classify_ec2_error)
+        def describe(...):
+            ..."""
+
+    if backoff <= 1:
+        raise ValueError("backoff must be greater than 1")
+
+    tries = math.floor(tries)
+    if tries < 1:
+        raise ValueError("tries must be 1 or greater")
+
+    if delay <= 0 or throttle_delay <= 0:
+        raise ValueError("delay must be greater than 0")
+
+    if deadline is not None and deadline <= 0:
+        raise ValueError("deadline must be greater than 0")
+
+    delays = {'delay': delay, 'backoff': backoff, 'max_delay': max_delay,
+              'throttle_delay': throttle_delay,
+              'throttle_max_delay': throttle_max_delay}
+
+    def deco_retry(f):
+        name = getattr(f, '__module__', None)
+        name = '{0}.{1}'.format(name, f.__name__) if name else f.__name__
+        def f_retry(*args, **kwargs):
+            if getattr(_attempts, 'single', False):
+                return f(*args, **kwargs)
+            start = time.time()
+            attempt = 0
+            _count_retry(name, calls=1)
+            while True:
+                attempt += 1
+                error = None
+                try:
+                    rv = f(*args, **kwargs)
+                    if not (retry_false and rv is False):
+                        _count_retry(name, attempts=1)
+                        return rv
+                    outcome = TRANSIENT
+                except Exception as e:
+                    error = sys.exc_info()
+                    outcome = classify(e) if classify is not None else TRANSIENT
+                _count_retry(name, attempts=1, **{outcome: 1})
+                sleep = retry_delay(outcome, attempt, **delays)
+                out_of_time = deadline is not None and \
+                    time.time() - start + sleep > deadline
+                if outcome == PERMANENT or attempt >= tries or out_of_time:
+                    if outcome != PERMANENT:
+                        _count_retry(name, gave_up=1)
+                    if error is not None:
+                        raise error[0], error[1], error[2]
+                    return False
+                if on_retry is not None:
+                    on_retry(error and error[1], outcome, sleep)
+                _count_retry(name, retries=1, sleep=sleep)
+                time.sleep(sleep)
+        f_retry.__doc__ = f.__doc__
+        f_retry.__name__ = f.__name__
+        f_retry.__wrapped__ = f
+        f_retry.retry_policy = {'name': name, 'tries': tries,
+                                'deadline': deadline, 'classify': classify,
+                                'delays': delays}
+        return f_retry
+    return deco_retry
+
+def retry_stats():
+    """Copy of the per-function retry counters."""
+    with _retry_metrics_lock:
+        return dict((name, dict(counts)) for name, counts in retry_metrics.items())
+
 @ioretry(4)
 def test2():
     raise Exception('Blair')
@@ -188,58 +320,147 @@ def test2():
     else:
         return False
 
-from collections import deque
 
-def lru_cache(maxsize):
+_kwd_mark = object()     # separates positional and keyword args in keys
+
+def _make_key(args, kwargs):
+    if not kwargs:
+        return args
+    return args + (_kwd_mark,) + tuple(sorted(kwargs.items()))
+
+class _DummyLock(object):
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        return False
+
+_dummy_lock = _DummyLock()
+
+def lru_cache(maxsize=100, ttl=None, maxweight=None, weigher=None,
+              concurrent=False):
     '''Decorator applying a least-recently-used cache with the given maximum size.
 
-    Arguments to the cached function must be hashable.
-    Cache performance statistics stored in f.hits and f.misses.
+    Arguments to the cached function must be hashable, keyword arguments
+    are part of the key. Lookups, insertions and evictions are O(1).
+
+    ttl expires entries that many seconds after they were computed.
+    maxweight caps the sum of weigher(result) over the cached entries
+    (weigher defaults to counting every entry as 1). concurrent makes the
+    cache safe to use from several threads; the function itself still
+    runs outside the lock, so concurrent misses on one key may both call it.
+
+    Cache performance statistics stored in f.hits, f.misses and
+    f.evictions, f.cache_info() returns them with the current size.
+    f.invalidate(*args, **kwargs) drops one entry, f.cache_clear() all.
     '''
+    if maxsize is not None and maxsize < 1:
+        raise ValueError("maxsize must be 1 or greater")
+    if ttl is not None and ttl <= 0:
+        raise ValueError("ttl must be greater than 0")
+    if maxweight is not None and maxweight <= 0:
+        raise ValueError("maxweight must be greater than 0")
+
+    PREV, NEXT, KEY, RESULT, EXPIRES, WEIGHT = 0, 1, 2, 3, 4, 5
+
     def decorating_function(f):
-        cache = {}              # mapping of args to results
-        queue = deque()         # order that keys have been accessed
-        refcount = {}           # number of times each key is in the access queue
-        def wrapper(*args):
-            
-            # localize variable access (ugly but fast)
-            _cache=cache; _len=len; _refcount=refcount; _maxsize=maxsize
-            queue_append=queue.append; queue_popleft = queue.popleft
-
-            # get cache entry or compute if not found
+        cache = {}              # mapping of keys to links
+        root = []               # sentinel of the circular doubly linked list
+        root[:] = [root, root, None, None, None, 0]
+        cache_get = cache.get
+        _time = time.time
+        lock = threading.Lock() if concurrent else None
+        state = {'weight': 0}
+
+        def unlink(link):
+            link_prev, link_next = link[PREV], link[NEXT]
+            link_prev[NEXT] = link_next
+            link_next[PREV] = link_prev
+
+        def remove(link):
+            unlink(link)
+            del cache[link[KEY]]
+            state['weight'] -= link[WEIGHT]
+
+        def wrapper(*args, **kwargs):
+            key = _make_key(args, kwargs) if kwargs else args
+            if lock is not None:
+                lock.acquire()
             try:
-                result = _cache[args]
-                wrapper.hits += 1
-            except KeyError:
-                result = _cache[args] = f(*args)
+                link = cache_get(key)
+                if link is not None:
+                    if ttl is not None and link[EXPIRES] <= _time():
+                        remove(link)
+                    else:
+                        # move to the most recently used end
+                        link_prev, link_next = link[PREV], link[NEXT]
+                        link_prev[NEXT] = link_next
+                        link_next[PREV] = link_prev
+                        last = root[PREV]
+                        last[NEXT] = root[PREV] = link
+                        link[PREV] = last
+                        link[NEXT] = root
+                        wrapper.hits += 1
+                        return link[RESULT]
                 wrapper.misses += 1
+            finally:
+                if lock is not None:
+                    lock.release()
 
-            # record that this key was recently accessed
-            queue_append(args)
-            _refcount[args] = _refcount.get(args, 0) + 1
-
-            # Purge least recently accessed cache contents
-            while _len(_cache) > _maxsize:
-                k = queue_popleft()
-                _refcount[k] -= 1
-                if not _refcount[k]:
-                    del _cache[k]
-                    del _refcount[k]
-    
-            # Periodically compact the queue by duplicate keys
-            if _len(queue) > _maxsize * 4:
-                for i in [None] * _len(queue):
-                    k = queue_popleft()
-                    if _refcount[k] == 1:
-                        queue_append(k)
-                    else:
-                        _refcount[k] -= 1
-                assert len(queue) == len(cache) == len(refcount) == sum(refcount.itervalues())
+            result = f(*args, **kwargs)
+            weight = weigher(result) if weigher is not None else 1
+            expires = _time() + ttl if ttl is not None else None
 
+            if lock is not None:
+                lock.acquire()
+            try:
+                link = cache_get(key)
+                if link is not None:
+                    # another thread computed it meanwhile
+                    remove(link)
+                if maxweight is not None and weight > maxweight:
+                    return result
+                last = root[PREV]
+                link = [last, root, key, result, expires, weight]
+                last[NEXT] = root[PREV] = cache[key] = link
+                state['weight'] += weight
+                # purge least recently used cache contents
+                while (maxsize is not None and len(cache) > maxsize) or \
+                      (maxweight is not None and state['weight'] > maxweight):
+                    remove(root[NEXT])
+                    wrapper.evictions += 1
+            finally:
+                if lock is not None:
+                    lock.release()
             return result
+
+        def invalidate(*args, **kwargs):
+            with lock or _dummy_lock:
+                link = cache.get(_make_key(args, kwargs))
+                if link is None:
+                    return False
+                remove(link)
+                return True
+
+        def cache_clear():
+            with lock or _dummy_lock:
+                cache.clear()
+                root[:] = [root, root, None, None, None, 0]
+                state['weight'] = 0
+                wrapper.hits = wrapper.misses = wrapper.evictions = 0
+
+        def cache_info():
+            with lock or _dummy_lock:
+                return {'hits': wrapper.hits, 'misses': wrapper.misses,
+                        'evictions': wrapper.evictions, 'size': len(cache),
+                        'weight': state['weight'], 'maxsize': maxsize,
+                        'maxweight': maxweight}
+
         wrapper.__doc__ = f.__doc__
         wrapper.__name__ = f.__name__
-        wrapper.hits = wrapper.misses = 0
+        wrapper.hits = wrapper.misses = wrapper.evictions = 0
+        wrapper.invalidate = invalidate
+        wrapper.cache_clear = cache_clear
+        wrapper.cache_info = cache_info
         return wrapper
     return decorating_function
 
@@ -352,7 +573,6 @@ Traceback (most recent call last):
 Exception: Houston we have problems!
 
 """
-import multiprocessing
 import time
 
 
@@ -360,11 +580,26 @@ class TimeoutException(Exception):
     pass
 
 
-class RunableProcessing(multiprocessing.Process):
+class RunableProcessing(object):
+    # wraps rather than subclasses multiprocessing.Process so that importing
+    # this module does not import multiprocessing
     def __init__(self, func, *args, **kwargs):
+        import multiprocessing
         self.queue = multiprocessing.Queue(maxsize=1)
         args = (func,) + args
-        multiprocessing.Process.__init__(self, target=self.run_func, args=args, kwargs=kwargs)
+        self.process = multiprocessing.Process(target=self.run_func, args=args, kwargs=kwargs)
+
+    def start(self):
+        self.process.start()
+
+    def join(self, timeout=None):
+        self.process.join(timeout)
+
+    def is_alive(self):
+        return self.process.is_alive()
+
+    def terminate(self):
+        self.process.terminate()
 
     def run_func(self, func, *args, **kwargs):
         try:
@@ -380,7 +615,20 @@ class RunableProcessing(multiprocessing.Process):
         return self.queue.get()
 
 
-def timeout(seconds, force_kill=True):
+def timeout(seconds, force_kill=True, mode='process', cancel_arg=None):
+    """Raise TimeoutException when the function runs longer than seconds.
+
+    mode 'process' (the default) runs every call in a new process that is
+    killed on timeout. mode 'thread' runs calls on a shared worker thread
+    pool, see thread_timeout, and mode 'pool' on a persistent process pool,
+    see pool_timeout.
+    """
+    if mode == 'thread':
+        return thread_timeout(seconds, cancel_arg)
+    if mode == 'pool':
+        return pool_timeout(seconds)
+    if mode != 'process':
+        raise ValueError("mode must be 'process', 'thread' or 'pool'")
     def wrapper(function):
         def inner(*args, **kwargs):
             now = time.time()
@@ -402,6 +650,305 @@ def timeout(seconds, force_kill=True):
     return wrapper
 ## end of http://code.activestate.com/recipes/577853/ }}}
 
+import heapq
+import Queue
+import atexit
+import weakref
+import itertools
+
+
+class _Task(object):
+    """A call submitted to the worker pool and its outcome.
+
+    wait() blocks on a plain lock instead of a timed Event.wait, which in
+    python 2 polls with sleeps of up to 50ms; timeouts are delivered by the
+    shared _Deadlines thread releasing the same lock.
+    """
+
+    def __init__(self, function, args, kwargs):
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.success = None
+        self.result = None
+        self.expired = False
+        self._settled = False
+        self._settle_lock = threading.Lock()
+        self._waiter = threading.Lock()
+        self._waiter.acquire()
+
+    def _settle(self, expired):
+        with self._settle_lock:
+            if self._settled:
+                return False
+            self._settled = True
+            self.expired = expired
+        self._waiter.release()
+        return True
+
+    def run(self):
+        try:
+            self.result = self.function(*self.args, **self.kwargs)
+            self.success = True
+        except:
+            self.result = sys.exc_info()
+            self.success = False
+        self.function = self.args = self.kwargs = None
+        self._settle(False)
+
+    def expire(self):
+        return self._settle(True)
+
+    def wait(self):
+        """Block till the call finished or expired, True if it finished."""
+        self._waiter.acquire()
+        return not self.expired
+
+
+class _Deadlines(object):
+    """One daemon thread expiring tasks whose deadline has passed.
+
+    The heap refers to tasks weakly: a task done with, and its arguments and
+    result, go as soon as its caller drops it, and the heap is compacted
+    once most of its entries are dead.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._cond = threading.Condition(threading.Lock())
+        self._counter = itertools.count()
+        self._thread = None
+        self._stopped = False
+        # entries whose task is gone; counted without the lock, which the
+        # thread dropping a task may hold
+        self._dead = 0
+
+    def _dropped(self, ref):
+        self._dead += 1
+
+    def add(self, deadline, task):
+        with self._cond:
+            if self._dead > len(self._heap) // 2:
+                self._heap = [e for e in self._heap if e[2]() is not None]
+                heapq.heapify(self._heap)
+                self._dead = 0
+            entry = (deadline, next(self._counter),
+                     weakref.ref(task, self._dropped))
+            heapq.heappush(self._heap, entry)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+            elif self._heap[0] is entry:
+                self._cond.notify()
+
+    def stop(self):
+        """Let the thread exit before the interpreter tears down."""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join(1)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._heap and not self._stopped:
+                    self._cond.wait()
+                if self._stopped:
+                    return
+                deadline, _, ref = self._heap[0]
+                delay = deadline - time.time()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+                heapq.heappop(self._heap)
+            task = ref()
+            if task is not None:
+                task.expire()
+
+
+class WorkerPool(object):
+    """Daemon worker threads fed from one queue.
+
+    A worker is started whenever a task is submitted while none is idle, up
+    to max_workers, so calls abandoned after a timeout do not starve later
+    ones until that limit is reached.
+    """
+
+    def __init__(self, max_workers=32):
+        if max_workers < 1:
+            raise ValueError("max_workers must be 1 or greater")
+        self.max_workers = max_workers
+        self._queue = Queue.Queue()
+        self._lock = threading.Lock()
+        self._workers = 0
+        # idle workers no task has been promised to, and queued tasks
+        # waiting for a busy worker to finish
+        self._idle = 0
+        self._backlog = 0
+
+    def _work(self):
+        while True:
+            task = self._queue.get()
+            task.run()
+            with self._lock:
+                if self._backlog:
+                    self._backlog -= 1
+                else:
+                    self._idle += 1
+
+    def submit(self, function, *args, **kwargs):
+        task = _Task(function, args, kwargs)
+        with self._lock:
+            if self._idle:
+                # the idle worker is this task's, a concurrent submit
+                # must not count on it too
+                self._idle -= 1
+            elif self._workers < self.max_workers:
+                worker = threading.Thread(target=self._work)
+                worker.daemon = True
+                self._workers += 1
+                worker.start()
+            else:
+                self._backlog += 1
+        self._queue.put(task)
+        return task
+
+
+_worker_pool = None
+_worker_pool_lock = threading.Lock()
+_deadlines = _Deadlines()
+atexit.register(_deadlines.stop)
+
+def worker_pool():
+    """The worker pool shared by thread_timeout callers."""
+    global _worker_pool
+    if _worker_pool is None:
+        with _worker_pool_lock:
+            if _worker_pool is None:
+                _worker_pool = WorkerPool()
+    return _worker_pool
+
+
+def thread_timeout(seconds, cancel_arg=None):
+    """Timeout calls run on the shared worker thread pool.
+
+    The call runs in the same process, so it can return any object (boto
+    connections and results included) and costs a queue round trip rather
+    than a fork. Threads cannot be killed: on timeout the caller gets
+    TimeoutException while the call keeps running in its worker. If
+    cancel_arg is given, the function receives a threading.Event under that
+    keyword argument which is set on timeout, and should return early once
+    it is set.
+
+    Usage:
+        @thread_timeout(5, cancel_arg='cancel')
+        def poll(conn, cancel=None):
+            while not cancel.is_set():
+                ...
+    """
+    if seconds <= 0:
+        raise ValueError("seconds must be greater than 0")
+    def wrapper(function):
+        def inner(*args, **kwargs):
+            cancel = None
+            if cancel_arg is not None:
+                cancel = kwargs[cancel_arg] = threading.Event()
+            task = worker_pool().submit(function, *args, **kwargs)
+            _deadlines.add(time.time() + seconds, task)
+            if not task.wait():
+                if cancel is not None:
+                    cancel.set()
+                raise TimeoutException('timed out after {0} seconds'.format(seconds))
+            if task.success:
+                return task.result
+            raise task.result[0], task.result[1], task.result[2]
+        inner.__doc__ = function.__doc__
+        inner.__name__ = function.__name__
+        inner.__wrapped__ = function
+        return inner
+    return wrapper
+
+
+def _call_wrapped(module, name, args, kwargs):
+    """Run the undecorated function named name in a pool process."""
+    try:
+        __import__(module)
+        function = getattr(sys.modules[module], name)
+        function = getattr(function, '__wrapped__', function)
+        return function(*args, **kwargs)
+    except Exception as e:
+        # the traceback object stays in this process
+        e.remote_traceback = traceback.format_exc()
+        raise
+
+
+class ProcessPool(object):
+    """Persistent multiprocessing pool that is killed and restarted when a
+    call times out."""
+
+    def __init__(self, processes=None):
+        self.processes = processes
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def _get(self):
+        with self._lock:
+            if self._pool is None:
+                import multiprocessing
+                self._pool = multiprocessing.Pool(self.processes)
+            return self._pool
+
+    def call(self, seconds, function, args, kwargs):
+        import multiprocessing
+        pool = self._get()
+        # get() also raises the errors of pickling the arguments or the
+        # result, which never reach a callback
+        result = pool.apply_async(
+            _call_wrapped, (function.__module__, function.__name__, args, kwargs))
+        try:
+            return result.get(seconds)
+        except multiprocessing.TimeoutError:
+            # the worker may be stuck for good, start over with fresh ones
+            with self._lock:
+                if self._pool is pool:
+                    self._pool = None
+            pool.terminate()
+            raise TimeoutException('timed out after {0} seconds'.format(seconds))
+
+    def close(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+
+_process_pool = ProcessPool()
+atexit.register(_process_pool.close)
+
+def pool_timeout(seconds):
+    """Timeout calls run on a persistent process pool.
+
+    For CPU bound work that may need a hard kill: the workers are forked
+    once, and killed and replaced only when a call times out (which also
+    fails the other calls running at that moment). The decorated function
+    must be defined at module level and its arguments and result must be
+    picklable. Its errors are raised in the caller with the worker's
+    formatted traceback as their remote_traceback attribute.
+    """
+    if seconds <= 0:
+        raise ValueError("seconds must be greater than 0")
+    def wrapper(function):
+        def inner(*args, **kwargs):
+            return _process_pool.call(seconds, function, args, kwargs)
+        inner.__doc__ = function.__doc__
+        inner.__name__ = function.__name__
+        inner.__wrapped__ = function
+        return inner
+    return wrapper
+
 if __name__=='__main__':
     @timeout(3)
     def s():
@@ -0,0 +1,448 @@
+#
+# ec2 utilities - non-blocking EC2 calls returning futures
+#
+
+import sys
+import time
+import heapq
+import itertools
+import threading
+from boto.exception import BotoServerError, EC2ResponseError
+
+from decorators import (WorkerPool, retry_delay, single_attempts,
+                        TRANSIENT, PERMANENT)
+from waiter import (AdaptiveInterval, WaitResult, describe_instances,
+                    instance_targets, record_poll, BATCH_SIZE)
+from coalesce import BAD_ID_CODES, MAX_BATCH
+from lookup import LookupIndex, use_index
+import ec2
+from ec2 import ec2_retry
+
+DEFAULT_CONCURRENCY = 32
+# seconds get_ami collects ids before describing them together
+IMAGE_WINDOW = 0.02
+
+
+class Future(object):
+    """Result of a call that may not have finished yet."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+
+    def _finish(self, result, exc_info):
+        with self._lock:
+            if self._done.is_set():
+                return
+            self._result = result
+            self._exc_info = exc_info
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def set_result(self, result):
+        self._finish(result, None)
+
+    def set_exception(self, exc_info):
+        """Fail with exc_info, a sys.exc_info() tuple."""
+        self._finish(None, exc_info)
+
+    def done(self):
+        return self._done.is_set()
+
+    def add_done_callback(self, callback):
+        """Call callback(future) once done, at once if it already is. The
+        callback runs on the thread that finishes the future."""
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def result(self, timeout=None):
+        """Block till done and return the result or raise the error.
+        @type   timeout: float
+        @param  timeout: seconds, None waits forever
+        """
+        if not self._done.wait(timeout):
+            raise RuntimeError('future not done after {0}s'.format(timeout))
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exception(self, timeout=None):
+        """The error the call failed with, None if it succeeded."""
+        if not self._done.wait(timeout):
+            raise RuntimeError('future not done after {0}s'.format(timeout))
+        return self._exc_info and self._exc_info[1]
+
+
+def chain(future, function):
+    """Future of function(result of future); errors are passed on."""
+    chained = Future()
+    def done(f):
+        if f._exc_info is not None:
+            chained.set_exception(f._exc_info)
+            return
+        try:
+            chained.set_result(function(f._result))
+        except Exception:
+            chained.set_exception(sys.exc_info())
+    future.add_done_callback(done)
+    return chained
+
+
+def gather(futures):
+    """Future of the list of results, failing with the first error."""
+    futures = list(futures)
+    gathered = Future()
+    if not futures:
+        gathered.set_result([])
+        return gathered
+    remaining = [len(futures)]
+    lock = threading.Lock()
+    def done(f):
+        if f._exc_info is not None:
+            gathered.set_exception(f._exc_info)
+            return
+        with lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last:
+            gathered.set_result([f._result for f in futures])
+    for future in futures:
+        future.add_done_callback(done)
+    return gathered
+
+
+class Scheduler(object):
+    """One daemon thread running callables once their time has come, so
+    that backoffs and polling intervals hold no thread while they wait."""
+
+    def __init__(self):
+        self._heap = []
+        self._cond = threading.Condition(threading.Lock())
+        self._counter = itertools.count()
+        self._thread = None
+
+    def call_later(self, delay, function, *args):
+        with self._cond:
+            entry = (time.time() + delay, next(self._counter), function, args)
+            heapq.heappush(self._heap, entry)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+            elif self._heap[0] is entry:
+                self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._heap:
+                    self._cond.wait()
+                when, _, function, args = self._heap[0]
+                delay = when - time.time()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+                heapq.heappop(self._heap)
+            try:
+                function(*args)
+            except Exception:
+                # the functions scheduled here finish their futures themselves
+                pass
+
+
+class EC2Client(object):
+    """EC2 calls that return a Future at once.
+
+    boto 2 blocks on its sockets, so there is no event loop here: every
+    request in flight holds a worker thread with its own pooled
+    connection (ec2.connections), and max_concurrency threads is the
+    ceiling. More calls queue up till a worker is free, and each worker
+    keeps an open connection, so raise it with care. Retries follow the
+    retry_policy of the ec2.py helper they call, but the backoff between
+    attempts, like the interval between polls of wait_for_instances, is
+    waited out on the Scheduler instead of in a sleeping thread; retrying
+    helpers the attempt calls in turn (del_keypair from create_keypair,
+    the lookup index and paginated listings) make a single attempt, see
+    decorators.single_attempts. Concurrent get_ami calls are described
+    together, up to MAX_BATCH ids per DescribeImages call.
+
+    The client lives as long as the process, like ec2.connections; its
+    threads are daemons.
+
+    @type   max_concurrency: int
+    @param  max_concurrency: requests in flight at most
+    """
+
+    def __init__(self, label, key, secret, ec2_url, validation=False,
+                 max_concurrency=DEFAULT_CONCURRENCY):
+        self._connection = ec2.connections.provider(label, key, secret,
+                                                    ec2_url, validation)
+        # the workers' connections share one existence index
+        self.index = LookupIndex(self._connection)
+        self._pool = WorkerPool(max_concurrency)
+        self._scheduler = Scheduler()
+        self._lock = threading.Lock()
+        self._images = {}
+        self._images_flush = False
+        self.stats = {'calls': 0, 'attempts': 0, 'retries': 0, 'failures': 0}
+
+    # --- calls and retries ----------------------------------------------
+
+    def call(self, function, *args, **kwargs):
+        """Run function(connection, *args, **kwargs) on a worker.
+
+        When function is decorated with decorators.retry_policy (as the
+        ec2.py helpers are), the undecorated function runs once per attempt
+        and failed attempts are rescheduled after the policy's backoff.
+        @rtype Future
+        """
+        future = Future()
+        policy = getattr(function, 'retry_policy', None)
+        if policy is not None:
+            function = function.__wrapped__
+        with self._lock:
+            self.stats['calls'] += 1
+        self._submit(future, function, args, kwargs, policy, time.time(), 1)
+        return future
+
+    def _submit(self, future, function, args, kwargs, policy, start, attempt):
+        self._pool.submit(self._attempt, future, function, args, kwargs,
+                          policy, start, attempt)
+
+    def _attempt(self, future, function, args, kwargs, policy, start, attempt):
+        with self._lock:
+            self.stats['attempts'] += 1
+        conn = self._connection()
+        use_index(conn, self.index)
+        _single_tries(conn)
+        # the connection belongs to this worker thread only
+        conn._single_try = policy is not None
+        try:
+            with single_attempts():
+                result = function(conn, *args, **kwargs)
+        except Exception as e:
+            exc_info = sys.exc_info()
+            if policy is None:
+                outcome = PERMANENT
+            elif policy['classify'] is not None:
+                outcome = policy['classify'](e)
+            else:
+                outcome = TRANSIENT
+            if outcome != PERMANENT and attempt < policy['tries']:
+                delay = retry_delay(outcome, attempt, **policy['delays'])
+                deadline = policy['deadline']
+                if deadline is None or time.time() - start + delay <= deadline:
+                    with self._lock:
+                        self.stats['retries'] += 1
+                    self._scheduler.call_later(
+                        delay, self._submit, future, function, args, kwargs,
+                        policy, start, attempt + 1)
+                    return
+            with self._lock:
+                self.stats['failures'] += 1
+            future.set_exception(exc_info)
+            return
+        finally:
+            conn._single_try = False
+        future.set_result(result)
+
+    # --- ec2.py helpers --------------------------------------------------
+
+    def get_azs(self):
+        return self.call(ec2.get_azs)
+
+    def get_az(self, az_name):
+        return self.call(_get_az, az_name)
+
+    def keypair_exists(self, label):
+        return self.call(_keypair_exists, label)
+
+    def create_keypair(self, label):
+        return self.call(ec2.create_keypair, label)
+
+    def del_keypair(self, label):
+        return self.call(ec2.del_keypair, label)
+
+    def getcreate_sec_group(self, label=u'default'):
+        return self.call(ec2.getcreate_sec_group, label)
+
+    def del_sec_group(self, label):
+        return self.call(ec2.del_sec_group, label)
+
+    def get_ami(self, ami_id):
+        """Future of the image, None if it does not exist. Ids asked for
+        within IMAGE_WINDOW seconds are described together."""
+        future = Future()
+        with self._lock:
+            self._images.setdefault(ami_id, []).append(future)
+            flush = not self._images_flush
+            self._images_flush = True
+        if flush:
+            self._scheduler.call_later(IMAGE_WINDOW, self._flush_images)
+        return future
+
+    def get_amis(self, ami_ids):
+        """Future of the images in the order of ami_ids, None for unknown
+        ones."""
+        return gather([self.get_ami(ami_id) for ami_id in ami_ids])
+
+    def _flush_images(self):
+        with self._lock:
+            waiting, self._images = self._images, {}
+            self._images_flush = False
+        ids = list(waiting)
+        for i in range(0, len(ids), MAX_BATCH):
+            self._describe_images(ids[i:i + MAX_BATCH], waiting)
+
+    def _describe_images(self, batch, waiting):
+        described = self.call(_describe_images, batch)
+        described.add_done_callback(
+            lambda f: self._images_described(f, batch, waiting))
+
+    def _images_described(self, future, batch, waiting):
+        error = future.exception()
+        if error is None:
+            images = dict((image.id, image) for image in future.result())
+            for ami_id in batch:
+                for waiter in waiting[ami_id]:
+                    waiter.set_result(images.get(ami_id))
+        elif isinstance(error, EC2ResponseError) and error.error_code in BAD_ID_CODES:
+            if len(batch) == 1:
+                for waiter in waiting[batch[0]]:
+                    waiter.set_result(None)
+                return
+            # one bad id fails the whole batch: halve it till the bad ids
+            # are on their own
+            half = len(batch) // 2
+            self._describe_images(batch[:half], waiting)
+            self._describe_images(batch[half:], waiting)
+        else:
+            for ami_id in batch:
+                for waiter in waiting[ami_id]:
+                    waiter.set_exception(future._exc_info)
+
+    # --- waiter ------------------------------------------------------------
+
+    def describe_instances(self, instance_ids, batch_size=BATCH_SIZE):
+        """Future of the list of instances, see waiter.describe_instances."""
+        return self.call(_describe_instances, list(instance_ids), batch_size)
+
+    def wait_for_instances(self, targets, timeout, interval=None,
+                           on_change=None, batch_size=BATCH_SIZE):
+        """Future of the WaitResult of waiter.wait_for_instances, polling
+        without holding a thread between polls. on_change is called from a
+        worker thread.
+        @rtype Future
+        """
+        if interval is None:
+            interval = AdaptiveInterval()
+        ids, objects = instance_targets(targets)
+        result = WaitResult()
+        pending = set(ids)
+        start = time.time()
+        future = Future()
+
+        def finish():
+            result.timed_out = [i for i in ids if i in pending]
+            result.elapsed = time.time() - start
+            future.set_result(result)
+
+        def poll():
+            result.polls += 1
+            described = self.describe_instances(
+                [i for i in ids if i in pending], batch_size)
+            described.add_done_callback(polled)
+
+        def polled(described):
+            if described.exception() is not None:
+                future.set_exception(described._exc_info)
+                return
+            try:
+                changed = record_poll(result, pending, objects,
+                                      described.result(), on_change)
+            except Exception:
+                future.set_exception(sys.exc_info())
+                return
+            remaining = timeout - (time.time() - start)
+            if not pending or remaining <= 0:
+                finish()
+            else:
+                self._scheduler.call_later(
+                    min(interval.next(changed), remaining), poll)
+
+        if pending:
+            poll()
+        else:
+            finish()
+        return future
+
+
+class _SendFailed(Exception):
+    """A network error, kept from boto's retry loop."""
+
+
+def _single_tries(conn):
+    # boto retries 5xx answers and network errors itself, sleeping on the
+    # calling thread, and sleeps after its last try too: while the worker
+    # makes an attempt of a retry policy, send once and raise at once
+    if getattr(conn, '_single_try', None) is not None:
+        return
+    mexe = conn._mexe
+    def send(connection, method, path, body, headers):
+        try:
+            connection.request(method, path, body, headers)
+            return connection.getresponse()
+        except conn.http_exceptions:
+            connection.close()
+            raise _SendFailed(sys.exc_info())
+    def refuse(response, i, next_sleep):
+        if response.status >= 500:
+            raise BotoServerError(response.status, response.reason,
+                                  response.read())
+    def single_try_mexe(request, sender=None, override_num_retries=None,
+                        retry_handler=None):
+        if not conn._single_try:
+            return mexe(request, sender, override_num_retries, retry_handler)
+        try:
+            return mexe(request, sender or send, 0, retry_handler or refuse)
+        except _SendFailed as e:
+            exc_info = e.args[0]
+            raise exc_info[0], exc_info[1], exc_info[2]
+    conn._mexe = single_try_mexe
+    conn._single_try = False
+
+
+# the index lookups behind these retry with the policy of the index, which
+# this client replaces by its own
+@ec2_retry(3, deadline=60)
+def _get_az(conn, az_name):
+    return ec2.get_az(conn, az_name)
+
+@ec2_retry(3, deadline=60)
+def _keypair_exists(conn, label):
+    return ec2.keypair_exists(conn, label)
+
+@ec2_retry(3, deadline=60)
+def _describe_images(conn, ami_ids):
+    return conn.get_all_images(image_ids=ami_ids)
+
+@ec2_retry(3, deadline=60)
+def _describe_instances(conn, instance_ids, batch_size):
+    # one try per batch: the policy of this function retries the call
+    return list(describe_instances(conn, instance_ids, batch_size, tries=1))
+
+
+def client_from_env(max_concurrency=DEFAULT_CONCURRENCY, label='NeCTAR'):
+    """EC2Client for the endpoint described by the ec2rc.sh variables."""
+    import os
+    return EC2Client(label, os.environ.get('EC2_ACCESS_KEY'),
+                     os.environ.get('EC2_SECRET_KEY'), os.environ.get('EC2_URL'),
+                     max_concurrency=max_concurrency)
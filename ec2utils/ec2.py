@@ -3,13 +3,54 @@
 #
 
 from urlparse import urlparse
-from decorators import retry
+from decorators import retry_policy, THROTTLED, TRANSIENT, PERMANENT
+from waiter import wait_for_instances, WaitResult
+from pool import default_manager
+from coalesce import resolver_for
+from secgroups import find_group
+from lookup import index_for, known_index
+from ratelimit import limiter_from_env, THROTTLE_CODES
+import metrics
 #boto
 import boto
 from boto.ec2.regioninfo import RegionInfo
-from boto.exception import EC2ResponseError
+from boto.exception import BotoServerError, EC2ResponseError
 import sys
 import time
+import socket
+import httplib
+
+def _limiter_from_env():
+    # a malformed setting must not break every command: run unlimited
+    try:
+        return limiter_from_env()
+    except (ValueError, OSError), e:
+        print >> sys.stderr, "EC2UTILS_RATE_LIMIT ignored: {0}".format(e)
+        return None
+
+# shared by every connection made by get_connection, see set_rate_limiter
+rate_limiter = _limiter_from_env()
+
+def set_rate_limiter(limiter):
+    """
+    Rate limit connections made by get_connection from now on.
+    @type   limiter: RateLimiter
+    @param  limiter: limiter, or None to stop limiting new connections
+    """
+    global rate_limiter
+    rate_limiter = limiter
+
+def enable_metrics(registry=None):
+    """
+    Instrument connections made by get_connection from now on.
+    @type   registry: MetricsRegistry
+    @param  registry: where to record, a new registry when None
+
+    @rtype : MetricsRegistry
+    @return: the registry in use
+    """
+    return metrics.enable(registry)
+
 # boto 2.34
 def get_connection(label, key, secret, ec2_url, validation):
     """
@@ -61,9 +102,75 @@ def get_connection(label, key, secret, ec2_url, validation):
                                 port=url.port,
                                 path=path)
 
+    # rate limit first: the instrumented calls then see the limiter's waits
+    # and keep them out of latency and parse times
+    if rate_limiter is not None:
+        rate_limiter.wrap_connection(conn)
+    if metrics.active is not None:
+        metrics.instrument_connection(conn, metrics.active)
     return conn
 
-@retry(3)
+def connection_settings(conn):
+    """
+    Arguments of get_connection that would build a connection like conn
+    @type   conn: EC2 connection
+    @param  conn: EC2 connection
+
+    @rtype : Tuple
+    @return: (label, key, secret, ec2_url, validation)
+    """
+    ec2_url = '{0}://{1}:{2}{3}'.format('https' if conn.is_secure else 'http',
+                                        conn.host, conn.port, conn.path)
+    return (conn.region.name, conn.aws_access_key_id, conn.aws_secret_access_key,
+            ec2_url, conn.https_validate_certificates)
+
+# connections reused per thread, see get_pooled_connection
+connections = default_manager(get_connection)
+
+def get_pooled_connection(label, key, secret, ec2_url, validation):
+    """
+    Get the calling thread's EC2 API connection, creating it on first use.
+    Takes the same arguments as get_connection. The connection stays open
+    for later calls from the same thread and must not be handed to other
+    threads; statistics are available from connections.stats().
+
+    @rtype : Ec2 Connection
+    @return: ec2 connection
+    """
+    return connections.get(label, key, secret, ec2_url, validation)
+
+# error codes worth retrying although the status may be 4xx
+TRANSIENT_CODES = ('InternalError', 'InternalFailure', 'ServiceUnavailable',
+                   'Unavailable', 'RequestExpired', 'IdempotentParameterMismatch')
+
+def classify_ec2_error(e):
+    """Classify an exception raised by a boto EC2 call for retry_policy.
+    @type   e: Exception
+    @param  e: exception
+
+    @rtype String
+    @return THROTTLED, TRANSIENT or PERMANENT
+    """
+    # boto raises EC2ResponseError for 4xx answers, but its base class
+    # BotoServerError for 5xx ones (e.g. a 503 RequestLimitExceeded) once
+    # its own retries are used up
+    if isinstance(e, BotoServerError):
+        if e.error_code in THROTTLE_CODES:
+            return THROTTLED
+        if e.status >= 500 or e.error_code in TRANSIENT_CODES:
+            return TRANSIENT
+        return PERMANENT
+    if isinstance(e, (socket.error, httplib.HTTPException)):
+        return TRANSIENT
+    return PERMANENT
+
+def ec2_retry(tries, deadline=None):
+    """retry_policy using classify_ec2_error: throttling backs off with full
+    jitter, 5xx and network errors are retried quickly and any other
+    service error is raised at once."""
+    return retry_policy(tries, deadline=deadline, classify=classify_ec2_error)
+
+@ec2_retry(3, deadline=60)
 def create_keypair(ec2conn, label):
     """Create an SSH keypair for accessing instances.
     @type   ec2conn: EC2 connection
@@ -72,19 +179,16 @@ def create_keypair(ec2conn, label):
     @type   label: String
     @param  label: label
 
-    @rtype Boolean
-    @return True if succeed, False otherwise    
+    @rtype KeyPair
+    @return the new keypair
     """
     # Try to delete first (from previous run), then create
-    try:
-        del_keypair(ec2conn, label)
-        kp = ec2conn.create_key_pair(label)
-        return kp
-    except EC2ResponseError,e:
-        print t5exc.exception()
-        return False
-
-@retry(2)
+    del_keypair(ec2conn, label)
+    keypair = ec2conn.create_key_pair(label)
+    _remember(ec2conn, 'keypairs', keypair)
+    return keypair
+
+@ec2_retry(2, deadline=30)
 def getcreate_sec_group(ec2conn, label=u'default'):
     """Get and possibly create if it does exist the EC2 security group described by label. Using ec2conn to talk to AWS.
     @type   ec2conn: EC2 connection
@@ -96,21 +200,14 @@ def getcreate_sec_group(ec2conn, label=u'default'):
     @rtype String
     @return security group    
     """
-    try:
-        secgroupdesc = unicode('n'+`int(time.time())`)
-        secgroup = None
-        for group in ec2conn.get_all_security_groups():
-            if group.name == label:
-                secgroup = group
-                break
-        if not secgroup:
-            secgroup = ec2conn.create_security_group(label, secgroupdesc)
-        return secgroup
-    except EC2ResponseError, e:
-        print t5exc.exception()
-        return False
-
-@retry(5)
+    secgroupdesc = unicode('n'+`int(time.time())`)
+    secgroup = find_group(ec2conn, name=label)
+    if not secgroup:
+        secgroup = ec2conn.create_security_group(label, secgroupdesc)
+        _remember(ec2conn, 'security_groups', secgroup)
+    return secgroup
+
+@ec2_retry(5, deadline=120)
 def del_sec_group(ec2conn, label):
     """Delete the EC2 security group described by label. Using ec2conn to talk to AWS.
     @type   ec2conn: EC2 connection
@@ -120,20 +217,19 @@ def del_sec_group(ec2conn, label):
     @param  label: label
 
     @rtype Boolean
-    @return True if succeed, False otherwise    
+    @return True, also when the group does not exist
     """
     try:
-        # returns True even when secgroup doesn't exist
         ec2conn.delete_security_group(label)
-        return True
     except EC2ResponseError, e:
-        print t5exc.exception()
-        if parse_response_error(e, 'Code') == u'SecurityGroupNotFoundForProject':
-            # secgroup might already be deleted so don't keep trying
-            return True
-        return False
-
-@retry(5)
+        # secgroup might already be deleted so don't keep trying
+        if e.error_code not in (u'SecurityGroupNotFoundForProject',
+                                u'InvalidGroup.NotFound'):
+            raise
+    _forget(ec2conn, 'security_groups', label)
+    return True
+
+@ec2_retry(5, deadline=120)
 def del_keypair(ec2conn, label):
     """Delete the EC2 keypair described by label. Using ec2conn to talk to AWS.
     @type   ec2conn: EC2 connection
@@ -143,19 +239,28 @@ def del_keypair(ec2conn, label):
     @param  label: label
 
     @rtype Boolean
-    @return True if succeed, False otherwise    
+    @return True, also when the keypair does not exist
     """
-    try:
-        # returns True even when keypair doesn't exist
-        ec2conn.delete_key_pair(label)
-        return True
-    except EC2ResponseError,e:
-        print t5exc.exception()
-        return False
-
-@retry(5)
+    # returns True even when keypair doesn't exist
+    ec2conn.delete_key_pair(label)
+    _forget(ec2conn, 'keypairs', label)
+    return True
+
+def _remember(ec2conn, kind, obj):
+    # keep the lookup index of ec2conn, if it has one, up to date
+    index = known_index(ec2conn)
+    if index is not None:
+        index.add(kind, obj)
+
+def _forget(ec2conn, kind, name):
+    index = known_index(ec2conn)
+    if index is not None:
+        index.discard(kind, name)
+
 def keypair_exists(ec2conn, label):
     """Checks if a keypair exists. Using ec2conn to talk to AWS.
+    Answered from the connection's lookup index (see lookup.LookupIndex),
+    which lists the keypairs once and remembers missing names briefly.
     @type   ec2conn: EC2 connection
     @param  ec2conn: EC2 connection
 
@@ -165,31 +270,38 @@ def keypair_exists(ec2conn, label):
     @rtype Boolean
     @return True if exists, False otherwise
     """
-    try:
-        kp = ec2conn.get_key_pair(label)
-        if kp:
-            return True
-    except EC2ResponseError,e:
-        print t5exc.exception()
-    return False
-
-@retry(3)
+    return index_for(ec2conn).exists('keypairs', label)
+
 def get_ami(ec2conn, ami_id):
-    """Get . Using ec2conn to talk to AWS.
+    """Get an image. Using ec2conn to talk to AWS.
+    Threads asking the same connection for images share its
+    coalesce.ImageResolver, which describes them together.
     @type   ec2conn: EC2 connection
     @param  ec2conn: EC2 connection
 
-    @type   label: String
-    @param  label: label
+    @type   ami_id: String
+    @param  ami_id: image id
+
+    @rtype Image
+    @return the image, None if it does not exist
     """
-    try:
-        ami = ec2conn.get_image(ami_id)
-        return ami
-    except EC2ResponseError,e:
-        print t5exc.exception()
-        return False
+    return resolver_for(ec2conn).get(ami_id)
+
+def get_amis(ec2conn, ami_ids):
+    """Get several images with one DescribeImages call per 200 ids,
+    through the connection's coalesce.ImageResolver like get_ami.
+    @type   ec2conn: EC2 connection
+    @param  ec2conn: EC2 connection
 
-@retry(3)
+    @type   ami_ids: List
+    @param  ami_ids: image ids
+
+    @rtype List
+    @return images in the order of ami_ids, None for unknown ids
+    """
+    return resolver_for(ec2conn).get_many(ami_ids)
+
+@ec2_retry(3, deadline=60)
 def get_azs(ec2conn):
     """Get availability zones.
     @type   ec2conn: EC2 connection
@@ -198,11 +310,7 @@ def get_azs(ec2conn):
     @rtype   List 
     @return  availability zones
     """
-    try:
-        return ec2conn.get_all_zones()
-    except EC2ResponseError,e:
-        print t5exc.exception()
-        return False
+    return ec2conn.get_all_zones()
 
 
 def get_az(ec2conn, az_name):
@@ -216,39 +324,43 @@ def get_az(ec2conn, az_name):
     @rtype: 
     @return: availability zone information
     """
-    azs = get_azs(ec2conn)
-    for az in azs:
-        if az.name == az_name:
-            return az
-    return None
+    return index_for(ec2conn).get('zones', az_name)
 
 
 
 def blockTillRunning(reservation, timeout):
     """Block still all instances in reservation are in running state.
     @type   reservation: EC2 reservation
-    @param  reservation: EC2 reservation
+    @param  reservation: EC2 reservation, or a list of reservations
 
     @type   timeout: int
     @param  timeout in seconds
+
+    @rtype WaitResult
+    @return which instances are running, failed or timed out
     """
-    # block till all instances are running or timeout
-    # check the status of instances
-    # some times out needed here
-    start = time.time()
-    stopChecking = False
-    while stopChecking == False and (time.time() - start <= timeout ): 
-        stopChecking = True
-        for instance in reservation.instances:
-            instance.update()
-            if(instance.state != u'running'):
-                stopChecking = False
-        time.sleep(10)
+    if isinstance(reservation, (list, tuple)):
+        reservations = reservation
+    else:
+        reservations = [reservation]
+    if not reservations:
+        return WaitResult()
+    return wait_for_instances(reservations[0].connection, reservations, timeout)
 
 
 def main(argv):
-    """ for testing """
-    conn = get_connection("", "", "", "")
-    conn.launch_vms(conn, "", "", "", "", [''])
+    """ for testing: launch [count] instances of image-id with the ec2rc.sh
+    credentials and wait till they are running """
+    from fanout import env_endpoint
+    from launch import launch_fleet
+    def ready(instance):
+        print instance.id, instance.state, instance.placement
+    endpoint = env_endpoint()
+    if endpoint is None or not argv:
+        print "usage: source ec2rc.sh; python ec2.py image-id [count]"
+        return 2
+    count = int(argv[1]) if len(argv) > 1 else 1
+    print launch_fleet(endpoint, argv[0], count, on_ready=ready)
+    return 0
 
     
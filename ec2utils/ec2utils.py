@@ -1,9 +1,14 @@
 #!/usr/bin/env python
+# boto, tabulate and the modules using them are imported by the functions
+# needing them, so that e.g. -h or a cached image listing start quickly
 import os
-import ec2
 import sys
+import time
 import getopt
-from tabulate import tabulate
+import metrics
+from cache import DEFAULT_TTL
+
+REGION_LABEL = 'NeCTAR'
 
 def check_env_variables():
     if os.environ.get('EC2_ACCESS_KEY')==None \
@@ -16,41 +21,755 @@ def create_ec2_connection(region):
     _access_key = os.environ.get('EC2_ACCESS_KEY')
     _secret_key = os.environ.get('EC2_SECRET_KEY')
     _url = os.environ.get('EC2_URL')
-    return ec2.get_connection(region, _access_key, _secret_key, _url, False)  
-        
-
-def list_ami_ids(connection):
-    images = connection.get_all_images()
-    _table_headers = ['ID', 'Name']
-    _table_rows = [] 
-    for image in images:
-        _table_row=[image.id, image.name]
-        _table_rows.append(_table_row)
-    print tabulate(_table_rows, _table_headers)
+    import ec2
+    return ec2.get_pooled_connection(region, _access_key, _secret_key, _url, False)
+
+def create_image_cache(region, ttl=DEFAULT_TTL):
+    check_env_variables()
+    from cache import ImageCatalogCache
+    return ImageCatalogCache(region, os.environ.get('EC2_ACCESS_KEY'),
+                             os.environ.get('EC2_URL'), ttl)
+
+# fields of an image listing unless --fields says otherwise
+IMAGE_FIELDS = ['id', 'name']
+
+def print_images(images, output=None):
+    from output import Output
+    from cache import IMAGE_FIELDS as IMAGE_RECORD_FIELDS
+    output = output or Output()
+    with metrics.phase(metrics.active, 'render'):
+        output.write(IMAGE_RECORD_FIELDS, images, IMAGE_FIELDS, default='table')
+
+def list_ami_ids(connection, cache=None, refresh=False, stale_ok=False,
+                 output=None):
+    """connection may be a callable returning the connection, so that a
+    cache hit does not connect (nor import boto) at all"""
+    from cache import fetch_image_records
+    def fetch():
+        conn = connection() if callable(connection) else connection
+        return fetch_image_records(conn)
+    if cache is None:
+        images = fetch()
+    else:
+        images = cache.get(fetch, refresh=refresh, stale_ok=stale_ok)
+    print_images(images, output)
+
+def stream_ami_ids(connection, image_ids=None, owners=None, filters=None,
+                   output=None):
+    """Print images as the response is parsed, reading only the printed
+    (and sorted on) fields."""
+    from records import iter_images, IMAGES
+    from output import Output
+    output = output or Output()
+    fields = output.needed(sorted(IMAGES.fields), IMAGE_FIELDS)
+    output.write(fields, iter_images(connection, image_ids, owners, filters, fields),
+                 IMAGE_FIELDS, widths={'id': 12})
+
+def wait_instances(connection, instance_ids, timeout):
+    from waiter import wait_for_instances
+    def report(instance, old_state):
+        print "{0}: {1} -> {2}".format(instance.id, old_state or '-', instance.state)
+        sys.stdout.flush()
+    result = wait_for_instances(connection, instance_ids, timeout, on_change=report)
+    print "running: {0}, failed: {1}, timed out: {2} ({3} polls, {4:.1f}s)".format(
+        len(result.running), len(result.failed), len(result.timed_out),
+        result.polls, result.elapsed)
+    for instance_id, state in sorted(result.failed.items()):
+        print "failed: {0} ({1})".format(instance_id, state)
+    for instance_id in result.timed_out:
+        print "timed out: {0} ({1})".format(instance_id, result.states.get(instance_id, 'unknown'))
+    return result
+
+def list_fan_out(endpoints, query, timeout, output=None):
+    from output import Output, field_name
+    from fanout import fan_out
+    result = fan_out(endpoints, query, timeout)
+    headers, rows = result.headers, result.rows
+    if len(endpoints) == 1:
+        headers, rows = headers[1:], [row[1:] for row in rows]
+    with metrics.phase(metrics.active, 'render'):
+        (output or Output()).write([field_name(h) for h in headers], rows,
+                                   default='table')
+    for name, error in sorted(result.errors.items()):
+        print >> sys.stderr, "{0}: {1}".format(name, error)
+    for name in result.timed_out:
+        print >> sys.stderr, "{0}: no answer within {1}s".format(name, timeout)
+    return result
 
 def usage():
         print "To list images"
-        print "ec2utils.py [--images/i]"
+        print "ec2utils.py [--images/i] [filters] [image-id ...]"
+        print "Image filters (sent to the server, output is streamed):"
+        print "  --owner=OWNER       owner id, or self/amazon/aws-marketplace (repeatable)"
+        print "  --name=PATTERN      image name, * and ? wildcards allowed"
+        print "  --state=STATE       e.g. available, pending, failed"
+        print "  --is-public=BOOL    true or false"
+        print "  --tag=KEY[=VALUE]   tagged with KEY (and VALUE)"
+        print "  --stream            stream the whole catalog without caching"
+        print "Listing output (images, other resources, query, provision and teardown):"
+        print "  --format=FORMAT     text (default), table, fixed, jsonl (or json), csv or tsv;"
+        print "                      fixed, jsonl, csv and tsv print rows as they arrive"
+        print "  --fields=F,...      fields to print, e.g. id,name,state,creation_date,tags"
+        print "  --sort=[-]F,...     sort on fields, - for descending"
+        print "  --limit=N           print the first N rows only"
+        print "To find images by name in a local index of the cached catalog"
+        print "ec2utils.py find-image PATTERN [--newest] [--state=STATE] [--owner=OWNER] [--tag=KEY[=VALUE]]"
+        print "  PATTERN is a glob (* ? [...]) or, without wildcards, a name prefix;"
+        print "  --newest prints the most recently created match only. Exit status 1 if"
+        print "  nothing matches. Takes the image cache and listing output options"
+        print "Image cache options:"
+        print "  --ttl=SECONDS   maximum age of the cached catalog (default {0})".format(DEFAULT_TTL)
+        print "  --refresh       ignore the cached catalog and refetch it"
+        print "  --stale         print an expired catalog at once and refresh it in the background"
+        print "  --no-cache      do not use the catalog cache"
+        print "  --cache-stats   report cache hit/miss/age"
+        print "To list other resources"
+        print "ec2utils.py [--zones/-z] [--secgroups/-g] [--keypairs/-k] [--instances/-n]"
+        print "To query several endpoints at once (profiles from ~/.ec2utils/endpoints.ini)"
+        print "ec2utils.py --endpoints=NAME,...|all [--endpoint-timeout=SECONDS] [listing options]"
+        print "To snapshot the account into a local SQLite database, and to query it offline"
+        print "ec2utils.py snapshot [--db=PATH] [images|instances|security_groups|keypairs|zones ...]"
+        print "ec2utils.py query [--db=PATH]                      last snapshot of every type"
+        print "ec2utils.py query TYPE [id ...] [--name=PATTERN] [--state=STATE] [--zone=ZONE] [--tag=KEY[=VALUE]]"
+        print "ec2utils.py query --sql='SELECT ...'               e.g. joining instances and images"
+        print "To create or delete the keypairs and security groups of many labels at once"
+        print "ec2utils.py provision [--only=keypairs|secgroups] [--rule=RULE ...] [--key-dir=DIR]"
+        print "            [--replace-keys] [--workers=N] [--format=FORMAT] label ...|-"
+        print "ec2utils.py teardown [--only=keypairs|secgroups] [--workers=N] [--format=FORMAT] label ...|-"
+        print "  RULE is protocol:port[-port]:source, e.g. tcp:22:0.0.0.0/0 or tcp:80:sg-1234;"
+        print "  given rules replace the ingress rules of every group. - reads labels from stdin;"
+        print "  keypairs are created only with --key-dir, where their private keys are saved"
+        print "To launch COUNT instances with concurrent calls spread over the zones, printing"
+        print "each instance as it reaches running"
+        print "ec2utils.py launch IMAGE COUNT [--type=TYPE] [--label=LABEL [--key-dir=DIR]]"
+        print "            [--zone=ZONE,...] [--batch=N] [--workers=N] [--timeout=SECONDS]"
+        print "            [--no-wait] [--format=text|json]"
+        print "  --label uses (and creates) the keypair and security group named LABEL; a"
+        print "  missing keypair needs --key-dir to save its private key in"
+        print "To wait till instances are running"
+        print "ec2utils.py --wait/-w [--timeout=SECONDS] instance-id [...]"
+        print "To stream instance changes (all instances, a filtered subset or the given ones)"
+        print "ec2utils.py --watch [--format=text|json] [--timeout=SECONDS] [--state=STATE]"
+        print "            [--zone=ZONE] [--tag=KEY[=VALUE]] [instance-id ...]"
+        print "General options:"
+        print "  --pool-stats    report connection reuse statistics"
+        print "  --stats         report per API call counts, latencies, bytes and retries"
+        print "  --stats-file=PATH  write the same metrics to PATH, as json if PATH"
+        print "                  ends in .json, in the Prometheus text format otherwise"
+        print "Daemon mode (socket ~/.ec2utils/daemon.sock, or EC2UTILS_SOCKET):"
+        print "  --daemon        serve later invocations from this process, keeping"
+        print "                  connections, caches and rate limits warm"
+        print "  --daemon-ttl=SECONDS  reuse zone and security group listings for"
+        print "                  this long (default 60, 0 disables)"
+        print "  --daemon-stop   stop the running daemon"
+        print "  --no-daemon     run the command here even if a daemon is running;"
+        print "                  launch, provision, teardown, --db, --wait, --watch and"
+        print "                  labels read from stdin (-) always run here"
+
+SHORT_OPTIONS = ':hiwzgkn'
+LONG_OPTIONS = ["help", "images", "ttl=", "refresh", "stale", "no-cache",
+                "cache-stats", "owner=", "name=", "state=", "is-public=",
+                "stream", "wait", "timeout=", "pool-stats", "zones",
+                "secgroups", "keypairs", "instances", "endpoints=",
+                "endpoint-timeout=", "stats", "stats-file=", "daemon",
+                "daemon-ttl=", "daemon-stop", "no-daemon", "db=", "zone=",
+                "tag=", "sql=", "watch", "format=", "workers=", "only=",
+                "rule=", "key-dir=", "replace-keys", "type=", "label=",
+                "batch=", "no-wait", "fields=", "sort=", "limit=", "newest"]
+# subcommands, given as the first argument
+COMMANDS = ("snapshot", "query", "provision", "teardown", "launch", "find-image")
+# listing flags answered by fanout.QUERIES
+QUERY_OPTIONS = {"-z": "azs", "--zones": "azs",
+                 "-g": "secgroups", "--secgroups": "secgroups",
+                 "-k": "keypairs", "--keypairs": "keypairs",
+                 "-n": "instances", "--instances": "instances"}
+# commands whose output the daemon may reuse for --daemon-ttl seconds
+DAEMON_CACHEABLE_OPTIONS = ("-z", "--zones", "-g", "--secgroups")
+# commands run by this process even when a daemon is running: launch
+# prints as it goes, provision and teardown read labels from stdin and
+# save keys under a directory that may be relative to the current one
+LOCAL_COMMANDS = ('launch', 'provision', 'teardown')
+
+def _seconds(option, value):
+    try:
+        return int(value)
+    except ValueError:
+        print "{0} expects a number of seconds".format(option)
+        sys.exit(2)
 
-def main(argv):
+def parse_options(argv):
+    command = None
+    parse = getopt.getopt
+    if argv and argv[0] in COMMANDS:
+        # subcommands take options after their arguments too
+        command, argv, parse = argv[0], argv[1:], getopt.gnu_getopt
     try:
-        opts, args = getopt.getopt(sys.argv[1:], ':hi',
-                     ["help", "images"])
+        opts, args = parse(argv, SHORT_OPTIONS, LONG_OPTIONS)
     except getopt.GetoptError as err:
         print str(err) # will print something like "option -a not recognized"
         usage()
         sys.exit(2)
+    options = {'images': False, 'wait': False, 'timeout': None,
+               'pool_stats': False, 'owners': [], 'filters': {},
+               'stream': False, 'ttl': DEFAULT_TTL, 'refresh': False,
+               'stale': False, 'cache': True, 'cache_stats': False,
+               'queries': [], 'endpoints': None,
+               'endpoint_timeout': None, 'stats': False,
+               'stats_file': None, 'daemon': False, 'daemon_ttl': None,
+               'daemon_stop': False, 'use_daemon': True,
+               'command': command, 'db': None, 'sql': None,
+               'watch': False, 'format': 'text', 'workers': None,
+               'only': None, 'rules': [], 'key_dir': None,
+               'replace_keys': False, 'type': 'm1.small', 'label': None,
+               'batch': None, 'no_wait': False, 'fields': None, 'sort': None,
+               'limit': None, 'newest': False}
     for o, a in opts:
         if o in ("-h", "--help"):
             usage()
             sys.exit()
+        elif o in ("-i", "--images"):
+            options['images'] = True
+        elif o in ("-w", "--wait"):
+            options['wait'] = True
+        elif o == "--watch":
+            options['watch'] = True
+        elif o == "--format":
+            from output import FORMATS
+            if a not in FORMATS:
+                print "--format expects one of {0}".format(', '.join(FORMATS))
+                sys.exit(2)
+            # the event streams of --watch and launch know text and json
+            options['format'] = 'json' if a == 'jsonl' else a
+        elif o in ("--fields", "--sort"):
+            from output import parse_fields, parse_sort
+            try:
+                options[o[2:]] = (parse_fields if o == "--fields" else parse_sort)(a)
+            except ValueError as detail:
+                print detail
+                sys.exit(2)
+        elif o in QUERY_OPTIONS:
+            if QUERY_OPTIONS[o] not in options['queries']:
+                options['queries'].append(QUERY_OPTIONS[o])
+        elif o == "--only":
+            if a not in ("keypairs", "secgroups"):
+                print "--only expects keypairs or secgroups"
+                sys.exit(2)
+            options['only'] = a
+        elif o == "--rule":
+            from secgroups import parse_rule
+            try:
+                options['rules'].append(parse_rule(a))
+            except ValueError as detail:
+                print detail
+                sys.exit(2)
+        elif o == "--key-dir":
+            options['key_dir'] = a
+        elif o == "--replace-keys":
+            options['replace_keys'] = True
+        elif o in ("--workers", "--batch", "--limit"):
+            if not a.isdigit() or int(a) < 1:
+                print "{0} expects a positive number".format(o)
+                sys.exit(2)
+            options[o[2:]] = int(a)
+        elif o in ("--type", "--label"):
+            options[o[2:]] = a
+        elif o == "--no-wait":
+            options['no_wait'] = True
+        elif o == "--newest":
+            options['newest'] = True
+        elif o in ("--timeout", "--ttl", "--endpoint-timeout", "--daemon-ttl"):
+            options[o[2:].replace('-', '_')] = _seconds(o, a)
+        elif o == "--pool-stats":
+            options['pool_stats'] = True
+        elif o == "--stats":
+            options['stats'] = True
+        elif o == "--stats-file":
+            options['stats_file'] = a
+        elif o in ("--daemon", "--daemon-stop"):
+            options[o[2:].replace('-', '_')] = True
+        elif o == "--no-daemon":
+            options['use_daemon'] = False
+        elif o in ("--db", "--sql"):
+            options[o[2:]] = a
+        elif o == "--zone":
+            options['filters']['availability-zone'] = a
+        elif o == "--tag":
+            if '=' in a:
+                key, value = a.split('=', 1)
+                options['filters']['tag:' + key] = value
+            else:
+                options['filters']['tag-key'] = a
+        elif o == "--endpoints":
+            options['endpoints'] = a
+        elif o == "--refresh":
+            options['refresh'] = True
+        elif o == "--stale":
+            options['stale'] = True
+        elif o == "--no-cache":
+            options['cache'] = False
+        elif o == "--cache-stats":
+            options['cache_stats'] = True
+        elif o == "--owner":
+            options['owners'].append(a)
+        elif o in ("--name", "--state"):
+            options['filters'][o[2:]] = a
+        elif o == "--is-public":
+            if a.lower() not in ("true", "false"):
+                print "--is-public expects true or false"
+                sys.exit(2)
+            options['filters']['is-public'] = a.lower()
+        elif o == "--stream":
+            options['stream'] = True
+    return options, args
+
+def connect_or_exit():
+    try:
+        return create_ec2_connection(REGION_LABEL)
+    except Exception as detail:
+        print "Problem creating ec2 connection:", detail
+        sys.exit(2)
+
+def run_wait(options, args):
+    if not args:
+        print "--wait expects instance ids"
+        sys.exit(2)
+    conn = connect_or_exit()
+    timeout = 600 if options['timeout'] is None else options['timeout']
+    result = wait_instances(conn, args, timeout)
+    return 0 if result.ok else 1
+
+# image style filters -> DescribeInstances filters
+INSTANCE_FILTERS = {'name': 'tag:Name', 'state': 'instance-state-name'}
+
+def event_format(options):
+    """--format of the event streams, which print text or json lines."""
+    if options['format'] not in ('text', 'json'):
+        print "--format expects text or json here"
+        sys.exit(2)
+    return options['format']
+
+def run_watch(options, instance_ids):
+    from watch import InstanceWatcher, write_events
+    format = event_format(options)
+    filters = dict((INSTANCE_FILTERS.get(k, k), v)
+                   for k, v in options['filters'].items())
+    if instance_ids and filters:
+        print "--watch takes instance ids or filters, not both"
+        return 2
+    conn = connect_or_exit()
+    watcher = InstanceWatcher(conn, instance_ids, filters)
+    try:
+        write_events(watcher.events(options['timeout']), format)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+def run_images(options, image_ids):
+    from output import options_output
+    from cache import IMAGE_FIELDS as IMAGE_RECORD_FIELDS
+    output = options_output(options)
+    try:
+        cached = output.needed(IMAGE_RECORD_FIELDS, IMAGE_FIELDS)
+    except ValueError:
+        # fields the cached catalog does not keep are read from the service
+        cached = None
+    if options['stream'] or options['owners'] or options['filters'] or image_ids \
+            or cached is None:
+        # a filtered listing is cheap to fetch and is never cached
+        try:
+            stream_ami_ids(connect_or_exit(), image_ids, options['owners'],
+                           options['filters'], output)
+        except ValueError as detail:
+            print detail
+            return 2
+        return 0
+    cache = None
+    if options['cache']:
         try:
-            conn = create_ec2_connection('NeCTAR')
+            cache = create_image_cache(REGION_LABEL, options['ttl'])
         except Exception as detail:
             print "Problem creating ec2 connection:", detail
             sys.exit(2)
-        if o in ("-i", "--images"):
-            list_ami_ids(conn)
-        conn.close()
+    list_ami_ids(connect_or_exit, cache, options['refresh'], options['stale'],
+                 output)
+    sys.stdout.flush()
+    if cache is not None:
+        # the table is already out, finish the background refresh
+        # before the connection goes away
+        cache.wait_refresh()
+        if options['cache_stats']:
+            print >> sys.stderr, cache.report()
+    return 0
+
+# fields of find-image unless --fields says otherwise
+FOUND_IMAGE_FIELDS = ['id', 'name', 'creation_date']
+
+def run_find_image(options, args):
+    from nameindex import image_index, INDEX_FIELDS
+    from output import options_output, column_widths
+    if len(args) != 1:
+        print "find-image expects one name pattern"
+        return 2
+    pattern = args[0].decode('utf-8')
+    try:
+        cache = create_image_cache(REGION_LABEL, options['ttl'])
+    except Exception as detail:
+        print "Problem creating ec2 connection:", detail
+        return 2
+    def fetch():
+        from cache import fetch_image_records
+        return fetch_image_records(connect_or_exit())
+    index = image_index(cache, fetch, options['refresh'])
+    filters = options['filters']
+    tags = {}
+    for key, value in filters.items():
+        if key.startswith('tag:'):
+            tags[key[4:]] = value
+        elif key == 'tag-key':
+            tags[value] = None
+    query = (pattern, filters.get('state'), options['owners'], tags)
+    if options['newest']:
+        newest = index.newest(*query)
+        rows = [newest] if newest is not None else []
+    else:
+        rows = index.find(*query)
+    if not rows:
+        similar = index.similar(pattern)
+        print >> sys.stderr, "no image matches {0}{1}".format(
+            pattern.encode('utf-8'), '; similar names: ' + ', '.join(
+                n.encode('utf-8') for n in similar) if similar else '')
+        return 1
+    with metrics.phase(metrics.active, 'render'):
+        try:
+            # the matches are all at hand: size the columns to them
+            options_output(options).write(INDEX_FIELDS, rows, FOUND_IMAGE_FIELDS,
+                                          widths=column_widths(INDEX_FIELDS, rows))
+        except ValueError as detail:
+            print detail
+            return 2
+    return 0
+
+def run_fan_out(options, queries):
+    from fanout import load_endpoints, DEFAULT_TIMEOUT
+    from output import options_output
+    names = options['endpoints']
+    try:
+        if names is None:
+            check_env_variables()
+            endpoints = load_endpoints(names=['default'])
+        elif names == 'all':
+            endpoints = load_endpoints()
+        else:
+            endpoints = load_endpoints(names=[n for n in names.split(',') if n])
+    except Exception as detail:
+        print "Problem reading endpoints:", detail
+        return 2
+    status = 0
+    for query in queries:
+        try:
+            result = list_fan_out(endpoints, query,
+                                  options['endpoint_timeout'] or DEFAULT_TIMEOUT,
+                                  options_output(options))
+        except ValueError as detail:
+            print detail
+            return 2
+        if result.errors or result.timed_out:
+            status = 1
+    return status
+
+def inventory_path(options):
+    from inventory import default_path
+    if options['db']:
+        return options['db']
+    check_env_variables()
+    return default_path(REGION_LABEL, os.environ.get('EC2_ACCESS_KEY'),
+                        os.environ.get('EC2_URL'))
+
+def run_snapshot(options, resource_types):
+    from inventory import Inventory, snapshot, resource_type
+    from fanout import env_endpoint
+    try:
+        resource_types = [resource_type(t) for t in resource_types]
+        path = inventory_path(options)
+        endpoint = env_endpoint(label=REGION_LABEL)
+        inventory = Inventory(path)
+    except Exception as detail:
+        print "Problem opening the inventory:", detail
+        return 2
+    def report(name, counts, elapsed):
+        if isinstance(counts, Exception):
+            print >> sys.stderr, "{0}: {1}".format(name, counts)
+        else:
+            print ("{0}: {total} rows, {added} added, {changed} changed, "
+                   "{removed} removed ({1:.2f}s)").format(name, elapsed, **counts)
+        sys.stdout.flush()
+    try:
+        results = snapshot(inventory, endpoint, resource_types, on_sync=report)
+    finally:
+        inventory.close()
+    if [r for r in results.values() if isinstance(r, Exception)]:
+        return 1
+    return 0
+
+def run_query(options, args):
+    from inventory import Inventory, resource_type
+    from output import Output, options_output
+    filters = options['filters']
+    output = options_output(options)
+    try:
+        path = inventory_path(options)
+        if not os.path.exists(path):
+            print "No snapshot in {0}, run ec2utils.py snapshot first".format(path)
+            return 2
+        inventory = Inventory(path)
+        try:
+            if options['sql']:
+                headers, rows = inventory.sql(options['sql'])
+            elif not args:
+                headers, rows = inventory.syncs()
+                rows = [[r[0], time.strftime('%Y-%m-%d %H:%M:%S',
+                         time.localtime(r[1]))] + list(r[2:]) for r in rows]
+            else:
+                tags = {}
+                for key, value in filters.items():
+                    if key.startswith('tag:'):
+                        tags[key[4:]] = value
+                    elif key == 'tag-key':
+                        tags[value] = None
+                headers, rows = inventory.query(
+                    resource_type(args[0]), args[1:], filters.get('name'),
+                    filters.get('state'), filters.get('availability-zone'), tags,
+                    output.sort, output.limit)
+                # sorted and limited by SQLite already
+                output = Output(output.format, output.fields)
+        finally:
+            inventory.close()
+    except Exception as detail:
+        print "Problem querying the inventory:", detail
+        return 2
+    with metrics.phase(metrics.active, 'render'):
+        try:
+            output.write(headers, rows, default='table')
+        except ValueError as detail:
+            print detail
+            return 2
+    return 0
+
+def read_labels(args):
+    """Labels given as arguments, '-' reading them from stdin."""
+    labels = []
+    seen = set()
+    for arg in args:
+        names = [line.strip() for line in sys.stdin] if arg == '-' else [arg]
+        for name in names:
+            if name and name not in seen:
+                seen.add(name)
+                labels.append(name)
+    return labels
+
+def run_bulk(options, args):
+    import bulk
+    from output import options_output
+    from fanout import env_endpoint
+    labels = read_labels(args)
+    if not labels:
+        print "{0} expects labels".format(options['command'])
+        return 2
+    try:
+        check_env_variables()
+    except Exception as detail:
+        print "Problem creating ec2 connection:", detail
+        return 2
+    endpoint = env_endpoint(label=REGION_LABEL)
+    keypairs = options['only'] in (None, 'keypairs')
+    secgroups = options['only'] in (None, 'secgroups')
+    workers = options['workers'] or bulk.DEFAULT_WORKERS
+    if options['command'] == 'provision':
+        fingerprints = None
+        if options['key_dir']:
+            fingerprints = bulk.saved_fingerprints(options['key_dir'], labels)
+        report = bulk.provision(endpoint, labels, keypairs, secgroups,
+                                options['rules'] or None, fingerprints,
+                                options['replace_keys'], options['key_dir'],
+                                workers)
+    else:
+        report = bulk.teardown(endpoint, labels, keypairs, secgroups, workers)
+    resources = [r for r, wanted in ((bulk.KEYPAIR, keypairs),
+                                     (bulk.SECGROUP, secgroups)) if wanted]
+    with metrics.phase(metrics.active, 'render'):
+        try:
+            options_output(options).write(['label'] + resources + ['errors'],
+                                          report.to_dicts(), default='table')
+        except ValueError as detail:
+            print detail
+    print >> sys.stderr, report.summary()
+    return 1 if report.failed else 0
+
+def run_launch(options, args):
+    import json
+    import launch
+    from bulk import error_text
+    from fanout import env_endpoint
+    format = event_format(options)
+    if len(args) != 2 or not args[1].isdigit():
+        print "launch expects an image id and a number of instances"
+        return 2
+    image_id, count = args[0], int(args[1])
+    try:
+        check_env_variables()
+    except Exception as detail:
+        print "Problem creating ec2 connection:", detail
+        return 2
+    zones = [z for z in options['filters'].get('availability-zone', '').split(',') if z]
+    start = time.time()
+    seen = []
+    def report(instance):
+        seen.append(instance.id)
+        if format == 'json':
+            print json.dumps({'id': instance.id, 'state': instance.state,
+                              'zone': instance.placement,
+                              'private_ip': instance.private_ip_address,
+                              'elapsed': round(time.time() - start, 3)},
+                             sort_keys=True)
+        else:
+            print "{0:8.1f}s {1} {2} {3} {4} ({5}/{6})".format(
+                time.time() - start, instance.id, instance.state,
+                instance.placement, instance.private_ip_address or '',
+                len(seen), count)
+        sys.stdout.flush()
+    try:
+        result = launch.launch_fleet(
+            env_endpoint(label=REGION_LABEL), image_id, count, options['type'],
+            zones=zones or None, batch_size=options['batch'] or launch.DEFAULT_BATCH,
+            max_workers=options['workers'] or launch.DEFAULT_WORKERS,
+            wait=not options['no_wait'],
+            timeout=600 if options['timeout'] is None else options['timeout'],
+            on_ready=report, on_failed=report, label=options['label'],
+            key_dir=options['key_dir'])
+    except ValueError as detail:
+        print detail
+        return 2
+    if options['no_wait']:
+        for instance_id in result.instances:
+            print instance_id
+    zones = ', '.join('{0}={1}'.format(z, n) for z, n in sorted(result.zones.items()))
+    print >> sys.stderr, "{0}/{1} launched ({2}), {3} running, {4} failed, " \
+        "{5} timed out, {6} unknown in {7:.1f}s".format(
+            result.launched, count, zones or '-', len(result.running),
+            len(result.failed), len(result.timed_out), len(result.unknown),
+            result.elapsed)
+    for error in result.errors:
+        print >> sys.stderr, "launch error:", error_text(error)
+    if options['no_wait']:
+        return 0 if result.launched == count else 1
+    return 0 if result.ok else 1
+
+def run(options, args):
+    """Run the command described by parse_options, return its exit status."""
+    registry = None
+    if options['stats'] or options['stats_file']:
+        registry = metrics.enable()
+    status = 0
+    try:
+        if options['command'] == 'snapshot':
+            status = run_snapshot(options, args)
+        elif options['command'] == 'query':
+            status = run_query(options, args)
+        elif options['command'] in ('provision', 'teardown'):
+            status = run_bulk(options, args)
+        elif options['command'] == 'launch':
+            status = run_launch(options, args)
+        elif options['command'] == 'find-image':
+            status = run_find_image(options, args)
+        elif options['wait']:
+            status = run_wait(options, args)
+        elif options['watch']:
+            status = run_watch(options, args)
+        elif options['endpoints'] is not None or options['queries']:
+            queries = list(options['queries'])
+            if options['images']:
+                queries.insert(0, 'images')
+            status = run_fan_out(options, queries)
+        elif options['images']:
+            status = run_images(options, args)
+    finally:
+        # connections are closed by ec2.connections at exit
+        if options['pool_stats']:
+            import ec2
+            print >> sys.stderr, ec2.connections.report()
+        if options['stats']:
+            print >> sys.stderr, registry.summary()
+        if options['stats_file']:
+            registry.write_textfile(options['stats_file'],
+                'json' if options['stats_file'].endswith('.json') else 'prometheus')
+    return status
+
+def _daemon_cacheable(argv):
+    try:
+        opts, args = getopt.getopt(argv, SHORT_OPTIONS, LONG_OPTIONS)
+    except getopt.GetoptError:
+        return False
+    return bool(opts) and not args and \
+        all(o in DAEMON_CACHEABLE_OPTIONS for o, a in opts)
+
+def _daemon_handler(argv):
+    options, args = parse_options(argv)
+    return run(options, args)
+
+def run_daemon(options):
+    import daemon
+    try:
+        check_env_variables()
+    except Exception as detail:
+        print "Problem starting the daemon:", detail
+        return 2
+    ttl = options['daemon_ttl']
+    server = daemon.Daemon(_daemon_handler, cacheable=_daemon_cacheable,
+                           result_ttl=daemon.DEFAULT_RESULT_TTL if ttl is None else ttl)
+    print >> sys.stderr, "ec2utils daemon listening on", server.path
+    try:
+        server.serve_forever()
+    except Exception as detail:
+        print "Problem running the daemon:", detail
+        return 2
+    return 0
+
+def _runs_here(options, args):
+    # the daemon has its own stdin and working directory
+    return options['command'] in LOCAL_COMMANDS or '-' in args or \
+        options['db'] is not None or options['wait'] or options['watch'] or \
+        options['stats'] or options['stats_file'] is not None
+
+def run_on_daemon(argv):
+    """Exit status of argv run by the daemon, None when none can run it."""
+    import daemon
+    try:
+        status, out, err = daemon.request(argv)
+    except daemon.DaemonUnavailable:
+        return None
+    sys.stdout.write(out.encode('utf-8'))
+    sys.stderr.write(err.encode('utf-8'))
+    return status
+
+def main(argv=None):
+    """Entry point of the ec2utils console script."""
+    if argv is None:
+        argv = sys.argv[1:]
+    options, args = parse_options(argv)
+    if options['daemon']:
+        status = run_daemon(options)
+    elif options['daemon_stop']:
+        import daemon
+        status = 0 if daemon.stop() else 1
+    else:
+        status = None
+        # --wait and --watch print as they go, --stats reports this process
+        if options['use_daemon'] and not _runs_here(options, args):
+            status = run_on_daemon(argv)
+        if status is None:
+            status = run(options, args)
+    if status:
+        sys.exit(status)
+
 if __name__ == '__main__':
-    main(sys.argv[1:])             
+    main(sys.argv[1:])
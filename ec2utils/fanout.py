@@ -0,0 +1,206 @@
+#
+# ec2 utilities - concurrent queries over several endpoints
+#
+
+import os
+import time
+import threading
+import ConfigParser
+
+import ec2
+from records import iter_images, iter_instances
+
+DEFAULT_LABEL = 'NeCTAR'
+DEFAULT_TIMEOUT = 30
+DEFAULT_ENDPOINTS_FILE = os.path.join(os.path.expanduser('~'), '.ec2utils',
+                                      'endpoints.ini')
+
+
+class Endpoint(object):
+    """Connection settings of one endpoint (cell, region or account)."""
+
+    def __init__(self, name, url, access_key, secret_key, label=DEFAULT_LABEL,
+                 validation=False):
+        self.name = name
+        self.url = url
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.label = label
+        self.validation = validation
+
+    def connect(self):
+        return ec2.get_connection(self.label, self.access_key, self.secret_key,
+                                  self.url, self.validation)
+
+    def checkout(self):
+        """Borrow a connection from ec2.connections, see checkin."""
+        return ec2.connections.checkout(self.label, self.access_key,
+                                        self.secret_key, self.url,
+                                        self.validation)
+
+    def checkin(self, conn):
+        ec2.connections.checkin(conn)
+
+    def __repr__(self):
+        return 'Endpoint(%s, %s)' % (self.name, self.url)
+
+
+def env_endpoint(name='default', label=DEFAULT_LABEL):
+    """Endpoint described by the variables set by ec2rc.sh, None if unset."""
+    url = os.environ.get('EC2_URL')
+    key = os.environ.get('EC2_ACCESS_KEY')
+    secret = os.environ.get('EC2_SECRET_KEY')
+    if url is None or key is None or secret is None:
+        return None
+    return Endpoint(name, url, key, secret, label)
+
+
+def load_endpoints(path=None, names=None):
+    """Read endpoint profiles.
+
+    The file (EC2UTILS_ENDPOINTS or ~/.ec2utils/endpoints.ini) has one
+    section per endpoint:
+
+        [melbourne]
+        url = https://cloud.example.org:8773/services/Cloud
+        access_key = ...
+        secret_key = ...
+        label = NeCTAR
+        validation = false
+
+    The environment from ec2rc.sh is available as the profile 'default'
+    unless the file defines one.
+
+    @type   path: String
+    @param  path: profile file
+
+    @type   names: List
+    @param  names: profiles to return, all of them when None
+
+    @rtype List
+    @return endpoints, in file order or in the order of names
+    """
+    path = path or os.environ.get('EC2UTILS_ENDPOINTS') or DEFAULT_ENDPOINTS_FILE
+    parser = ConfigParser.RawConfigParser()
+    parser.read([path])
+    endpoints = []
+    for section in parser.sections():
+        get = lambda option, default=None: parser.get(section, option) \
+            if parser.has_option(section, option) else default
+        if get('url') is None or get('access_key') is None or get('secret_key') is None:
+            raise ValueError('endpoint {0} in {1} needs url, access_key and '
+                             'secret_key'.format(section, path))
+        endpoints.append(Endpoint(section, get('url'), get('access_key'),
+                                  get('secret_key'), get('label', DEFAULT_LABEL),
+                                  get('validation', 'false').lower() == 'true'))
+    if 'default' not in [e.name for e in endpoints]:
+        default = env_endpoint()
+        if default is not None:
+            endpoints.insert(0, default)
+    if names is None:
+        return endpoints
+    by_name = dict((e.name, e) for e in endpoints)
+    missing = [n for n in names if n not in by_name]
+    if missing:
+        raise ValueError('unknown endpoint(s): {0}'.format(', '.join(missing)))
+    return [by_name[n] for n in names]
+
+
+# query name -> (table headers, function(connection) returning rows)
+QUERIES = {
+    'images': (['ID', 'Name'],
+               lambda conn: [[i.id, i.name] for i in iter_images(conn)]),
+    'azs': (['Zone', 'State'],
+            lambda conn: [[z.name, z.state] for z in ec2.get_azs(conn)]),
+    'secgroups': (['ID', 'Name', 'Description'],
+                  lambda conn: [[g.id, g.name, g.description]
+                                for g in conn.get_all_security_groups()]),
+    'keypairs': (['Name', 'Fingerprint'],
+                 lambda conn: [[k.name, k.fingerprint]
+                               for k in conn.get_all_key_pairs()]),
+    'instances': (['ID', 'State', 'Image', 'Zone', 'Private IP'],
+                  lambda conn: [list(i) for i in iter_instances(
+                      conn, fields=('id', 'state', 'image_id', 'zone', 'private_ip'),
+                      page_size=1000)]),
+}
+
+
+class FanOutResult(object):
+    """Rows from every endpoint that answered in time.
+
+    rows start with the endpoint name, errors maps endpoint names to the
+    exception they raised, timed_out lists the endpoints that did not
+    answer in time and elapsed maps endpoint names to their latency.
+    """
+
+    def __init__(self, headers):
+        self.headers = ['Source'] + headers
+        self.rows = []
+        self.errors = {}
+        self.timed_out = []
+        self.elapsed = {}
+
+
+def fan_out(endpoints, query, timeout=DEFAULT_TIMEOUT):
+    """Run a query against several endpoints at once.
+
+    Every endpoint gets its own thread and a connection borrowed from
+    ec2.connections, so repeated fan-outs in one process (e.g. the daemon)
+    reuse warm connections. Endpoints that have not answered within timeout
+    seconds are reported as timed out and their threads are abandoned, so
+    one slow endpoint delays the answer by at most timeout seconds.
+
+    @type   endpoints: List
+    @param  endpoints: Endpoint objects
+
+    @type   query: String or Tuple
+    @param  query: a QUERIES name, or (headers, function(connection))
+
+    @type   timeout: float
+    @param  timeout: seconds to wait for the endpoints
+
+    @rtype FanOutResult
+    @return merged rows tagged with their endpoint
+    """
+    headers, run = QUERIES[query] if isinstance(query, basestring) else query
+    outcomes = {}
+    lock = threading.Lock()
+
+    def work(endpoint):
+        start = time.time()
+        conn = None
+        try:
+            conn = endpoint.checkout()
+            outcome = (True, run(conn))
+        except Exception as e:
+            outcome = (False, e)
+        finally:
+            if conn is not None:
+                endpoint.checkin(conn)
+        with lock:
+            outcomes[endpoint.name] = outcome + (time.time() - start,)
+
+    threads = []
+    for endpoint in endpoints:
+        thread = threading.Thread(target=work, args=(endpoint,))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    deadline = time.time() + timeout
+    for thread in threads:
+        thread.join(max(0, deadline - time.time()))
+
+    result = FanOutResult(headers)
+    with lock:
+        for endpoint in endpoints:
+            outcome = outcomes.get(endpoint.name)
+            if outcome is None:
+                result.timed_out.append(endpoint.name)
+                continue
+            success, value, elapsed = outcome
+            result.elapsed[endpoint.name] = elapsed
+            if success:
+                result.rows.extend([endpoint.name] + row for row in value)
+            else:
+                result.errors[endpoint.name] = value
+    return result
@@ -0,0 +1,378 @@
+#
+# ec2 utilities - account inventory snapshots in a local SQLite database
+#
+
+import os
+import json
+import time
+import Queue
+import hashlib
+import sqlite3
+import threading
+
+from cache import cache_key, DEFAULT_CACHE_DIR, IMAGE_FIELDS
+from records import iter_images, iter_instances
+
+SCHEMA_VERSION = 1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    id TEXT PRIMARY KEY, name TEXT, state TEXT, owner_id TEXT,
+    is_public INTEGER, architecture TEXT, creation_date TEXT,
+    fingerprint TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS images_name ON images (name);
+CREATE INDEX IF NOT EXISTS images_state ON images (state);
+
+CREATE TABLE IF NOT EXISTS instances (
+    id TEXT PRIMARY KEY, name TEXT, state TEXT, zone TEXT, image_id TEXT,
+    instance_type TEXT, key_name TEXT, private_ip TEXT, public_ip TEXT,
+    launch_time TEXT, fingerprint TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS instances_name ON instances (name);
+CREATE INDEX IF NOT EXISTS instances_state ON instances (state);
+CREATE INDEX IF NOT EXISTS instances_zone ON instances (zone);
+CREATE INDEX IF NOT EXISTS instances_image ON instances (image_id);
+
+CREATE TABLE IF NOT EXISTS instance_groups (
+    instance_id TEXT NOT NULL, group_id TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS instance_groups_instance ON instance_groups (instance_id);
+CREATE INDEX IF NOT EXISTS instance_groups_group ON instance_groups (group_id);
+
+CREATE TABLE IF NOT EXISTS security_groups (
+    id TEXT PRIMARY KEY, name TEXT, description TEXT, vpc_id TEXT,
+    fingerprint TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS security_groups_name ON security_groups (name);
+
+CREATE TABLE IF NOT EXISTS security_group_rules (
+    group_id TEXT NOT NULL, protocol TEXT, from_port TEXT, to_port TEXT,
+    source TEXT);
+CREATE INDEX IF NOT EXISTS security_group_rules_group ON security_group_rules (group_id);
+
+CREATE TABLE IF NOT EXISTS keypairs (
+    id TEXT PRIMARY KEY, name TEXT, key_fingerprint TEXT,
+    fingerprint TEXT NOT NULL);
+
+CREATE TABLE IF NOT EXISTS zones (
+    id TEXT PRIMARY KEY, name TEXT, state TEXT, zone TEXT,
+    fingerprint TEXT NOT NULL);
+
+CREATE TABLE IF NOT EXISTS tags (
+    resource_type TEXT NOT NULL, resource_id TEXT NOT NULL, key TEXT NOT NULL,
+    value TEXT);
+CREATE INDEX IF NOT EXISTS tags_resource ON tags (resource_type, resource_id);
+CREATE INDEX IF NOT EXISTS tags_key_value ON tags (key, value);
+
+CREATE TABLE IF NOT EXISTS syncs (
+    resource_type TEXT PRIMARY KEY, synced_at REAL, total INTEGER,
+    added INTEGER, changed INTEGER, removed INTEGER, elapsed REAL);
+"""
+
+
+# resource type -> (table columns after id, child table, child columns)
+TABLES = {
+    'images': (['name', 'state', 'owner_id', 'is_public', 'architecture',
+                'creation_date'], None, None),
+    'instances': (['name', 'state', 'zone', 'image_id', 'instance_type',
+                   'key_name', 'private_ip', 'public_ip', 'launch_time'],
+                  'instance_groups', ['instance_id', 'group_id']),
+    'security_groups': (['name', 'description', 'vpc_id'],
+                        'security_group_rules',
+                        ['group_id', 'protocol', 'from_port', 'to_port', 'source']),
+    'keypairs': (['name', 'key_fingerprint'], None, None),
+    'zones': (['name', 'state', 'zone'], None, None),
+}
+RESOURCE_TYPES = ['images', 'instances', 'security_groups', 'keypairs', 'zones']
+# names used by the listing options
+ALIASES = {'secgroups': 'security_groups', 'azs': 'zones'}
+
+
+def resource_type(name):
+    """Table name of a resource type or of one of its ALIASES."""
+    name = ALIASES.get(name, name)
+    if name not in TABLES:
+        raise ValueError('unknown resource type {0}, expected one of '
+                         '{1}'.format(name, ', '.join(RESOURCE_TYPES)))
+    return name
+
+
+# Fetchers return records: (row dict with 'id', tags dict, child rows).
+# boto is only needed by them, so offline queries do not import it.
+
+INSTANCE_FIELDS = ('id', 'state', 'zone', 'image_id', 'type', 'key_name',
+                   'private_ip', 'public_ip', 'launch_time', 'groups', 'tags')
+INSTANCE_PAGE_SIZE = 1000
+
+def fetch_images(conn):
+    records = []
+    for image in iter_images(conn, fields=IMAGE_FIELDS):
+        row = {'id': image.id, 'name': image.name, 'state': image.state,
+               'owner_id': image.owner_id, 'is_public': int(bool(image.is_public)),
+               'architecture': image.architecture,
+               'creation_date': image.creation_date}
+        records.append((row, image.tags, []))
+    return records
+
+def fetch_instances(conn):
+    records = []
+    for i in iter_instances(conn, fields=INSTANCE_FIELDS,
+                            page_size=INSTANCE_PAGE_SIZE):
+        row = {'id': i.id, 'name': i.tags.get('Name'), 'state': i.state,
+               'zone': i.zone, 'image_id': i.image_id,
+               'instance_type': i.type, 'key_name': i.key_name,
+               'private_ip': i.private_ip, 'public_ip': i.public_ip,
+               'launch_time': i.launch_time}
+        groups = [[i.id, g] for g in i.groups]
+        records.append((row, i.tags, groups))
+    return records
+
+def fetch_security_groups(conn):
+    records = []
+    for g in conn.get_all_security_groups():
+        row = {'id': g.id, 'name': g.name, 'description': g.description,
+               'vpc_id': g.vpc_id}
+        rules = []
+        for rule in g.rules:
+            for grant in rule.grants:
+                rules.append([g.id, rule.ip_protocol, rule.from_port,
+                              rule.to_port, grant.cidr_ip or grant.group_id
+                              or grant.name])
+        records.append((row, dict(g.tags), sorted(rules)))
+    return records
+
+def fetch_keypairs(conn):
+    return [({'id': k.name, 'name': k.name, 'key_fingerprint': k.fingerprint},
+             {}, []) for k in conn.get_all_key_pairs()]
+
+def fetch_zones(conn):
+    return [({'id': z.name, 'name': z.name, 'state': z.state, 'zone': z.name},
+             {}, []) for z in conn.get_all_zones()]
+
+FETCHERS = {'images': fetch_images, 'instances': fetch_instances,
+            'security_groups': fetch_security_groups,
+            'keypairs': fetch_keypairs, 'zones': fetch_zones}
+
+
+def fingerprint(record):
+    return hashlib.sha1(json.dumps(record, sort_keys=True)).hexdigest()
+
+
+def default_path(label, access_key, ec2_url, cache_dir=None):
+    """Snapshot file of an endpoint, next to its image catalog cache."""
+    cache_dir = cache_dir or os.environ.get('EC2UTILS_CACHE_DIR') \
+        or DEFAULT_CACHE_DIR
+    return os.path.join(cache_dir, cache_key(label, access_key, ec2_url)
+                        + '.inventory.db')
+
+
+class Inventory(object):
+    """Resources of one endpoint stored in SQLite.
+
+    Every resource type has its own table, keyed by id and indexed by the
+    columns queries filter on; tags live in the tags table. Each row keeps
+    the fingerprint of the record it came from, so sync() only rewrites
+    rows that changed since the last snapshot.
+    """
+
+    def __init__(self, path):
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0700)
+        self.path = path
+        self.db = sqlite3.connect(path)
+        # readers (query) are not blocked by a running snapshot
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        version = self.db.execute('PRAGMA user_version').fetchone()[0]
+        if version not in (0, SCHEMA_VERSION):
+            raise ValueError('{0} has schema version {1}, expected {2}'.format(
+                path, version, SCHEMA_VERSION))
+        self.db.executescript(SCHEMA)
+        self.db.execute('PRAGMA user_version={0}'.format(SCHEMA_VERSION))
+        self._reader = None
+
+    def close(self):
+        if self._reader is not None:
+            self._reader.close()
+        self.db.close()
+
+    def _read(self, statement, params=()):
+        # queries run on a connection of their own that SQLite keeps from
+        # writing, whatever the statement; set again each time, in case an
+        # earlier statement was a pragma turning it off
+        if self._reader is None:
+            self._reader = sqlite3.connect(self.path)
+        self._reader.execute('PRAGMA query_only=ON')
+        return self._reader.execute(statement, params)
+
+    def sync(self, resource_type, records, elapsed=0.0):
+        """Make the table of resource_type hold exactly records.
+        @type   records: List
+        @param  records: (row dict, tags dict, child rows) as returned by
+                         the FETCHERS
+
+        @rtype Dict
+        @return counters 'total', 'added', 'changed', 'removed'
+        """
+        columns, child_table, child_columns = TABLES[resource_type]
+        columns = ['id'] + columns + ['fingerprint']
+        insert = 'INSERT OR REPLACE INTO {0} ({1}) VALUES ({2})'.format(
+            resource_type, ', '.join(columns), ', '.join('?' * len(columns)))
+        db = self.db
+        known = dict(db.execute('SELECT id, fingerprint FROM ' + resource_type))
+        counts = {'total': len(records), 'added': 0, 'changed': 0, 'removed': 0}
+        rows, tags, children, stale = [], [], [], []
+        seen = set()
+        for row, row_tags, child_rows in records:
+            resource_id = row['id']
+            seen.add(resource_id)
+            digest = fingerprint([row, row_tags, child_rows])
+            old = known.get(resource_id)
+            if old == digest:
+                continue
+            if old is None:
+                counts['added'] += 1
+            else:
+                counts['changed'] += 1
+                stale.append((resource_id,))
+            row = dict(row, fingerprint=digest)
+            rows.append([row.get(c) for c in columns])
+            tags.extend((resource_type, resource_id, k, v)
+                        for k, v in sorted(row_tags.items()))
+            children.extend(child_rows)
+        removed = [(i,) for i in known if i not in seen]
+        counts['removed'] = len(removed)
+        with db:
+            for ids in (stale, removed):
+                db.executemany('DELETE FROM tags WHERE resource_type = ? AND '
+                               'resource_id = ?',
+                               [(resource_type, i) for (i,) in ids])
+                if child_table:
+                    db.executemany('DELETE FROM {0} WHERE {1} = ?'.format(
+                        child_table, child_columns[0]), ids)
+            db.executemany('DELETE FROM {0} WHERE id = ?'.format(resource_type),
+                           removed)
+            db.executemany(insert, rows)
+            db.executemany('INSERT INTO tags VALUES (?, ?, ?, ?)', tags)
+            if child_table:
+                db.executemany('INSERT INTO {0} ({1}) VALUES ({2})'.format(
+                    child_table, ', '.join(child_columns),
+                    ', '.join('?' * len(child_columns))), children)
+            db.execute('INSERT OR REPLACE INTO syncs VALUES (?, ?, ?, ?, ?, ?, ?)',
+                       (resource_type, time.time(), counts['total'],
+                        counts['added'], counts['changed'], counts['removed'],
+                        elapsed))
+        return counts
+
+    def query(self, resource_type, ids=None, name=None, state=None, zone=None,
+              tags=None, order=None, limit=None):
+        """Rows of resource_type matching every given filter.
+
+        name is a glob pattern (* and ?), tags maps tag keys to values
+        (None matching any value). order lists (column, descending) pairs
+        to sort on before the id, limit caps the number of rows; both are
+        left to SQLite.
+
+        @rtype Tuple
+        @return (column names, rows)
+        """
+        if resource_type not in TABLES:
+            raise ValueError('unknown resource type {0}'.format(resource_type))
+        columns = ['id'] + TABLES[resource_type][0]
+        where, params = [], []
+        if ids:
+            where.append('id IN ({0})'.format(', '.join('?' * len(ids))))
+            params.extend(ids)
+        for column, value in (('name', name), ('state', state), ('zone', zone)):
+            if value is None:
+                continue
+            if column not in columns:
+                raise ValueError('{0} have no {1}'.format(resource_type, column))
+            if column == 'name':
+                where.append('name GLOB ?')
+            else:
+                where.append('{0} = ?'.format(column))
+            params.append(value)
+        for key, value in sorted((tags or {}).items()):
+            clause = 'id IN (SELECT resource_id FROM tags WHERE ' \
+                     'resource_type = ? AND key = ?'
+            params.extend([resource_type, key])
+            if value is not None:
+                clause += ' AND value = ?'
+                params.append(value)
+            where.append(clause + ')')
+        statement = 'SELECT {0} FROM {1}'.format(', '.join(columns), resource_type)
+        if where:
+            statement += ' WHERE ' + ' AND '.join(where)
+        ordering = []
+        for column, descending in order or []:
+            if column not in columns:
+                raise ValueError('{0} have no {1}'.format(resource_type, column))
+            ordering.append(column + (' DESC' if descending else ''))
+        statement += ' ORDER BY ' + ', '.join(ordering + ['id'])
+        if limit is not None:
+            statement += ' LIMIT ?'
+            params.append(limit)
+        return columns, self._read(statement, params).fetchall()
+
+    def sql(self, statement, params=()):
+        """Run a SQL statement, e.g. joining several tables. SQLite refuses
+        any statement that would write (sqlite3.OperationalError).
+        @rtype Tuple
+        @return (column names, rows)
+        """
+        cursor = self._read(statement, params)
+        return [d[0] for d in cursor.description or []], cursor.fetchall()
+
+    def syncs(self):
+        """Last sync of every resource type, as (column names, rows)."""
+        return self.sql('SELECT resource_type, synced_at, total, added, changed, '
+                        'removed, elapsed FROM syncs ORDER BY resource_type')
+
+
+def snapshot(inventory, endpoint, resource_types=None, on_sync=None):
+    """Fetch resource types in parallel and sync them into inventory.
+
+    Every type is fetched on its own thread with a connection borrowed from
+    ec2.connections; the tables are written from the calling thread as the
+    answers arrive, one transaction per type.
+
+    @type   endpoint: fanout.Endpoint
+    @param  endpoint: where to fetch from
+
+    @type   on_sync: callable
+    @param  on_sync: called as on_sync(resource_type, counts, elapsed)
+
+    @rtype Dict
+    @return resource type -> counts, or the exception its fetch raised
+    """
+    import ec2
+    resource_types = resource_types or RESOURCE_TYPES
+    answers = Queue.Queue()
+
+    def work(resource_type):
+        start = time.time()
+        conn = None
+        try:
+            conn = endpoint.checkout()
+            fetch = ec2.ec2_retry(3)(FETCHERS[resource_type])
+            answer = (True, fetch(conn))
+        except Exception as e:
+            answer = (False, e)
+        finally:
+            if conn is not None:
+                endpoint.checkin(conn)
+        answers.put((resource_type, answer, time.time() - start))
+
+    for resource_type in resource_types:
+        thread = threading.Thread(target=work, args=(resource_type,))
+        thread.daemon = True
+        thread.start()
+
+    results = {}
+    for i in range(len(resource_types)):
+        resource_type, (success, value), elapsed = answers.get()
+        if success:
+            value = inventory.sync(resource_type, value, elapsed)
+        results[resource_type] = value
+        if on_sync is not None:
+            on_sync(resource_type, value, elapsed)
+    return results
@@ -0,0 +1,380 @@
+#
+# ec2 utilities - concurrent fleet launch with readiness tracking
+#
+
+import time
+import uuid
+import threading
+from boto.exception import BotoServerError
+
+from waiter import AdaptiveInterval, describe_instances, TERMINAL_STATES, BATCH_SIZE
+
+# instances per RunInstances call
+DEFAULT_BATCH = 50
+DEFAULT_WORKERS = 8
+# errors meaning "not in this zone", worth trying another zone for
+CAPACITY_CODES = ('InsufficientInstanceCapacity', 'InsufficientCapacity',
+                  'InsufficientHostCapacity', 'Unsupported')
+# next_zone() once every zone ran out
+_NO_ZONE = object()
+
+
+class BatchFailed(Exception):
+    """Some instances of a batch could not be launched in any zone."""
+
+    def __init__(self, missing, error):
+        from bulk import error_text
+        Exception.__init__(self, '{0} instance(s) not launched: {1}'.format(
+            missing, error_text(error)))
+        self.missing = missing
+        self.error = error
+
+
+def plan_batches(count, zones, batch_size=DEFAULT_BATCH):
+    """Split count instances evenly across zones, in batches of at most
+    batch_size, interleaving the zones so that the first calls already
+    cover all of them.
+    @rtype List
+    @return (index, zone, instances) tuples
+    """
+    if count < 1:
+        return []
+    zones = list(zones) or [None]
+    shares = [count // len(zones) + (1 if i < count % len(zones) else 0)
+              for i in range(len(zones))]
+    per_zone = []
+    for zone, share in zip(zones, shares):
+        per_zone.append([(zone, min(batch_size, share - i))
+                         for i in range(0, share, batch_size)])
+    batches = []
+    for round_ in range(max(len(b) for b in per_zone)):
+        for zone_batches in per_zone:
+            if round_ < len(zone_batches):
+                batches.append((len(batches),) + zone_batches[round_])
+    return batches
+
+
+class LaunchResult(object):
+    """Outcome of launch_fleet.
+
+    instances lists the ids launched, zones counts them per zone, errors
+    holds a BatchFailed (or the error raised) per batch that ran out of
+    zones. running, failed and timed_out are filled in by the
+    readiness tracking, time_to_running is the time from the first call
+    to the last instance running. unknown lists the instances whose state
+    could not be read, the error of the last poll being in errors.
+    """
+
+    def __init__(self, requested):
+        self.requested = requested
+        self.instances = []
+        self.reservations = []
+        self.zones = {}
+        self.errors = []
+        self.running = []
+        self.failed = {}
+        self.timed_out = []
+        self.unknown = []
+        self.elapsed = 0.0
+        self.time_to_running = None
+
+    @property
+    def launched(self):
+        return len(self.instances)
+
+    @property
+    def ok(self):
+        return self.launched == self.requested and not self.failed \
+            and not self.timed_out and not self.unknown
+
+    def __repr__(self):
+        return ('LaunchResult(requested=%d, launched=%d, running=%d, failed=%d, '
+                'timed_out=%d, unknown=%d, elapsed=%.1fs)') % (
+                    self.requested, self.launched, len(self.running),
+                    len(self.failed), len(self.timed_out), len(self.unknown),
+                    self.elapsed)
+
+
+class ReadinessTracker(object):
+    """Poll instances on a thread of its own as they are handed over with
+    add(), reporting each one once it is running or has failed.
+
+    on_ready(instance) and on_failed(instance) are called from the
+    tracking thread.
+
+    A poll that fails is retried (see waiter.describe_instances); once the
+    retries are
+    used up the error is kept in error and polling goes on at a longer
+    interval, unless the error is one retrying cannot cure.
+    """
+
+    def __init__(self, connection, on_ready=None, on_failed=None,
+                 interval=None, batch_size=BATCH_SIZE):
+        self.connection = connection
+        self.on_ready = on_ready
+        self.on_failed = on_failed
+        self.interval = interval or AdaptiveInterval(minimum=1.0, maximum=10.0)
+        self.batch_size = batch_size
+        self.pending = []
+        self.running = []
+        self.failed = {}
+        self.last_running = None
+        self.error = None
+        self._lock = threading.Lock()
+        self._added = threading.Event()
+        self._closed = False
+        self._stopped = False
+        self._thread = None
+
+    def add(self, instance_ids):
+        with self._lock:
+            self.pending.extend(instance_ids)
+        self._added.set()
+
+    def close(self):
+        """No more instances will be added."""
+        self._closed = True
+        self._added.set()
+
+    def stop(self):
+        """Stop polling, leaving what is pending unreported."""
+        self._stopped = True
+        self._added.set()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def join(self, timeout=None):
+        """Wait for the thread, return the ids still pending."""
+        self._thread.join(timeout)
+        with self._lock:
+            return list(self.pending)
+
+    def _poll(self):
+        with self._lock:
+            ids = list(self.pending)
+        done = set()
+        changed = False
+        for instance in list(describe_instances(self.connection, ids,
+                                                self.batch_size)):
+            if instance.state == u'running':
+                self.running.append(instance.id)
+                self.last_running = time.time()
+                if self.on_ready is not None:
+                    self.on_ready(instance)
+            elif instance.state in TERMINAL_STATES:
+                self.failed[instance.id] = instance.state
+                if self.on_failed is not None:
+                    self.on_failed(instance)
+            else:
+                continue
+            done.add(instance.id)
+            changed = True
+        with self._lock:
+            self.pending = [i for i in self.pending if i not in done]
+        return changed
+
+    def _run(self):
+        while not self._stopped:
+            self._added.wait()
+            if self._stopped:
+                return
+            with self._lock:
+                idle = not self.pending
+            if idle:
+                if self._closed:
+                    return
+                self._added.clear()
+                continue
+            try:
+                changed = self._poll()
+                self.error = None
+            except Exception as e:
+                # the instances stay pending: their state is not known
+                from ec2 import classify_ec2_error
+                from decorators import PERMANENT
+                self.error = e
+                if classify_ec2_error(e) == PERMANENT:
+                    return
+                changed = False
+            with self._lock:
+                idle = not self.pending
+            if idle and self._closed:
+                return
+            delay = self.interval.next(changed)
+            # new instances do not need to wait for a slow poll
+            self._added.clear()
+            self._added.wait(delay)
+            self._added.set()
+
+
+def _launch_retry(tries):
+    # a capacity error is for this zone only: move on instead of retrying
+    from decorators import retry_policy, PERMANENT
+    from ec2 import classify_ec2_error
+    def classify(e):
+        if isinstance(e, BotoServerError) and e.error_code in CAPACITY_CODES:
+            return PERMANENT
+        return classify_ec2_error(e)
+    return retry_policy(tries, deadline=120, classify=classify)
+
+
+def prepare_label(conn, label, key_dir=None):
+    """Keypair and security group named label, created when missing with
+    ec2.create_keypair and ec2.getcreate_sec_group. The private key of a
+    new keypair is saved in key_dir as LABEL.pem; without key_dir a missing
+    keypair is a ValueError, as its private key could not be kept.
+    @rtype Tuple
+    @return (key name, [security group name])
+    """
+    import ec2
+    from bulk import _save_key, NO_KEY_DIR
+    if not ec2.keypair_exists(conn, label):
+        if not key_dir:
+            raise ValueError('keypair {0} {1}'.format(label, NO_KEY_DIR))
+        _save_key(key_dir, ec2.create_keypair(conn, label))
+    ec2.getcreate_sec_group(conn, label)
+    return label, [label]
+
+
+def launch_fleet(endpoint, image_id, count, instance_type='m1.small',
+                 key_name=None, security_groups=None, zones=None,
+                 batch_size=DEFAULT_BATCH, max_workers=DEFAULT_WORKERS,
+                 wait=True, timeout=600, on_ready=None, on_failed=None,
+                 user_data=None, label=None, key_dir=None, tries=3):
+    """Start count instances with concurrent RunInstances calls.
+
+    The instances are spread evenly over zones (every available zone by
+    default, see ec2.get_azs). A batch that meets a capacity error in its
+    zone goes on with the instances it still misses in the next zone that
+    did not run out. Every call carries a client token, so retrying one
+    never starts instances twice.
+
+    With wait the instances are tracked as soon as their batch returns:
+    on_ready(instance) is called as each one reaches running, on_failed
+    for those that will not, and launch_fleet returns once none is
+    pending or timeout seconds after the first call.
+
+    @type   endpoint: fanout.Endpoint
+    @param  endpoint: where to launch
+
+    @type   key_name: String
+    @param  key_name: keypair, see ec2.create_keypair
+
+    @type   security_groups: List
+    @param  security_groups: group names, see ec2.getcreate_sec_group
+
+    @type   label: String
+    @param  label: use (and create) the keypair and security group named
+                   label when key_name and security_groups are not given,
+                   see prepare_label
+
+    @rtype LaunchResult
+    """
+    import ec2
+    from bulk import for_each
+    start = time.time()
+    result = LaunchResult(count)
+    conn = endpoint.checkout()
+    try:
+        if label and key_name is None and security_groups is None:
+            key_name, security_groups = prepare_label(conn, label, key_dir)
+        if not zones:
+            zones = [z.name for z in ec2.get_azs(conn)
+                     if z.state in (None, u'available')]
+    finally:
+        endpoint.checkin(conn)
+    zones = list(zones)
+    full = set()
+    lock = threading.Lock()
+    tracker = None
+    if wait:
+        tracker_conn = endpoint.checkout()
+        tracker = ReadinessTracker(tracker_conn, on_ready, on_failed)
+        tracker.start()
+    retry = _launch_retry(tries)
+
+    @retry
+    def run(conn, zone, instances, token):
+        # retries are ours: boto would retry a capacity error (a 500) in
+        # the same zone. The connection is checked out, no one else uses it
+        num_retries = conn.num_retries
+        conn.num_retries = 0
+        try:
+            return conn.run_instances(
+                image_id, min_count=1, max_count=instances, key_name=key_name,
+                security_groups=security_groups, instance_type=instance_type,
+                placement=zone, user_data=user_data, client_token=token)
+        finally:
+            conn.num_retries = num_retries
+
+    def next_zone(zone):
+        # mark zone as out of capacity, pick the next one that is not
+        with lock:
+            full.add(zone)
+            candidates = [z for z in zones if z not in full]
+        if not candidates:
+            return _NO_ZONE
+        # keep spreading: start looking after the zone that failed
+        after = zones.index(zone) if zone in zones else -1
+        later = [z for z in candidates if zones.index(z) > after]
+        return (later or candidates)[0]
+
+    def launch_batch(conn, batch):
+        index, zone, missing = batch
+        if zone in full:
+            zone = next_zone(zone)
+        error = 'no capacity left'
+        while missing > 0 and zone is not _NO_ZONE:
+            try:
+                reservation = run(conn, zone, missing, str(uuid.uuid4()))
+            except BotoServerError as e:
+                if e.error_code not in CAPACITY_CODES:
+                    raise
+                error = e
+                zone = next_zone(zone)
+                continue
+            ids = [i.id for i in reservation.instances]
+            with lock:
+                result.reservations.append(reservation)
+                result.instances.extend(ids)
+                for instance in reservation.instances:
+                    placed = instance.placement or zone
+                    result.zones[placed] = result.zones.get(placed, 0) + 1
+            if tracker is not None:
+                tracker.add(ids)
+            missing -= len(ids)
+            if missing > 0:
+                # partial capacity
+                zone = next_zone(zone)
+        if missing > 0:
+            raise BatchFailed(missing, error)
+        return True
+
+    batches = plan_batches(count, zones or [None], batch_size)
+    for batch, (success, value) in sorted(
+            for_each(endpoint, batches, launch_batch, max_workers).items()):
+        if not success:
+            result.errors.append(value)
+    if tracker is not None:
+        tracker.close()
+        remaining = timeout - (time.time() - start)
+        pending = tracker.join(max(remaining, 0))
+        if pending:
+            tracker.stop()
+            tracker.join()
+        endpoint.checkin(tracker_conn)
+        if pending and tracker.error is not None:
+            # not a timeout: polling failed
+            result.unknown = pending
+            result.errors.append(tracker.error)
+        else:
+            result.timed_out = pending
+        result.running = list(tracker.running)
+        result.failed = dict(tracker.failed)
+        if tracker.last_running is not None and not tracker.pending:
+            result.time_to_running = tracker.last_running - start
+    result.elapsed = time.time() - start
+    return result
@@ -0,0 +1,232 @@
+#
+# ec2 utilities - in-memory existence index with negative caching
+#
+
+import time
+import threading
+
+# seconds an object found is taken to still exist before it is looked up
+# again on its own
+DEFAULT_TTL = 60
+DEFAULT_NEGATIVE_TTL = 30
+
+
+def _list_keypairs(conn):
+    return conn.get_all_key_pairs()
+
+def _find_keypair(conn, name):
+    return conn.get_all_key_pairs(filters={'key-name': name})
+
+def _list_security_groups(conn):
+    return conn.get_all_security_groups()
+
+def _find_security_group(conn, name):
+    key = 'group-id' if name.startswith('sg-') else 'group-name'
+    return conn.get_all_security_groups(filters={key: name})
+
+def _list_zones(conn):
+    return conn.get_all_zones()
+
+def _find_zone(conn, name):
+    return conn.get_all_zones(filters={'zone-name': name})
+
+
+class Kind(object):
+    """How to list and look up one kind of resource.
+
+    list_all(conn) returns every object, find(conn, name) the objects
+    named name (an empty list when there is none). keys(obj) gives the
+    names an object is known by.
+    """
+
+    def __init__(self, name, list_all, find, keys):
+        self.name = name
+        self.list_all = list_all
+        self.find = find
+        self.keys = keys
+
+
+KINDS = {
+    'keypairs': Kind('keypairs', _list_keypairs, _find_keypair,
+                     lambda k: [k.name]),
+    'security_groups': Kind('security_groups', _list_security_groups,
+                            _find_security_group,
+                            lambda g: [g.name, g.id] if g.id else [g.name]),
+    'zones': Kind('zones', _list_zones, _find_zone, lambda z: [z.name]),
+}
+
+
+class _Entries(object):
+    """Index of one kind: name -> (object, time found), name -> negative
+    expiry, and the calls in flight: name -> Event, None for the listing."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.objects = {}
+        self.missing = {}
+        self.loaded = None
+        self.inflight = {}
+
+
+class LookupIndex(object):
+    """Answer "does it exist" and "get it" from memory.
+
+    The first question about a kind lists all of it with one call;
+    questions after that are dictionary lookups. An object found more than
+    ttl seconds ago is looked up again, on its own, with one filtered call.
+    A name that is not in the index is looked up the same way, unless the
+    index was loaded less than negative_ttl seconds ago, and is then
+    remembered as missing for negative_ttl seconds. Not found is an
+    answer, never an error to retry.
+
+    No lock is held during a call to the service: a caller asking about a
+    name (or a kind) already being looked up waits for that call only.
+    """
+
+    def __init__(self, connection, ttl=DEFAULT_TTL,
+                 negative_ttl=DEFAULT_NEGATIVE_TTL, tries=3):
+        """
+        @type   connection: EC2 connection or callable
+        @param  connection: connection, or a callable returning the calling
+                            thread's connection (see ConnectionManager.provider)
+        """
+        from ec2 import ec2_retry
+        self.connection = connection
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._retry = ec2_retry(tries, deadline=60)
+        self._kinds = dict((name, _Entries()) for name in KINDS)
+        self.stats = {'hits': 0, 'negative_hits': 0, 'loads': 0, 'lookups': 0}
+
+    def _conn(self):
+        if callable(self.connection):
+            return self.connection()
+        return self.connection
+
+    def _call(self, function, *args):
+        return self._retry(function)(self._conn(), *args)
+
+    def _load(self, spec, entries):
+        listed = self._call(spec.list_all)
+        now = time.time()
+        objects = {}
+        for obj in listed:
+            for key in spec.keys(obj):
+                objects[key] = (obj, now)
+        with entries.lock:
+            entries.objects = objects
+            entries.missing = {}
+            entries.loaded = now
+            self.stats['loads'] += 1
+
+    def _lookup(self, spec, entries, name):
+        matches = [obj for obj in self._call(spec.find, name)
+                   if name in spec.keys(obj)]
+        now = time.time()
+        with entries.lock:
+            self.stats['lookups'] += 1
+            if not matches:
+                self._drop(spec, entries, name, now)
+                return None
+            self._store(spec, entries, matches[0], now)
+            return matches[0]
+
+    def get(self, kind, name):
+        """Object of kind (a KINDS name) known as name, None if none is.
+        @rtype boto object
+        """
+        spec = KINDS[kind]
+        entries = self._kinds[kind]
+        while True:
+            with entries.lock:
+                now = time.time()
+                key = None if entries.loaded is None else name
+                if key is not None:
+                    found = entries.objects.get(name)
+                    if found is not None and now - found[1] <= self.ttl:
+                        self.stats['hits'] += 1
+                        return found[0]
+                    if found is None and entries.missing.get(name, 0) > now:
+                        self.stats['negative_hits'] += 1
+                        return None
+                    if found is None and now - entries.loaded < self.negative_ttl:
+                        # the listing is recent enough to be the answer
+                        entries.missing[name] = now + self.negative_ttl
+                        self.stats['negative_hits'] += 1
+                        return None
+                waiting = entries.inflight.get(key)
+                if waiting is None:
+                    done = entries.inflight[key] = threading.Event()
+            if waiting is not None:
+                # someone else is asking the service: wait for its answer
+                waiting.wait()
+                continue
+            try:
+                if key is not None:
+                    return self._lookup(spec, entries, name)
+                self._load(spec, entries)
+            finally:
+                with entries.lock:
+                    del entries.inflight[key]
+                done.set()
+
+    def _store(self, spec, entries, obj, now):
+        for key in spec.keys(obj):
+            entries.objects[key] = (obj, now)
+            entries.missing.pop(key, None)
+
+    def _drop(self, spec, entries, name, now):
+        found = entries.objects.get(name)
+        for key in (spec.keys(found[0]) if found is not None else [name]):
+            entries.objects.pop(key, None)
+            entries.missing[key] = now + self.negative_ttl
+
+    def exists(self, kind, name):
+        return self.get(kind, name) is not None
+
+    def add(self, kind, obj):
+        """Record obj, e.g. just created, without asking the service."""
+        entries = self._kinds[kind]
+        with entries.lock:
+            self._store(KINDS[kind], entries, obj, time.time())
+
+    def discard(self, kind, name):
+        """Record that name, e.g. just deleted, no longer exists."""
+        entries = self._kinds[kind]
+        with entries.lock:
+            self._drop(KINDS[kind], entries, name, time.time())
+
+    def invalidate(self, kind=None):
+        """Forget kind, or everything; the next question reloads it."""
+        for name in ([kind] if kind else list(self._kinds)):
+            entries = self._kinds[name]
+            with entries.lock:
+                entries.objects = {}
+                entries.missing = {}
+                entries.loaded = None
+
+
+# each connection keeps its index in this attribute, see index_for. The
+# indexed objects refer to their connection, so a table keyed on
+# connections, even weakly, would keep every connection alive
+_INDEX_ATTRIBUTE = '_lookup_index'
+_indexes_lock = threading.Lock()
+
+def index_for(connection):
+    """The LookupIndex kept for a connection as long as it lives."""
+    with _indexes_lock:
+        index = getattr(connection, _INDEX_ATTRIBUTE, None)
+        if index is None:
+            index = LookupIndex(connection)
+            setattr(connection, _INDEX_ATTRIBUTE, index)
+        return index
+
+def use_index(connection, index):
+    """Keep index for connection instead of one of its own, e.g. one index
+    shared by several threads' connections (see LookupIndex)."""
+    with _indexes_lock:
+        setattr(connection, _INDEX_ATTRIBUTE, index)
+
+def known_index(connection):
+    """The index kept for connection, None when nothing asked it yet."""
+    return getattr(connection, _INDEX_ATTRIBUTE, None)
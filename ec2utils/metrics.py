@@ -0,0 +1,393 @@
+#
+# ec2 utilities - per API call instrumentation
+#
+
+import os
+import json
+import time
+import tempfile
+import threading
+
+from decorators import retry_stats
+
+# latency histogram bucket bounds, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# registry of the connections made by ec2.get_connection, see enable
+active = None
+
+
+class Histogram(object):
+    """Fixed bucket latency histogram (not thread safe on its own)."""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, fraction):
+        """Upper bound of the bucket holding the given quantile."""
+        if not self.count:
+            return 0.0
+        rank = fraction * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return self.buckets[i] if i < len(self.buckets) else float('inf')
+        return float('inf')
+
+
+class _Action(object):
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = {}            # http status -> count
+        self.latency = Histogram()  # request sent till response headers
+        self.read = 0.0             # seconds spent reading bodies
+        self.parse = 0.0            # seconds spent parsing bodies
+        self.bytes = 0
+
+
+class MetricsRegistry(object):
+    """Counters and histograms of EC2 API calls, per action.
+
+    Instrumented connections record, for every request, the time till the
+    response headers arrived (including boto's own retries), the body size
+    and read time, the time spent turning the body into objects, and the
+    HTTP status of failures, plus the time spent opening sockets (phase
+    'connect'). Other phases, e.g. rendering, are recorded with phase().
+    Helper calls, retries and backoff sleeps come from
+    decorators.retry_metrics.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.actions = {}
+        self.phases = {}
+        self.started = time.time()
+
+    def _action(self, action):
+        entry = self.actions.get(action)
+        if entry is None:
+            entry = self.actions[action] = _Action()
+        return entry
+
+    def record_request(self, action, seconds, status):
+        with self._lock:
+            entry = self._action(action)
+            entry.calls += 1
+            entry.latency.observe(seconds)
+            if status >= 400:
+                entry.errors[status] = entry.errors.get(status, 0) + 1
+
+    def record_body(self, action, nbytes, seconds):
+        with self._lock:
+            entry = self._action(action)
+            entry.bytes += nbytes
+            entry.read += seconds
+
+    def record_parse(self, action, seconds):
+        with self._lock:
+            self._action(action).parse += max(0.0, seconds)
+
+    def record_phase(self, phase, seconds):
+        with self._lock:
+            count, total = self.phases.get(phase, (0, 0.0))
+            self.phases[phase] = (count + 1, total + seconds)
+
+    def phase(self, name):
+        """Context manager timing a phase, e.g. with registry.phase('render')."""
+        return _Phase(self, name)
+
+    # --- exporters ------------------------------------------------------
+
+    def snapshot(self):
+        """Plain dict of every metric, suitable for json."""
+        with self._lock:
+            actions = {}
+            for name, entry in self.actions.items():
+                actions[name] = {
+                    'calls': entry.calls,
+                    'errors': dict((str(k), v) for k, v in entry.errors.items()),
+                    'latency_sum': entry.latency.sum,
+                    'latency_p50': entry.latency.quantile(0.5),
+                    'latency_p99': entry.latency.quantile(0.99),
+                    'latency_buckets': dict(zip(
+                        [str(b) for b in entry.latency.buckets] + ['+Inf'],
+                        entry.latency.counts)),
+                    'read_seconds': entry.read,
+                    'parse_seconds': entry.parse,
+                    'bytes': entry.bytes}
+            phases = dict((k, {'count': c, 'seconds': s})
+                          for k, (c, s) in self.phases.items())
+        return {'uptime': time.time() - self.started, 'actions': actions,
+                'phases': phases, 'retries': retry_stats()}
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=2, sort_keys=True)
+
+    def to_prometheus(self):
+        """Prometheus text exposition format."""
+        snap = self.snapshot()
+        lines = []
+        def metric(name, kind, help_text):
+            lines.append('# HELP {0} {1}'.format(name, help_text))
+            lines.append('# TYPE {0} {1}'.format(name, kind))
+        metric('ec2utils_requests_total', 'counter', 'EC2 API requests.')
+        for action, a in sorted(snap['actions'].items()):
+            lines.append('ec2utils_requests_total{{action="{0}"}} {1}'.format(action, a['calls']))
+        metric('ec2utils_request_errors_total', 'counter', 'EC2 API requests answered with an error status.')
+        for action, a in sorted(snap['actions'].items()):
+            for status, n in sorted(a['errors'].items()):
+                lines.append('ec2utils_request_errors_total{{action="{0}",status="{1}"}} {2}'.format(
+                    action, status, n))
+        metric('ec2utils_request_seconds', 'histogram', 'Time till the response headers arrived.')
+        with self._lock:
+            histograms = [(k, v.latency) for k, v in self.actions.items()]
+        for action, h in sorted(histograms):
+            cumulative = 0
+            for bound, n in zip([repr(b) for b in h.buckets] + ['+Inf'], h.counts):
+                cumulative += n
+                lines.append('ec2utils_request_seconds_bucket{{action="{0}",le="{1}"}} {2}'.format(
+                    action, bound, cumulative))
+            lines.append('ec2utils_request_seconds_sum{{action="{0}"}} {1!r}'.format(action, h.sum))
+            lines.append('ec2utils_request_seconds_count{{action="{0}"}} {1}'.format(action, h.count))
+        metric('ec2utils_response_bytes_total', 'counter', 'Response body bytes received.')
+        for action, a in sorted(snap['actions'].items()):
+            lines.append('ec2utils_response_bytes_total{{action="{0}"}} {1}'.format(action, a['bytes']))
+        metric('ec2utils_parse_seconds_total', 'counter', 'Time spent reading and parsing responses.')
+        for action, a in sorted(snap['actions'].items()):
+            lines.append('ec2utils_parse_seconds_total{{action="{0}"}} {1!r}'.format(
+                action, a['read_seconds'] + a['parse_seconds']))
+        metric('ec2utils_phase_seconds_total', 'counter', 'Time spent in other phases.')
+        for phase, p in sorted(snap['phases'].items()):
+            lines.append('ec2utils_phase_seconds_total{{phase="{0}"}} {1!r}'.format(phase, p['seconds']))
+        metric('ec2utils_helper_calls_total', 'counter', 'Calls of retry_policy decorated helpers.')
+        for function, r in sorted(snap['retries'].items()):
+            lines.append('ec2utils_helper_calls_total{{function="{0}"}} {1}'.format(function, r['calls']))
+        metric('ec2utils_helper_failures_total', 'counter', 'Helper calls that gave up.')
+        for function, r in sorted(snap['retries'].items()):
+            lines.append('ec2utils_helper_failures_total{{function="{0}"}} {1}'.format(function, r['gave_up']))
+        metric('ec2utils_retries_total', 'counter', 'Retries by retry_policy.')
+        for function, r in sorted(snap['retries'].items()):
+            lines.append('ec2utils_retries_total{{function="{0}"}} {1}'.format(function, r['retries']))
+        metric('ec2utils_retry_sleep_seconds_total', 'counter', 'Backoff sleeps by retry_policy.')
+        for function, r in sorted(snap['retries'].items()):
+            lines.append('ec2utils_retry_sleep_seconds_total{{function="{0}"}} {1!r}'.format(
+                function, r['sleep']))
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, path, fmt='prometheus'):
+        """Atomically write the metrics, e.g. for node_exporter's textfile
+        collector (fmt 'prometheus') or other tooling (fmt 'json')."""
+        data = self.to_prometheus() if fmt == 'prometheus' else self.to_json()
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+        try:
+            os.write(fd, data)
+            os.close(fd)
+            os.rename(tmp, path)
+        except:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            raise
+
+    def summary(self):
+        """Human readable summary, as printed by ec2utils --stats."""
+        snap = self.snapshot()
+        lines = ['{0:<32} {1:>6} {2:>6} {3:>10} {4:>10} {5:>10} {6:>12}'.format(
+            'action', 'calls', 'errors', 'remote s', 'p99 <= s', 'parse s', 'bytes')]
+        for action, a in sorted(snap['actions'].items()):
+            lines.append('{0:<32} {1:>6} {2:>6} {3:>10.3f} {4:>10} {5:>10.3f} {6:>12}'.format(
+                action, a['calls'], sum(a['errors'].values()), a['latency_sum'],
+                a['latency_p99'], a['read_seconds'] + a['parse_seconds'], a['bytes']))
+        for phase, p in sorted(snap['phases'].items()):
+            lines.append('phase {0:<26} {1:>6} {2:>24.3f}'.format(phase, p['count'], p['seconds']))
+        for function, r in sorted(snap['retries'].items()):
+            lines.append('helper {0:<25} {1:>6} {2:>6} {3:>10.3f}s backoff, {4} retries'.format(
+                function, r['calls'], r['gave_up'], r['sleep'], r['retries']))
+        return '\n'.join(lines)
+
+
+def enable(registry=None):
+    """Instrument connections made by ec2.get_connection from now on.
+    @type   registry: MetricsRegistry
+    @param  registry: where to record, a new registry when None
+
+    @rtype : MetricsRegistry
+    @return: the registry in use
+    """
+    global active
+    active = registry or active or MetricsRegistry()
+    return active
+
+
+class _Phase(object):
+
+    def __init__(self, registry, name):
+        self.registry = registry
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.registry.record_phase(self.name, time.time() - self.start)
+        return False
+
+
+class _NoPhase(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_no_phase = _NoPhase()
+
+
+def phase(registry, name):
+    """registry.phase(name), or a context manager doing nothing when
+    registry is None."""
+    if registry is None:
+        return _no_phase
+    return registry.phase(name)
+
+
+# seconds the calling thread spent in requests and reads (and rate
+# limiter waits) since a parse started being timed, None outside one
+_spent = threading.local()
+
+def _spend(seconds):
+    if getattr(_spent, 'seconds', None) is not None:
+        _spent.seconds += seconds
+
+def _begin_parse():
+    outer = getattr(_spent, 'seconds', None)
+    _spent.seconds = 0.0
+    return outer
+
+def _end_parse(outer):
+    seconds, _spent.seconds = _spent.seconds, outer
+    return seconds
+
+
+def timed_records(registry, action, records):
+    """Iterate over records, a generator making requests and parsing
+    their responses as it goes (see records.describe), and record as parse
+    time what it took beyond its requests and reads. The time the consumer
+    spends between records is left out."""
+    parsing = 0.0
+    try:
+        while True:
+            outer = _begin_parse()
+            start = time.time()
+            try:
+                record = next(records)
+            except StopIteration:
+                return
+            finally:
+                parsing += time.time() - start - _end_parse(outer)
+            yield record
+    finally:
+        registry.record_parse(action, parsing)
+
+
+class _CountingResponse(object):
+    """Response wrapper recording the body size and read time."""
+
+    def __init__(self, response, registry, action):
+        self._response = response
+        self._registry = registry
+        self._action = action
+
+    def read(self, *args):
+        start = time.time()
+        data = self._response.read(*args)
+        elapsed = time.time() - start
+        self._registry.record_body(self._action, len(data), elapsed)
+        _spend(elapsed)
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+
+def instrument_connection(conn, registry):
+    """Record every request made through a boto connection.
+    @type   conn: EC2 connection
+    @param  conn: EC2 connection
+
+    @type   registry: MetricsRegistry
+    @param  registry: where to record
+
+    @rtype : Ec2 Connection
+    @return: the same connection
+    """
+    if getattr(conn, '_metrics', None) is registry:
+        return conn
+    make_request = conn.make_request
+    def timed_make_request(action, params=None, path='/', verb='GET'):
+        # a rate limiter wrapped before leaves its wait out of the latency
+        limiter = getattr(conn, '_rate_limiter', None)
+        start = time.time()
+        try:
+            response = make_request(action, params, path, verb)
+        except Exception:
+            elapsed = time.time() - start
+            waited = limiter.last_wait() if limiter is not None else 0.0
+            registry.record_request(action, elapsed - waited, 599)
+            _spend(elapsed)
+            raise
+        elapsed = time.time() - start
+        waited = limiter.last_wait() if limiter is not None else 0.0
+        registry.record_request(action, elapsed - waited, response.status)
+        _spend(elapsed)
+        return _CountingResponse(response, registry, action)
+    conn.make_request = timed_make_request
+
+    # sockets are opened lazily by the first request on a new http
+    # connection; time the handshake on its own
+    new_http_connection = conn.new_http_connection
+    def timed_new_http_connection(*args, **kwargs):
+        http_conn = new_http_connection(*args, **kwargs)
+        connect = http_conn.connect
+        def timed_connect():
+            with registry.phase('connect'):
+                connect()
+        http_conn.connect = timed_connect
+        return http_conn
+    conn.new_http_connection = timed_new_http_connection
+
+    # get_list & co. make one request and parse its body: what is left of
+    # their time after the request and the read is parsing
+    def timed(method):
+        def call(action, *args, **kwargs):
+            outer = _begin_parse()
+            start = time.time()
+            try:
+                return method(action, *args, **kwargs)
+            finally:
+                elapsed = time.time() - start
+                registry.record_parse(action, elapsed - _end_parse(outer))
+        return call
+    for name in ('get_list', 'get_object', 'get_status'):
+        setattr(conn, name, timed(getattr(conn, name)))
+    conn._metrics = registry
+    return conn
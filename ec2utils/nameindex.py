@@ -0,0 +1,259 @@
+#
+# ec2 utilities - persistent image name index
+#
+
+import os
+import re
+import time
+import bisect
+import fnmatch
+import difflib
+import threading
+
+# row layout; rows sort by name, then id
+INDEX_FIELDS = ('name', 'id', 'creation_date', 'state', 'owner_id', 'tags')
+_NAME, _ID, _DATE, _STATE, _OWNER, _TAGS = range(len(INDEX_FIELDS))
+INDEX_VERSION = 1
+# above this share of changed rows an update sorts everything again
+REBUILD_RATIO = 0.125
+_WILDCARDS = re.compile(r'[*?[]')
+
+
+def index_row(record):
+    """Index row of an image record (see cache.image_record)."""
+    return [record.get('name') or u'', record['id'], record.get('creation_date'),
+            record.get('state'), record.get('owner_id'), record.get('tags') or None]
+
+
+def _successor(prefix):
+    # smallest string greater than every string starting with prefix
+    last = ord(prefix[-1])
+    if last >= 0xffff:
+        return None
+    return prefix[:-1] + unichr(last + 1)
+
+
+def _grams(text):
+    text = u'  ' + text.lower() + u' '
+    return set(text[i:i + 3] for i in range(len(text) - 2))
+
+
+class NameIndex(object):
+    """Image names, ids, creation dates, states, owners and tags in arrays
+    sorted by name.
+
+    A name prefix is a range found by bisection. A glob pattern is matched
+    within the range of its literal prefix, or of its literal suffix in a
+    second array sorted on reversed names, so that only patterns starting
+    and ending with wildcards look at every name. The arrays are saved as
+    they are and load without sorting.
+    """
+
+    def __init__(self, rows=(), fetched_at=None):
+        """
+        @type   rows: List
+        @param  rows: index rows in INDEX_FIELDS order, sorted
+        """
+        self.rows = list(rows)
+        self.fetched_at = fetched_at
+        self._reindex()
+
+    def _reindex(self):
+        self.names = [row[_NAME] for row in self.rows]
+        self._suffixes = None
+        self._trigrams = None
+
+    @classmethod
+    def build(cls, images, fetched_at=None):
+        """Index of image records."""
+        return cls(sorted(index_row(r) for r in images), fetched_at)
+
+    def __len__(self):
+        return len(self.rows)
+
+    # --- persistence -----------------------------------------------------
+
+    @classmethod
+    def load(cls, path):
+        """Index saved in path, None if there is none (or it is unreadable).
+        A file is parsed once per change, see cache.ImageCatalogCache.load."""
+        from cache import _read_json
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        signature = (st.st_ino, st.st_mtime, st.st_size)
+        with _loaded_lock:
+            loaded = _loaded.get(path)
+        if loaded is not None and loaded[0] == signature:
+            return loaded[1]
+        data = _read_json(path)
+        if data is None or data.get('version') != INDEX_VERSION \
+                or data.get('fields') != list(INDEX_FIELDS):
+            return None
+        index = cls(data['rows'], data.get('fetched_at'))
+        with _loaded_lock:
+            _loaded[path] = (signature, index)
+        return index
+
+    def save(self, path):
+        """Write the index to path; load then returns this index until the
+        file changes again."""
+        from cache import _write_json
+        _write_json(path, {'version': INDEX_VERSION, 'fields': list(INDEX_FIELDS),
+                           'fetched_at': self.fetched_at, 'rows': self.rows})
+        st = os.stat(path)
+        with _loaded_lock:
+            _loaded[path] = ((st.st_ino, st.st_mtime, st.st_size), self)
+
+    def updated(self, images, fetched_at=None):
+        """Index of a refreshed catalog, made from this one by touching
+        only the rows that changed. This index is left as it is, as loaded
+        indexes are shared by the threads reading them (see load).
+        @rtype Tuple
+        @return (NameIndex, counts of added, changed and removed images)
+        """
+        new = dict((r['id'], index_row(r)) for r in images)
+        old = dict((row[_ID], row) for row in self.rows)
+        removed = [i for i in old if i not in new]
+        added = [i for i in new if i not in old]
+        changed = [i for i in new if i in old and old[i] != new[i]]
+        counts = {'added': len(added), 'changed': len(changed),
+                  'removed': len(removed)}
+        if not (removed or added or changed):
+            rows = self.rows
+        elif len(removed) + len(added) + len(changed) > len(self.rows) * REBUILD_RATIO:
+            rows = sorted(new.values())
+        else:
+            stale = set(removed + changed)
+            rows = [row for row in self.rows if row[_ID] not in stale]
+            for image_id in added + changed:
+                bisect.insort(rows, new[image_id])
+        return NameIndex(rows, fetched_at), counts
+
+    # --- queries -----------------------------------------------------------
+
+    def _range(self, prefix):
+        lo = bisect.bisect_left(self.names, prefix)
+        end = _successor(prefix) if prefix else None
+        hi = len(self.names) if end is None else bisect.bisect_left(self.names, end)
+        return lo, hi
+
+    def _suffix_positions(self, suffix):
+        if self._suffixes is None:
+            order = sorted(range(len(self.names)), key=lambda i: self.names[i][::-1])
+            self._suffixes = ([self.names[i][::-1] for i in order], order)
+        reversed_names, order = self._suffixes
+        key = suffix[::-1]
+        lo = bisect.bisect_left(reversed_names, key)
+        end = _successor(key)
+        hi = len(order) if end is None else bisect.bisect_left(reversed_names, end)
+        return sorted(order[lo:hi])
+
+    def _positions(self, pattern):
+        if not _WILDCARDS.search(pattern):
+            return range(*self._range(pattern))
+        first = _WILDCARDS.search(pattern).start()
+        prefix = pattern[:first]
+        # the literal tail after the last wildcard ('[...]' counts as one)
+        suffix = re.split(r'[*?]|\[[^]]*\]', pattern)[-1]
+        if prefix:
+            candidates = range(*self._range(prefix))
+        elif suffix and '[' not in suffix and ']' not in suffix:
+            candidates = self._suffix_positions(suffix)
+        else:
+            candidates = range(len(self.names))
+        match = re.compile(fnmatch.translate(pattern)).match
+        names = self.names
+        return [i for i in candidates if match(names[i])]
+
+    def _matches(self, row, state, owners, tags):
+        if state is not None and row[_STATE] != state:
+            return False
+        if owners and row[_OWNER] not in owners:
+            return False
+        for key, value in (tags or {}).items():
+            row_tags = row[_TAGS] or {}
+            if key not in row_tags or (value is not None and row_tags[key] != value):
+                return False
+        return True
+
+    def find(self, pattern, state=None, owners=None, tags=None):
+        """Images whose name matches pattern, in name order.
+
+        A pattern with * ? or [...] wildcards is a glob matched against the
+        whole name (case sensitive, like EC2 names); any other pattern
+        matches the names starting with it.
+
+        @type   owners: List
+        @param  owners: owner ids, any owner when empty
+
+        @type   tags: Dict
+        @param  tags: tag key -> value, None matching any value
+
+        @rtype List
+        @return rows in INDEX_FIELDS order
+        """
+        rows = self.rows
+        return [rows[i] for i in self._positions(pattern)
+                if self._matches(rows[i], state, owners, tags)]
+
+    def newest(self, pattern, state=None, owners=None, tags=None):
+        """Most recently created image matching, see find; None if none."""
+        best = None
+        for row in self.find(pattern, state, owners, tags):
+            if best is None or (row[_DATE] or '', row[_NAME]) > \
+                    (best[_DATE] or '', best[_NAME]):
+                best = row
+        return best
+
+    def similar(self, name, limit=5):
+        """Names close to name, closest first, e.g. to suggest when nothing
+        matched. Names sharing the most three letter sequences with name
+        are ranked by difflib."""
+        if self._trigrams is None:
+            trigrams = {}
+            for i, indexed in enumerate(self.names):
+                for gram in _grams(indexed):
+                    trigrams.setdefault(gram, []).append(i)
+            self._trigrams = trigrams
+        name = _WILDCARDS.sub(u'', name)
+        shared = {}
+        for gram in _grams(name):
+            for i in self._trigrams.get(gram, ()):
+                shared[i] = shared.get(i, 0) + 1
+        candidates = sorted(shared, key=lambda i: -shared[i])[:50]
+        names = sorted(set(self.names[i] for i in candidates))
+        return difflib.get_close_matches(name, names, limit, 0.3)
+
+
+# path -> ((inode, mtime, size), index) of the index files read so far
+_loaded = {}
+_loaded_lock = threading.Lock()
+
+
+def image_index(cache, fetch, refresh=False):
+    """Name index of the catalog kept by cache (an ImageCatalogCache).
+
+    The index file alone answers while it is younger than the cache ttl;
+    otherwise the catalog is read (or refetched with fetch(), updating the
+    index) and the index brought up to date with it.
+    @rtype NameIndex
+    """
+    index = None if refresh else NameIndex.load(cache.index_path)
+    if index is not None and index.fetched_at is not None and \
+            time.time() - index.fetched_at <= cache.ttl:
+        return index
+    images = cache.get(fetch, refresh=refresh)
+    entry = cache.load()
+    fetched_at = entry['fetched_at'] if entry is not None else time.time()
+    index = NameIndex.load(cache.index_path)
+    if index is None:
+        index = NameIndex.build(images, fetched_at)
+    elif index.fetched_at != fetched_at:
+        index, _ = index.updated(images, fetched_at)
+    else:
+        return index
+    cache._ensure_dir()
+    index.save(cache.index_path)
+    return index
@@ -0,0 +1,359 @@
+#
+# ec2 utilities - listing output in table, fixed width, JSON Lines, CSV and TSV
+#
+
+import sys
+import time
+import heapq
+import itertools
+
+# text is each command's usual layout, json an alias of jsonl
+FORMATS = ('text', 'table', 'fixed', 'jsonl', 'json', 'csv', 'tsv')
+# seconds between flushes when writing to a pipe or file
+FLUSH_INTERVAL = 0.2
+# header words printed in capitals
+_ACRONYMS = ('id', 'ip', 'ami', 'vpc')
+
+
+def field_name(header):
+    """Field name of a table header, e.g. 'Private IP' -> 'private_ip'."""
+    return header.strip().lower().replace(' ', '_')
+
+
+def header_label(field):
+    """Table header of a field name, e.g. 'private_ip' -> 'Private IP'."""
+    return ' '.join(word.upper() if word in _ACRONYMS else word.capitalize()
+                    for word in field.split('_'))
+
+
+def parse_fields(text):
+    """Field names from 'a,b,c'."""
+    fields = [field_name(f) for f in text.split(',') if f.strip()]
+    if not fields:
+        raise ValueError('--fields expects field names, e.g. id,name')
+    return fields
+
+
+def parse_sort(text):
+    """Sort keys from 'a,-b': (field, descending) pairs."""
+    keys = []
+    for part in text.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        descending = part.startswith('-')
+        keys.append((field_name(part.lstrip('-+')), descending))
+    if not keys:
+        raise ValueError('--sort expects field names, e.g. name,-creation_date')
+    return keys
+
+
+def cell_text(value):
+    """Value as a byte string for the text formats."""
+    if value is None:
+        return ''
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, dict):
+        return ','.join('{0}={1}'.format(cell_text(k), cell_text(v))
+                        for k, v in sorted(value.items()))
+    if isinstance(value, (list, tuple)):
+        return ','.join(cell_text(v) for v in value)
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return str(value)
+
+
+class Writer(object):
+    """Write rows of values, one field each, as they are given.
+
+    Output is flushed after every row on a terminal and at least every
+    FLUSH_INTERVAL seconds otherwise, so that a pipeline reading the
+    output sees rows soon after they arrive without a write per row.
+    """
+
+    def __init__(self, fields, out=None):
+        self.fields = list(fields)
+        self.out = out or sys.stdout
+        self.interactive = hasattr(self.out, 'isatty') and self.out.isatty()
+        self.rows = 0
+        self._flushed = time.time()
+
+    def header(self):
+        pass
+
+    def format(self, values):
+        raise NotImplementedError
+
+    def write(self, values):
+        if self.rows == 0:
+            self.header()
+        self.out.write(self.format(values))
+        self.rows += 1
+        if self.interactive:
+            self.out.flush()
+        else:
+            now = time.time()
+            if now - self._flushed > FLUSH_INTERVAL:
+                self.out.flush()
+                self._flushed = now
+
+    def close(self):
+        if self.rows == 0:
+            self.header()
+        self.out.flush()
+
+
+class StreamingTable(Writer):
+    """Print rows as they arrive, in a layout close to tabulate's.
+
+    Column widths are fixed up front (header width or the given minimum)
+    and only grow for the cell being printed, so no row needs to be seen
+    before the first one is written.
+    """
+
+    def __init__(self, headers, widths=None, out=None):
+        Writer.__init__(self, headers, out)
+        self.headers = headers
+        if widths is None:
+            widths = [0] * len(headers)
+        self.widths = [max(len(h), w) for h, w in zip(headers, widths)]
+
+    def _line(self, cells):
+        parts = []
+        for cell, width in zip(cells, self.widths):
+            parts.append(cell_text(cell).ljust(width))
+        return '  '.join(parts).rstrip() + '\n'
+
+    def header(self):
+        self.out.write(self._line(self.headers))
+        self.out.write('  '.join(['-' * w for w in self.widths]) + '\n')
+
+    def format(self, values):
+        return self._line(values)
+
+
+class TableWriter(Writer):
+    """tabulate table; it measures every row, so rows are kept till close."""
+
+    def __init__(self, headers, out=None):
+        Writer.__init__(self, headers, out)
+        self.headers = headers
+        self._rows = []
+
+    def write(self, values):
+        self._rows.append([cell_text(v) if isinstance(v, (dict, list, tuple))
+                           else v for v in values])
+        self.rows += 1
+
+    def close(self):
+        from tabulate import tabulate
+        self.out.write(tabulate(self._rows, self.headers) + '\n')
+        self.out.flush()
+
+
+class JsonLinesWriter(Writer):
+    """One JSON object per row, keyed by field name."""
+
+    def __init__(self, fields, out=None):
+        import json
+        Writer.__init__(self, fields, out)
+        self._encode = json.JSONEncoder(sort_keys=True).encode
+
+    def format(self, values):
+        return self._encode(dict(zip(self.fields, values))) + '\n'
+
+
+class _Line(object):
+    """File-like collector of what csv.writer writes for one row."""
+
+    def __init__(self):
+        self.parts = []
+
+    def write(self, text):
+        self.parts.append(text)
+
+    def pop(self):
+        text = ''.join(self.parts)
+        del self.parts[:]
+        return text
+
+
+class CsvWriter(Writer):
+    """RFC 4180 CSV with a header row of field names."""
+
+    def __init__(self, fields, out=None):
+        import csv
+        Writer.__init__(self, fields, out)
+        self._line = _Line()
+        self._csv = csv.writer(self._line, lineterminator='\n')
+
+    def header(self):
+        self.out.write(self.format(self.fields))
+
+    def format(self, values):
+        self._csv.writerow([cell_text(v) for v in values])
+        return self._line.pop()
+
+
+class TsvWriter(Writer):
+    """Tab separated values with a header row of field names. Tabs and
+    newlines inside values become spaces, so every row is one line that
+    cut and awk can split."""
+
+    def header(self):
+        self.out.write('\t'.join(self.fields) + '\n')
+
+    def format(self, values):
+        return '\t'.join(cell_text(v).replace('\t', ' ').replace('\n', ' ')
+                         .replace('\r', ' ') for v in values) + '\n'
+
+
+def column_widths(fields, rows):
+    """Widest text of each field in rows, for the widths of Output.write
+    when every row is at hand."""
+    widths = dict((f, 0) for f in fields)
+    for row in rows:
+        for field, value in zip(fields, row):
+            widths[field] = max(widths[field], len(cell_text(value)))
+    return widths
+
+
+def make_writer(format, fields, out=None, widths=None):
+    """Writer for format (a FORMATS name other than text)."""
+    headers = [header_label(f) for f in fields]
+    if format == 'table':
+        return TableWriter(headers, out)
+    if format == 'fixed':
+        return StreamingTable(headers, widths, out)
+    if format in ('jsonl', 'json'):
+        return JsonLinesWriter(fields, out)
+    if format == 'csv':
+        return CsvWriter(fields, out)
+    if format == 'tsv':
+        return TsvWriter(fields, out)
+    raise ValueError('unknown output format {0}'.format(format))
+
+
+class Output(object):
+    """How a listing is to be printed: format, projected fields, sort
+    order and row limit, as given by --format, --fields, --sort and
+    --limit.
+
+    @type   fields: List
+    @param  fields: field names to print, the listing's own when None
+
+    @type   sort: List
+    @param  sort: (field, descending) pairs, see parse_sort
+
+    @type   limit: int
+    @param  limit: rows to print at most
+    """
+
+    def __init__(self, format='text', fields=None, sort=None, limit=None):
+        if format not in FORMATS:
+            raise ValueError('unknown output format {0}'.format(format))
+        self.format = format
+        self.fields = fields
+        self.sort = sort
+        self.limit = limit
+
+    def selected(self, available, shown=None):
+        """Fields to print out of the available ones; shown are printed
+        when no fields were asked for, every available one if None."""
+        fields = list(self.fields or shown or available)
+        unknown = [f for f in fields if f not in available]
+        if unknown:
+            raise ValueError('unknown field(s): {0}, expected some of {1}'.format(
+                ', '.join(unknown), ', '.join(available)))
+        return fields
+
+    def needed(self, available, shown=None):
+        """Fields to fetch: the printed ones and the sort keys.
+        @rtype List
+        """
+        fields = self.selected(available, shown)
+        for field, _ in self.sort or []:
+            if field not in available:
+                raise ValueError('cannot sort on {0}, expected one of {1}'.format(
+                    field, ', '.join(available)))
+            if field not in fields:
+                fields.append(field)
+        return fields
+
+    def _ordered(self, rows, position):
+        # rows are tuples of values; sort is stable, so sorting on the
+        # last key first leaves rows ordered by every key
+        keys = [(position[f], descending) for f, descending in self.sort]
+        if len(set(d for _, d in keys)) == 1:
+            indexes = [i for i, _ in keys]
+            key = lambda row: [row[i] for i in indexes]
+            if self.limit is not None:
+                # keeps limit rows in memory rather than every row
+                pick = heapq.nlargest if keys[0][1] else heapq.nsmallest
+                return pick(self.limit, rows, key=key)
+            return sorted(rows, key=key, reverse=keys[0][1])
+        rows = list(rows)
+        for index, descending in reversed(keys):
+            rows.sort(key=lambda row: row[index], reverse=descending)
+        return rows
+
+    def write(self, fields, rows, shown=None, default='fixed', out=None,
+              widths=None):
+        """Print rows.
+
+        Unless they are sorted, rows are printed as they come and no more
+        than limit are read from rows, so that a generator stops fetching
+        once enough rows were printed.
+
+        @type   fields: List
+        @param  fields: field names of the values in each row
+
+        @type   rows: Iterable
+        @param  rows: sequences of values (lists, tuples, namedtuples) in
+                      the order of fields, or dicts keyed by field name
+
+        @type   shown: List
+        @param  shown: fields printed when none were asked for, all if None
+
+        @type   default: String
+        @param  default: format used for text
+
+        @type   widths: Dict
+        @param  widths: minimum column widths of the fixed format by field
+                        name, see column_widths
+
+        @rtype int
+        @return rows printed
+        """
+        fields = list(fields)
+        selected = self.selected(fields, shown)
+        needed = self.needed(fields, shown)
+        position = dict((f, i) for i, f in enumerate(needed))
+        index = dict((f, i) for i, f in enumerate(fields))
+
+        def project(row):
+            if isinstance(row, dict):
+                return tuple(row.get(f) for f in needed)
+            return tuple(row[index[f]] for f in needed)
+        rows = itertools.imap(project, rows)
+        if self.sort:
+            rows = self._ordered(rows, position)
+        if self.limit is not None:
+            rows = itertools.islice(rows, self.limit)
+
+        format = default if self.format == 'text' else self.format
+        if widths is not None:
+            widths = [widths.get(f, 0) for f in selected]
+        writer = make_writer(format, selected, out, widths)
+        width = len(selected)
+        for row in rows:
+            writer.write(row[:width])
+        writer.close()
+        return writer.rows
+
+
+def options_output(options):
+    """Output described by parsed command line options."""
+    return Output(options['format'], options['fields'], options['sort'],
+                  options['limit'])
@@ -0,0 +1,256 @@
+#
+# ec2 utilities - paged iteration over Describe* calls
+#
+
+import sys
+import threading
+import Queue
+
+from boto.ec2.instance import Reservation
+from boto.ec2.image import Image
+from boto.ec2.securitygroup import SecurityGroup
+from boto.ec2.snapshot import Snapshot
+from boto.ec2.volume import Volume
+
+DEFAULT_PAGE_SIZE = 500
+# smallest MaxResults EC2 accepts
+MIN_PAGE_SIZE = 5
+
+
+class Resource(object):
+    """How to describe one kind of resource page by page.
+
+    paginated is the largest MaxResults the action accepts, or 0 when it
+    does not page with MaxResults/NextToken; such resources are paged by
+    describing the given ids in batches, and in one response otherwise.
+    """
+
+    def __init__(self, name, action, item_class, id_param, paginated=0,
+                 flatten=None):
+        self.name = name
+        self.action = action
+        self.item_class = item_class
+        self.id_param = id_param
+        self.paginated = paginated
+        self.flatten = flatten
+
+    def items(self, result):
+        if self.flatten is None:
+            return list(result)
+        return self.flatten(result)
+
+
+def _instances(reservations):
+    return [instance for reservation in reservations
+            for instance in reservation.instances]
+
+
+RESOURCES = {
+    'instances': Resource('instances', 'DescribeInstances', Reservation,
+                          'InstanceId', 1000, _instances),
+    'images': Resource('images', 'DescribeImages', Image, 'ImageId'),
+    'security_groups': Resource('security_groups', 'DescribeSecurityGroups',
+                                SecurityGroup, 'GroupId'),
+    'snapshots': Resource('snapshots', 'DescribeSnapshots', Snapshot,
+                          'SnapshotId', 1000),
+    'volumes': Resource('volumes', 'DescribeVolumes', Volume, 'VolumeId', 500),
+}
+
+
+class _Prefetcher(object):
+    """Fetch pages on a background thread, one page ahead of the consumer.
+
+    boto connections must not be shared between threads: the thread
+    borrows a connection with the settings of the consumer's from
+    ec2.connections, and calls pages(connection) with it.
+    """
+
+    def __init__(self, pages, connection):
+        self._pages = pages
+        self._connection = connection
+        self._queue = Queue.Queue(maxsize=1)
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _put(self, entry):
+        while not self._stopped.is_set():
+            try:
+                self._queue.put(entry, timeout=0.5)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def _run(self):
+        import ec2
+        conn = None
+        try:
+            conn = ec2.connections.checkout(
+                *ec2.connection_settings(self._connection))
+            for page in self._pages(conn):
+                if not self._put(('page', page)):
+                    return
+            self._put(('done', None))
+        except Exception:
+            self._put(('error', sys.exc_info()))
+        finally:
+            if conn is not None:
+                ec2.connections.checkin(conn)
+
+    def __iter__(self):
+        try:
+            while True:
+                kind, value = self._queue.get()
+                if kind == 'done':
+                    return
+                if kind == 'error':
+                    raise value[0], value[1], value[2]
+                yield value
+        finally:
+            self._stopped.set()
+
+
+class Paginator(object):
+    """Describe resources one page at a time.
+
+    Pages are fetched lazily, so at most one page (two with prefetch) is
+    held at once however large the account is. Every page is retried on
+    its own, with ec2_retry, resuming from the same token or id batch.
+
+    With prefetch the next page is requested on a background thread while
+    the caller works through the current one. That thread uses a connection
+    of its own, checked out of ec2.connections with the settings of the
+    given one, so the caller may keep using its connection meanwhile.
+
+    @type   connection: EC2 connection
+    @param  connection: EC2 connection
+
+    @type   resource: String
+    @param  resource: a RESOURCES name or a Resource
+
+    @type   ids: List
+    @param  ids: describe only these ids, page_size per request
+
+    @type   filters: Dict
+    @param  filters: server side filters
+
+    @type   params: Dict
+    @param  params: further request parameters, e.g. {'Owner.1': 'self'}
+
+    @type   page_size: int
+    @param  page_size: items per page, clamped to what the action allows
+    """
+
+    def __init__(self, connection, resource, ids=None, filters=None,
+                 params=None, page_size=DEFAULT_PAGE_SIZE, prefetch=False,
+                 tries=3):
+        from ec2 import ec2_retry
+        if isinstance(resource, basestring):
+            resource = RESOURCES[resource]
+        self.connection = connection
+        self.resource = resource
+        self.ids = list(ids or [])
+        self.filters = filters or None
+        self.params = dict(params or {})
+        self.page_size = max(1, page_size)
+        self.prefetch = prefetch
+        self.pages_fetched = 0
+        self._fetch = ec2_retry(tries, deadline=120)(self._fetch_page)
+
+    def _request_params(self):
+        params = dict(self.params)
+        if self.filters:
+            self.connection.build_filter_params(params, self.filters)
+        return params
+
+    def _fetch_page(self, conn, params):
+        result = conn.get_list(
+            self.resource.action, params,
+            [('item', self.resource.item_class)], verb='POST')
+        self.pages_fetched += 1
+        return result
+
+    def _pages(self, conn):
+        resource = self.resource
+        base = self._request_params()
+        if self.ids:
+            # EC2 refuses MaxResults together with ids: batch them instead
+            for i in range(0, len(self.ids), self.page_size):
+                params = dict(base)
+                self.connection.build_list_params(
+                    params, self.ids[i:i + self.page_size], resource.id_param)
+                yield resource.items(self._fetch(conn, params))
+        elif resource.paginated:
+            base['MaxResults'] = min(max(self.page_size, MIN_PAGE_SIZE),
+                                     resource.paginated)
+            next_token = None
+            while True:
+                params = dict(base)
+                if next_token:
+                    params['NextToken'] = next_token
+                result = self._fetch(conn, params)
+                next_token = result.next_token
+                yield resource.items(result)
+                if not next_token:
+                    break
+        else:
+            yield resource.items(self._fetch(conn, base))
+
+    def pages(self):
+        """
+        @rtype Generator
+        @return lists of boto objects, one per response
+        """
+        if self.prefetch:
+            return iter(_Prefetcher(self._pages, self.connection))
+        return self._pages(self.connection)
+
+    def __iter__(self):
+        for page in self.pages():
+            for item in page:
+                yield item
+
+
+def iter_instances(connection, instance_ids=None, filters=None,
+                   page_size=DEFAULT_PAGE_SIZE, prefetch=False):
+    """Iterate over boto instances, see Paginator."""
+    return iter(Paginator(connection, 'instances', instance_ids, filters,
+                          page_size=page_size, prefetch=prefetch))
+
+
+def iter_images(connection, image_ids=None, owners=None, filters=None,
+                page_size=DEFAULT_PAGE_SIZE, prefetch=False):
+    """Iterate over boto images, see Paginator. DescribeImages does not
+    page, so without image_ids the catalog comes in one response; use
+    records.iter_images to parse it without holding it."""
+    params = {}
+    if owners:
+        connection.build_list_params(params, owners, 'Owner')
+    return iter(Paginator(connection, 'images', image_ids, filters, params,
+                          page_size, prefetch))
+
+
+def iter_security_groups(connection, group_ids=None, filters=None,
+                         page_size=DEFAULT_PAGE_SIZE, prefetch=False):
+    """Iterate over boto security groups, see Paginator."""
+    return iter(Paginator(connection, 'security_groups', group_ids, filters,
+                          page_size=page_size, prefetch=prefetch))
+
+
+def iter_snapshots(connection, snapshot_ids=None, owners=None, filters=None,
+                   page_size=DEFAULT_PAGE_SIZE, prefetch=False):
+    """Iterate over boto snapshots, see Paginator."""
+    params = {}
+    if owners:
+        connection.build_list_params(params, owners, 'Owner')
+    return iter(Paginator(connection, 'snapshots', snapshot_ids, filters,
+                          params, page_size, prefetch))
+
+
+def iter_volumes(connection, volume_ids=None, filters=None,
+                 page_size=DEFAULT_PAGE_SIZE, prefetch=False):
+    """Iterate over boto volumes, see Paginator."""
+    return iter(Paginator(connection, 'volumes', volume_ids, filters,
+                          page_size=page_size, prefetch=prefetch))
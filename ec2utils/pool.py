@@ -0,0 +1,261 @@
+#
+# ec2 utilities - per thread EC2 connection reuse
+#
+
+import time
+import atexit
+import weakref
+import threading
+
+DEFAULT_MAX_IDLE = 300
+
+
+def close_connection(conn):
+    """Close a boto connection including its kept-alive sockets.
+
+    boto's close() only forgets the current socket, the ones waiting in
+    the connection's HTTP pool stay open until the server drops them.
+    """
+    try:
+        conn.close()
+        pool = getattr(conn, '_pool', None)
+        if pool is not None:
+            with pool.mutex:
+                for host_pool in pool.host_to_pool.values():
+                    for http_conn, _ in host_pool.queue:
+                        http_conn.close()
+                pool.host_to_pool.clear()
+    except Exception:
+        pass
+
+
+class ConnectionManager(object):
+    """Hand out one EC2 connection per thread and connection settings.
+
+    boto connections keep their HTTP(S) sockets alive between requests, but
+    they must not be shared between threads. The manager keeps a connection
+    per (label, key, endpoint, validation) for every thread that asks for
+    one, so repeated calls from the same thread reuse the same warm
+    connection. Connections unused for longer than max_idle seconds, and
+    those of threads that have finished, are closed (see evict_idle, run
+    every max_idle / 2 seconds by get and checkout) and replaced on the
+    next request.
+
+    Short lived threads, whose connections would never be asked for again,
+    borrow connections shared by every thread with checkout() and checkin().
+    """
+
+    def __init__(self, factory, max_idle=DEFAULT_MAX_IDLE):
+        """
+        @type   factory: callable
+        @param  factory: called as factory(label, key, secret, ec2_url,
+                         validation) to build a new connection
+
+        @type   max_idle: int
+        @param  max_idle: seconds a connection may stay unused
+        """
+        if max_idle <= 0:
+            raise ValueError("max_idle must be greater than 0")
+        self.factory = factory
+        self.max_idle = max_idle
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # every live entry, across threads, so shutdown() can close them:
+        # [connection, last use, closed, owning thread (a weakref) or None
+        # for the connections shared with checkout()]
+        self._entries = []
+        # settings -> entries checked in, id(conn) -> (settings, entry)
+        self._idle = {}
+        self._checked_out = {}
+        self._stats = {'new': 0, 'reuses': 0, 'evictions': 0}
+        self._closed = False
+        self._evicted = time.time()
+
+    def _connections(self):
+        try:
+            return self._local.connections
+        except AttributeError:
+            self._local.connections = {}
+            return self._local.connections
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def _close_entry(self, entry):
+        with self._lock:
+            if entry in self._entries:
+                self._entries.remove(entry)
+        close_connection(entry[0])
+
+    def _evict_due(self, now):
+        with self._lock:
+            due = now - self._evicted > self.max_idle / 2.0
+            if due:
+                self._evicted = now
+        if due:
+            self.evict_idle()
+
+    def get(self, label, key, secret, ec2_url, validation):
+        """Connection for the calling thread, created on first use.
+
+        Takes the same arguments as ec2.get_connection.
+
+        @rtype : Ec2 Connection
+        @return: ec2 connection
+        """
+        if self._closed:
+            raise RuntimeError("connection manager has been shut down")
+        conn_key = (label, key, ec2_url, bool(validation))
+        connections = self._connections()
+        now = time.time()
+        self._evict_due(now)
+        entry = connections.get(conn_key)
+        if entry is not None and entry[2]:
+            # already closed by evict_idle()
+            entry = None
+        elif entry is not None and now - entry[1] > self.max_idle:
+            self._close_entry(entry)
+            self._count('evictions')
+            entry = None
+        if entry is not None:
+            entry[1] = now
+            self._count('reuses')
+            return entry[0]
+        conn = self.factory(label, key, secret, ec2_url, validation)
+        entry = [conn, now, False, weakref.ref(threading.current_thread())]
+        _track_use(entry)
+        connections[conn_key] = entry
+        with self._lock:
+            self._entries.append(entry)
+            self._stats['new'] += 1
+        return conn
+
+    def checkout(self, label, key, secret, ec2_url, validation):
+        """Connection for the caller's exclusive use till checkin(conn).
+
+        Takes the same arguments as ec2.get_connection and reuses a
+        connection checked in by any thread when there is one.
+
+        @rtype : Ec2 Connection
+        @return: ec2 connection
+        """
+        if self._closed:
+            raise RuntimeError("connection manager has been shut down")
+        conn_key = (label, key, ec2_url, bool(validation))
+        now = time.time()
+        self._evict_due(now)
+        while True:
+            with self._lock:
+                idle = self._idle.get(conn_key)
+                entry = idle.pop() if idle else None
+            if entry is None:
+                break
+            if entry[2]:
+                continue
+            if now - entry[1] > self.max_idle:
+                self._close_entry(entry)
+                self._count('evictions')
+                continue
+            entry[1] = now
+            with self._lock:
+                self._checked_out[id(entry[0])] = (conn_key, entry)
+                self._stats['reuses'] += 1
+            return entry[0]
+        conn = self.factory(label, key, secret, ec2_url, validation)
+        entry = [conn, now, False, None]
+        _track_use(entry)
+        with self._lock:
+            self._entries.append(entry)
+            self._checked_out[id(conn)] = (conn_key, entry)
+            self._stats['new'] += 1
+        return conn
+
+    def checkin(self, conn):
+        """Give back a connection returned by checkout()."""
+        with self._lock:
+            conn_key, entry = self._checked_out.pop(id(conn))
+            # entries closed by shutdown() or evict_idle() are not reused
+            if not self._closed and not entry[2]:
+                entry[1] = time.time()
+                self._idle.setdefault(conn_key, []).append(entry)
+
+    def provider(self, label, key, secret, ec2_url, validation):
+        """Callable returning the calling thread's connection.
+
+        Handy for handing connection settings to worker threads without
+        handing them a connection.
+        """
+        return lambda: self.get(label, key, secret, ec2_url, validation)
+
+    def evict_idle(self):
+        """Close connections of every thread that have been idle too long,
+        and those of threads that have finished.
+        @rtype int
+        @return number of connections closed
+        """
+        now = time.time()
+        with self._lock:
+            busy = set(id(e) for _, e in self._checked_out.values())
+            idle = [e for e in self._entries if id(e) not in busy and
+                    (now - e[1] > self.max_idle or _owner_finished(e))]
+        for entry in idle:
+            # the owning thread replaces it on its next get()
+            entry[2] = True
+            self._close_entry(entry)
+            self._count('evictions')
+        with self._lock:
+            for conn_key, entries in self._idle.items():
+                self._idle[conn_key] = [e for e in entries if not e[2]]
+        return len(idle)
+
+    def shutdown(self):
+        """Close every connection handed out so far."""
+        self._closed = True
+        with self._lock:
+            entries, self._entries = self._entries, []
+        for entry in entries:
+            entry[2] = True
+            close_connection(entry[0])
+
+    def stats(self):
+        """Pool statistics.
+        @rtype Dict
+        @return counters 'new', 'reuses', 'evictions' and 'open'
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['open'] = len(self._entries)
+        return stats
+
+    def report(self):
+        return ('connections: new={new} reuses={reuses} evictions={evictions} '
+                'open={open}').format(**self.stats())
+
+
+def _track_use(entry):
+    # last use is that of the latest request, not of the latest get(): a
+    # thread may keep the connection it got for a long paginate or wait
+    conn = entry[0]
+    make_request = conn.make_request
+    def used_make_request(*args, **kwargs):
+        entry[1] = time.time()
+        try:
+            return make_request(*args, **kwargs)
+        finally:
+            entry[1] = time.time()
+    conn.make_request = used_make_request
+
+
+def _owner_finished(entry):
+    if entry[3] is None:
+        return False
+    owner = entry[3]()
+    return owner is None or not owner.is_alive()
+
+
+def default_manager(factory):
+    """Build a manager whose connections are closed at interpreter exit."""
+    manager = ConnectionManager(factory)
+    atexit.register(manager.shutdown)
+    return manager
@@ -0,0 +1,295 @@
+#
+# ec2 utilities - client side EC2 API rate limiting
+#
+
+import os
+import re
+import time
+import errno
+import fcntl
+import threading
+from StringIO import StringIO
+
+# requests per second and burst size for each action category
+DEFAULT_LIMITS = {'describe': (20.0, 40), 'mutate': (5.0, 10)}
+# adaptive rate control: multiplicative decrease on throttling, additive
+# increase (as a fraction of the configured rate) on success
+DECREASE = 0.5
+INCREASE = 0.02
+MIN_RATE_FRACTION = 0.05
+# error codes the service uses when the caller exceeds its request rate
+THROTTLE_CODES = ('RequestLimitExceeded', 'Throttling', 'ThrottlingException',
+                  'RequestThrottled', 'SlowDown')
+THROTTLE_STATUSES = (429, 503)
+_ERROR_CODE = re.compile(r'<Code>([^<]*)</Code>')
+
+
+def is_throttled(error):
+    """Whether an exception raised by a boto request means throttling."""
+    return getattr(error, 'error_code', None) in THROTTLE_CODES or \
+        getattr(error, 'status', None) in THROTTLE_STATUSES
+
+
+def _throttled_response(response):
+    # 4xx answers carry the reason in their body only: read it, and hand
+    # the same bytes to the caller, which has not read anything yet
+    if response.status in THROTTLE_STATUSES:
+        return True
+    if response.status < 400:
+        return False
+    body = response.read()
+    response.read = StringIO(body).read
+    match = _ERROR_CODE.search(body)
+    return match is not None and match.group(1) in THROTTLE_CODES
+
+
+def action_category(action):
+    """Bucket an EC2 Query API action belongs to.
+    @type   action: String
+    @param  action: e.g. 'DescribeImages', 'RunInstances'
+
+    @rtype String
+    @return 'describe' for read only actions, 'mutate' otherwise
+    """
+    if action and action.startswith(('Describe', 'Get')):
+        return 'describe'
+    return 'mutate'
+
+
+class _Bucket(object):
+    """Token bucket arithmetic shared by the in-process and file backends.
+
+    The state is (tokens, timestamp, rate). Acquiring always takes the
+    tokens, letting the balance go negative, and returns how long the
+    caller has to sleep for the balance to be paid back, so the sleep
+    happens outside any lock and waiters are served in arrival order.
+    """
+
+    def __init__(self, rate, burst):
+        if rate <= 0:
+            raise ValueError("rate must be greater than 0")
+        if burst < 1:
+            raise ValueError("burst must be 1 or greater")
+        self.max_rate = float(rate)
+        self.min_rate = self.max_rate * MIN_RATE_FRACTION
+        self.burst = burst
+
+    def _take(self, state, now, tokens):
+        balance, stamp, rate = state
+        balance = min(self.burst, balance + (now - stamp) * rate) - tokens
+        wait = -balance / rate if balance < 0 else 0.0
+        return (balance, now, rate), wait
+
+    def _throttled(self, state, now):
+        balance, stamp, rate = state
+        balance = min(self.burst, balance + (now - stamp) * rate)
+        rate = max(self.min_rate, rate * DECREASE)
+        # drop the burst allowance so the next calls are spread out
+        return (min(balance, 0.0), now, rate)
+
+    def _succeeded(self, state, now):
+        balance, stamp, rate = state
+        balance = min(self.burst, balance + (now - stamp) * rate)
+        rate = min(self.max_rate, rate + self.max_rate * INCREASE)
+        return (balance, now, rate)
+
+    def acquire(self, tokens=1):
+        """Take tokens, sleeping as long as the bucket requires.
+        @rtype float
+        @return seconds slept
+        """
+        wait = self._update(lambda state, now: self._take(state, now, tokens))
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def throttled(self):
+        """The service throttled a call: halve the rate."""
+        self._update(lambda state, now: (self._throttled(state, now), None))
+
+    def succeeded(self):
+        """A call went through: creep the rate back up."""
+        self._update(lambda state, now: (self._succeeded(state, now), None))
+
+
+class TokenBucket(_Bucket):
+    """Token bucket shared by the threads of one process."""
+
+    def __init__(self, rate, burst):
+        _Bucket.__init__(self, rate, burst)
+        self._lock = threading.Lock()
+        self._state = (float(burst), time.time(), self.max_rate)
+
+    def _update(self, change):
+        with self._lock:
+            self._state, result = change(self._state, time.time())
+        return result
+
+    @property
+    def rate(self):
+        return self._state[2]
+
+
+class FileTokenBucket(_Bucket):
+    """Token bucket shared by every process using the same state file.
+
+    The state is kept in a small file updated under an exclusive flock, so
+    unrelated worker processes on one host draw from the same budget.
+    """
+
+    def __init__(self, path, rate, burst):
+        _Bucket.__init__(self, rate, burst)
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            try:
+                os.makedirs(directory, 0700)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+    def _read(self, fd):
+        os.lseek(fd, 0, os.SEEK_SET)
+        data = os.read(fd, 128)
+        try:
+            balance, stamp, rate = [float(x) for x in data.split()]
+            return (balance, stamp, min(rate, self.max_rate))
+        except ValueError:
+            # new or damaged file, start with a full bucket
+            return (float(self.burst), time.time(), self.max_rate)
+
+    def _write(self, fd, state):
+        data = '%.6f %.6f %.6f\n' % state
+        os.lseek(fd, 0, os.SEEK_SET)
+        os.ftruncate(fd, 0)
+        os.write(fd, data)
+
+    def _update(self, change):
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            state, result = change(self._read(fd), time.time())
+            self._write(fd, state)
+            return result
+        finally:
+            os.close(fd)
+
+    @property
+    def rate(self):
+        return self._update(lambda state, now: (state, state[2]))
+
+
+class RateLimiter(object):
+    """Per action category token buckets in front of EC2 connections.
+
+    Wrapped connections take a token before every request and report
+    throttled responses (HTTP 429/503 or a throttling error code) and
+    successes back to the bucket, so the rate adapts to what the service
+    accepts.
+    """
+
+    def __init__(self, buckets):
+        """
+        @type   buckets: Dict
+        @param  buckets: category ('describe', 'mutate') to bucket
+        """
+        self.buckets = buckets
+        self.waited = 0.0
+        self.throttles = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def bucket(self, action):
+        return self.buckets.get(action_category(action))
+
+    def acquire(self, action):
+        bucket = self.bucket(action)
+        wait = bucket.acquire() if bucket is not None else 0.0
+        self._local.waited = wait
+        with self._lock:
+            self.waited += wait
+
+    def last_wait(self):
+        """Seconds the calling thread waited in its last acquire."""
+        return getattr(self._local, 'waited', 0.0)
+
+    def feedback(self, action, throttled):
+        bucket = self.bucket(action)
+        if bucket is None:
+            return
+        if throttled:
+            with self._lock:
+                self.throttles += 1
+            bucket.throttled()
+        else:
+            bucket.succeeded()
+
+    def wrap_connection(self, conn):
+        """Rate limit every request made through a boto connection.
+        @type   conn: EC2 connection
+        @param  conn: EC2 connection
+
+        @rtype : Ec2 Connection
+        @return: the same connection
+        """
+        if getattr(conn, '_rate_limiter', None) is self:
+            return conn
+        make_request = conn.make_request
+        limiter = self
+        def limited_make_request(action, params=None, path='/', verb='GET'):
+            limiter.acquire(action)
+            try:
+                response = make_request(action, params, path, verb)
+            except Exception as e:
+                # boto raises for the 5xx answers it gave up retrying
+                if is_throttled(e):
+                    limiter.feedback(action, True)
+                raise
+            limiter.feedback(action, _throttled_response(response))
+            return response
+        conn.make_request = limited_make_request
+        conn._rate_limiter = self
+        return conn
+
+
+def parse_limits(spec):
+    """Parse 'describe=20/40,mutate=5/10' into {category: (rate, burst)}."""
+    limits = dict(DEFAULT_LIMITS)
+    for item in spec.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        try:
+            category, value = item.split('=', 1)
+            rate, _, burst = value.partition('/')
+            rate = float(rate)
+            burst = int(burst) if burst else max(1, int(rate * 2))
+        except ValueError:
+            raise ValueError('bad rate limit {0!r}, expected category=rate[/burst]'.format(item))
+        limits[category.strip()] = (rate, burst)
+    return limits
+
+
+def limiter_from_env(environ=None):
+    """Rate limiter configured by the environment, None when disabled.
+
+    EC2UTILS_RATE_LIMIT enables it, as 'default' or as
+    'describe=RATE[/BURST],mutate=RATE[/BURST]'. When EC2UTILS_RATE_LIMIT_DIR
+    is set too the buckets live in files there and are shared by every
+    process using that directory; otherwise they are shared by the threads
+    of this process only.
+    """
+    environ = os.environ if environ is None else environ
+    spec = environ.get('EC2UTILS_RATE_LIMIT')
+    if not spec:
+        return None
+    limits = DEFAULT_LIMITS if spec == 'default' else parse_limits(spec)
+    directory = environ.get('EC2UTILS_RATE_LIMIT_DIR')
+    buckets = {}
+    for category, (rate, burst) in limits.items():
+        if directory:
+            path = os.path.join(directory, category + '.bucket')
+            buckets[category] = FileTokenBucket(path, rate, burst)
+        else:
+            buckets[category] = TokenBucket(rate, burst)
+    return RateLimiter(buckets)
@@ -0,0 +1,269 @@
+#
+# ec2 utilities - compact records parsed from Describe* responses
+#
+
+from collections import namedtuple
+from xml.etree import cElementTree as ElementTree
+
+
+def _local(tag):
+    """Strip the xml namespace from an element tag."""
+    return tag.rsplit('}', 1)[-1]
+
+
+def _child(elem, tag):
+    for child in elem:
+        if _local(child.tag) == tag:
+            return child
+    return None
+
+
+def _text(elem):
+    # an empty element is '' rather than None, as boto reports it
+    return elem.text or ''
+
+
+def _bool(elem):
+    return elem.text == 'true'
+
+
+def _tags(elem):
+    tags = {}
+    for item in elem:
+        key = value = None
+        for field in item:
+            name = _local(field.tag)
+            if name == 'key':
+                key = field.text
+            elif name == 'value':
+                value = field.text
+        if key is not None:
+            tags[key] = value
+    return tags
+
+
+def _group_ids(elem):
+    ids = []
+    for item in elem:
+        group = _child(item, 'groupId')
+        if group is not None:
+            ids.append(group.text)
+    return ids
+
+
+class ItemSpec(object):
+    """Where the items of a Describe* response are and how to read their
+    fields.
+
+    fields maps a field name to (path of tags below the item, converter of
+    the element found there, value when it is missing).
+    """
+
+    def __init__(self, action, item_path, fields, default_fields):
+        self.action = action
+        self.item_path = tuple(item_path)
+        self.fields = fields
+        self.default_fields = tuple(default_fields)
+        # containers to clear once one of their items has been read
+        self.clear_paths = set(self.item_path[:i + 1]
+                               for i in range(len(self.item_path))
+                               if self.item_path[i] == 'item')
+        self._types = {}
+
+    def record_type(self, names):
+        """namedtuple class holding the given fields, one per field set."""
+        names = tuple(names)
+        record = self._types.get(names)
+        if record is None:
+            unknown = [n for n in names if n not in self.fields]
+            if unknown:
+                raise ValueError('unknown {0} field(s): {1}'.format(
+                    self.action, ', '.join(unknown)))
+            record = namedtuple(self.action[len('Describe'):-1] + 'Record', names)
+            self._types[names] = record
+        return record
+
+
+IMAGES = ItemSpec('DescribeImages', ['imagesSet', 'item'], {
+    'id': (('imageId',), _text, None),
+    'name': (('name',), _text, None),
+    'state': (('imageState',), _text, None),
+    'owner_id': (('imageOwnerId',), _text, None),
+    'is_public': (('isPublic',), _bool, None),
+    'architecture': (('architecture',), _text, None),
+    'creation_date': (('creationDate',), _text, None),
+    'location': (('imageLocation',), _text, None),
+    'type': (('imageType',), _text, None),
+    'kernel_id': (('kernelId',), _text, None),
+    'root_device_type': (('rootDeviceType',), _text, None),
+    'description': (('description',), _text, None),
+    'tags': (('tagSet',), _tags, {}),
+}, ['id', 'name'])
+
+INSTANCES = ItemSpec('DescribeInstances',
+                     ['reservationSet', 'item', 'instancesSet', 'item'], {
+    'id': (('instanceId',), _text, None),
+    'image_id': (('imageId',), _text, None),
+    'state': (('instanceState', 'name'), _text, None),
+    'zone': (('placement', 'availabilityZone'), _text, None),
+    'type': (('instanceType',), _text, None),
+    'key_name': (('keyName',), _text, None),
+    'private_ip': (('privateIpAddress',), _text, None),
+    'public_ip': (('ipAddress',), _text, None),
+    'launch_time': (('launchTime',), _text, None),
+    'vpc_id': (('vpcId',), _text, None),
+    'groups': (('groupSet',), _group_ids, []),
+    'tags': (('tagSet',), _tags, {}),
+}, ['id', 'state'])
+
+
+def iter_items(source, spec, fields=None, next_token=None):
+    """Parse a Describe* response body incrementally.
+
+    Only the requested fields are read, into namedtuples, and every item
+    is dropped from the tree once read, so memory and time grow with the
+    fields used rather than with boto's object model.
+
+    @type   source: file
+    @param  source: response body
+
+    @type   spec: ItemSpec
+    @param  spec: IMAGES, INSTANCES, ...
+
+    @type   fields: List
+    @param  fields: field names, spec.default_fields when None
+
+    @type   next_token: List
+    @param  next_token: receives the nextToken of the response, if any
+
+    @rtype Generator
+    @return records
+    """
+    names = tuple(fields or spec.default_fields)
+    record = spec.record_type(names)
+    defaults = [spec.fields[n][2] for n in names]
+    # first tag of a field path -> [(position, rest of the path, converter)]
+    wanted = {}
+    for i, name in enumerate(names):
+        path, convert, default = spec.fields[name]
+        wanted.setdefault(path[0], []).append((i, path[1:], convert))
+    item_path = spec.item_path
+    depth = len(item_path) + 1
+    clear_paths = spec.clear_paths
+    path = []
+    stack = []
+    for event, elem in ElementTree.iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            path.append(_local(elem.tag))
+            stack.append(elem)
+            continue
+        tag = path[-1]
+        if tag == 'item' and len(path) == depth and tuple(path[1:]) == item_path:
+            values = list(defaults)
+            for child in elem:
+                targets = wanted.get(_local(child.tag))
+                if not targets:
+                    continue
+                for i, rest, convert in targets:
+                    node = child
+                    for name in rest:
+                        node = _child(node, name)
+                        if node is None:
+                            break
+                    if node is not None:
+                        values[i] = convert(node)
+            yield record._make(values)
+        elif tag == 'nextToken' and len(path) == 2 and next_token is not None:
+            next_token.append(elem.text)
+        if tag == 'item' and tuple(path[1:]) in clear_paths:
+            stack[-2].clear()
+        path.pop()
+        stack.pop()
+
+
+def describe(connection, spec, params, fields=None):
+    """Send a Describe* request and yield records while the response is
+    parsed, following nextToken to the next page. On an instrumented
+    connection the parsing is timed, see metrics.timed_records.
+    @type   connection: EC2 connection
+    @param  connection: EC2 connection
+
+    @type   params: Dict
+    @param  params: request parameters
+
+    @rtype Generator
+    @return records, see iter_items
+    """
+    records = _describe(connection, spec, dict(params), fields)
+    registry = getattr(connection, '_metrics', None)
+    if registry is not None:
+        from metrics import timed_records
+        records = timed_records(registry, spec.action, records)
+    return records
+
+
+def _describe(connection, spec, params, fields):
+    while True:
+        response = connection.make_request(spec.action, params, verb='POST')
+        if response.status != 200:
+            body = response.read()
+            raise connection.ResponseError(response.status, response.reason, body)
+        next_token = []
+        for record in iter_items(response, spec, fields, next_token):
+            yield record
+        if not next_token or not next_token[0]:
+            break
+        params['NextToken'] = next_token[0]
+
+
+def image_request_params(connection, image_ids=None, owners=None, filters=None):
+    """Build DescribeImages parameters the same way get_all_images does.
+    @type   connection: EC2 connection
+    @param  connection: EC2 connection
+
+    @type   image_ids: List
+    @param  image_ids: image ids to describe
+
+    @type   owners: List
+    @param  owners: owner ids, or 'self', 'amazon', ...
+
+    @type   filters: Dict
+    @param  filters: server side filters, e.g. {'name': 'ubuntu*'}
+
+    @rtype Dict
+    @return request parameters
+    """
+    params = {}
+    if image_ids:
+        connection.build_list_params(params, image_ids, 'ImageId')
+    if owners:
+        connection.build_list_params(params, owners, 'Owner')
+    if filters:
+        connection.build_filter_params(params, filters)
+    return params
+
+
+def iter_images(connection, image_ids=None, owners=None, filters=None,
+                fields=None):
+    """Describe images, yielding records with only the given fields (id
+    and name by default), see IMAGES for the field names."""
+    params = image_request_params(connection, image_ids, owners, filters)
+    return describe(connection, IMAGES, params, fields)
+
+
+def iter_instances(connection, instance_ids=None, filters=None, fields=None,
+                   page_size=None):
+    """Describe instances, yielding records with only the given fields (id
+    and state by default), see INSTANCES for the field names.
+
+    page_size asks for pages of that many instances; EC2 does not allow it
+    together with instance_ids.
+    """
+    params = {}
+    if instance_ids:
+        connection.build_list_params(params, instance_ids, 'InstanceId')
+    if filters:
+        connection.build_filter_params(params, filters)
+    if page_size:
+        params['MaxResults'] = page_size
+    return describe(connection, INSTANCES, params, fields)
@@ -0,0 +1,326 @@
+#
+# ec2 utilities - security group lookup and rule reconciliation
+#
+
+import re
+import time
+import threading
+from collections import namedtuple
+from boto.exception import EC2ResponseError
+
+from paginate import iter_security_groups
+
+DEFAULT_TTL = 60
+# grants (rule, source pairs) per Authorize/Revoke call
+MAX_GRANTS = 100
+PROTOCOL_NAMES = {'6': 'tcp', '17': 'udp', '1': 'icmp', 'all': '-1'}
+
+# source is a CIDR, a group id (sg-...) or, for EC2-Classic, a group name
+Rule = namedtuple('Rule', 'protocol from_port to_port source')
+
+
+def _port(value):
+    if value is None or value == '':
+        return None
+    return int(value)
+
+
+def make_rule(protocol, from_port=None, to_port=None, source='0.0.0.0/0'):
+    """Rule with the protocol and ports spelled the way EC2 reports them,
+    so that desired and current rules compare equal."""
+    protocol = str(protocol).lower()
+    protocol = PROTOCOL_NAMES.get(protocol, protocol)
+    if protocol == '-1':
+        from_port = to_port = None
+    from_port = _port(from_port)
+    to_port = _port(to_port)
+    if to_port is None:
+        to_port = from_port
+    return Rule(protocol, from_port, to_port, source)
+
+
+_RULE = re.compile(r'^([^:]+):(?:(-?\d+)(?:-(-?\d+))?)?:(.+)$')
+
+def parse_rule(text):
+    """Parse 'protocol:port[-port]:source', e.g. tcp:22:0.0.0.0/0,
+    tcp:8000-8080:sg-0123abcd, icmp:-1:10.0.0.0/8 or all::10.0.0.0/8.
+    @rtype Rule
+    """
+    match = _RULE.match(text.strip())
+    if match is None:
+        raise ValueError('rule must be protocol:port[-port]:source, not ' + text)
+    protocol, from_port, to_port, source = match.groups()
+    return make_rule(protocol, from_port, to_port, source)
+
+
+def group_rules(group):
+    """Ingress rules of a boto SecurityGroup, one Rule per grant.
+    @rtype frozenset
+    """
+    rules = set()
+    for permission in group.rules:
+        for grant in permission.grants:
+            source = grant.cidr_ip or grant.group_id or grant.name
+            rules.add(make_rule(permission.ip_protocol, permission.from_port,
+                                permission.to_port, source))
+    return frozenset(rules)
+
+
+def diff_rules(current, desired, exclusive=True):
+    """Smallest change turning current into desired.
+    @type   exclusive: Boolean
+    @param  exclusive: also revoke the current rules that are not desired
+
+    @rtype Tuple
+    @return (rules to authorize, rules to revoke), as sorted lists
+    """
+    current = set(current)
+    desired = set(desired)
+    authorize = sorted(desired - current)
+    revoke = sorted(current - desired) if exclusive else []
+    return authorize, revoke
+
+
+def permission_params(rules):
+    """IpPermissions.N parameters for rules, one permission per protocol
+    and port range carrying all of its sources."""
+    permissions = {}
+    for rule in rules:
+        key = (rule.protocol, rule.from_port, rule.to_port)
+        permissions.setdefault(key, []).append(rule.source)
+    params = {}
+    for n, key in enumerate(sorted(permissions), 1):
+        protocol, from_port, to_port = key
+        prefix = 'IpPermissions.{0}.'.format(n)
+        params[prefix + 'IpProtocol'] = protocol
+        if from_port is not None:
+            params[prefix + 'FromPort'] = from_port
+            params[prefix + 'ToPort'] = to_port
+        cidrs = groups = 0
+        for source in sorted(permissions[key]):
+            if '/' in source:
+                cidrs += 1
+                params['{0}IpRanges.{1}.CidrIp'.format(prefix, cidrs)] = source
+            else:
+                groups += 1
+                kind = 'GroupId' if source.startswith('sg-') else 'GroupName'
+                params['{0}Groups.{1}.{2}'.format(prefix, groups, kind)] = source
+    return params
+
+
+class SecurityGroups(object):
+    """Security groups of one account, looked up by name or id with
+    server side filters and kept for ttl seconds.
+
+    reconcile() brings a group's ingress rules to a desired set with one
+    AuthorizeSecurityGroupIngress and one RevokeSecurityGroupIngress call
+    per MAX_GRANTS changed grants; when nothing differs it makes no
+    mutating call at all.
+    """
+
+    def __init__(self, connection, ttl=DEFAULT_TTL, tries=3):
+        """
+        @type   connection: EC2 connection or callable
+        @param  connection: connection, or a callable returning the calling
+                            thread's connection (see ConnectionManager.provider)
+
+        @type   ttl: float
+        @param  ttl: seconds a looked up group is trusted, 0 not to cache
+        """
+        from ec2 import ec2_retry
+        self.connection = connection
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # ('name', name) or ('id', id) -> (expires, group)
+        self._groups = {}
+        self._retry = ec2_retry(tries, deadline=120)
+        self.stats = {'lookups': 0, 'hits': 0, 'describes': 0, 'creates': 0,
+                      'authorize_calls': 0, 'revoke_calls': 0}
+
+    def _conn(self):
+        if callable(self.connection):
+            return self.connection()
+        return self.connection
+
+    def remember(self, group):
+        """Cache group as it is now, e.g. as described by the caller."""
+        if self.ttl <= 0:
+            return
+        expires = time.time() + self.ttl
+        with self._lock:
+            self._groups[('name', group.name)] = (expires, group)
+            self._groups[('id', group.id)] = (expires, group)
+
+    def invalidate(self, group=None):
+        """Forget group (a boto SecurityGroup), or every group."""
+        with self._lock:
+            if group is None:
+                self._groups.clear()
+            else:
+                self._groups.pop(('name', group.name), None)
+                self._groups.pop(('id', group.id), None)
+
+    def get(self, name=None, group_id=None):
+        """Group with the given name or id, None if there is none.
+        @rtype SecurityGroup
+        """
+        if group_id:
+            key, filters = ('id', group_id), {'group-id': group_id}
+        elif name:
+            key, filters = ('name', name), {'group-name': name}
+        else:
+            raise ValueError('need a group name or id')
+        now = time.time()
+        with self._lock:
+            self.stats['lookups'] += 1
+            entry = self._groups.get(key)
+            if entry is not None and entry[0] > now:
+                self.stats['hits'] += 1
+                return entry[1]
+        # every page is retried by the paginator
+        groups = list(iter_security_groups(self._conn(), filters=filters))
+        with self._lock:
+            self.stats['describes'] += 1
+        for group in groups:
+            if group.name == name or group.id == group_id:
+                self.remember(group)
+                return group
+        return None
+
+    def get_or_create(self, name, description=None):
+        """Group named name, created with description if missing.
+        @rtype SecurityGroup
+        """
+        group = self.get(name)
+        if group is not None:
+            return group
+        description = description or unicode('n' + repr(int(time.time())))
+        try:
+            self._conn().create_security_group(name, description)
+        except EC2ResponseError as e:
+            # created meanwhile by someone else
+            if e.error_code != 'InvalidGroup.Duplicate':
+                raise
+        else:
+            with self._lock:
+                self.stats['creates'] += 1
+        # describe rather than trust the create response, which has no rules
+        return self.get(name)
+
+    def _target(self, group):
+        if group.id:
+            return {'GroupId': group.id}
+        return {'GroupName': group.name}
+
+    def _apply(self, action, group, rules):
+        calls = 0
+        for i in range(0, len(rules), MAX_GRANTS):
+            params = self._target(group)
+            params.update(permission_params(rules[i:i + MAX_GRANTS]))
+            send = self._retry(lambda: self._conn().get_status(
+                action, params, verb='POST'))
+            send()
+            calls += 1
+        key = 'revoke_calls' if action.startswith('Revoke') else 'authorize_calls'
+        with self._lock:
+            self.stats[key] += calls
+        return calls
+
+    def _resolve_sources(self, rules):
+        # the service reports group sources by id
+        resolved = set()
+        for rule in rules:
+            source = rule.source
+            if '/' not in source and not source.startswith('sg-'):
+                group = self.get(source)
+                if group is not None and group.id:
+                    rule = rule._replace(source=group.id)
+            resolved.add(rule)
+        return resolved
+
+    def plan(self, group, desired, exclusive=True):
+        """Rules reconcile() would authorize and revoke.
+        @rtype Tuple
+        @return (authorize, revoke), see diff_rules
+        """
+        if isinstance(group, basestring):
+            found = self.get(group_id=group) if group.startswith('sg-') \
+                else self.get(group)
+            if found is None:
+                raise LookupError('no security group ' + group)
+            group = found
+        return group, diff_rules(group_rules(group),
+                                 self._resolve_sources(desired), exclusive)
+
+    def reconcile(self, group, desired, exclusive=True):
+        """Make the ingress rules of group equal to desired.
+
+        The group is described at most once per ttl, so repeating an
+        unchanged reconcile within ttl makes no API call at all. When the
+        rules changed behind the cached copy (a Duplicate or NotFound
+        permission error), they are described again and the diff retried
+        once.
+
+        @type   group: SecurityGroup or String
+        @param  group: boto group, group name or group id
+
+        @type   desired: List
+        @param  desired: Rules, see make_rule and parse_rule
+
+        @type   exclusive: Boolean
+        @param  exclusive: revoke the rules that are not desired
+
+        @rtype Dict
+        @return counts of authorized and revoked grants and of calls made
+        """
+        result = {'authorized': 0, 'revoked': 0, 'calls': 0}
+        for attempt in (1, 2):
+            group, (authorize, revoke) = self.plan(group, desired, exclusive)
+            try:
+                if revoke:
+                    result['calls'] += self._apply(
+                        'RevokeSecurityGroupIngress', group, revoke)
+                    result['revoked'] += len(revoke)
+                if authorize:
+                    result['calls'] += self._apply(
+                        'AuthorizeSecurityGroupIngress', group, authorize)
+                    result['authorized'] += len(authorize)
+            except EC2ResponseError as e:
+                if attempt == 2 or e.error_code not in (
+                        'InvalidPermission.Duplicate',
+                        'InvalidPermission.NotFound'):
+                    raise
+                self.invalidate(group)
+                group = group.id or group.name
+                continue
+            if revoke or authorize:
+                # cache the rules now in place instead of describing again
+                rules = (group_rules(group) - set(revoke)) | set(authorize)
+                self._remember_rules(group, rules)
+            return result
+
+    def _remember_rules(self, group, rules):
+        from boto.ec2.securitygroup import IPPermissions, GroupOrCIDR
+        permissions = []
+        for rule in sorted(rules):
+            permission = IPPermissions(group)
+            permission.ip_protocol = rule.protocol
+            permission.from_port = rule.from_port
+            permission.to_port = rule.to_port
+            grant = GroupOrCIDR(permission)
+            if '/' in rule.source:
+                grant.cidr_ip = rule.source
+            else:
+                grant.group_id = rule.source
+            permission.grants.append(grant)
+            permissions.append(permission)
+        group.rules = permissions
+        self.remember(group)
+
+
+def find_group(connection, name=None, group_id=None):
+    """Describe one security group by name or id without listing the
+    others. Returns None when it does not exist.
+    @rtype SecurityGroup
+    """
+    return SecurityGroups(connection, ttl=0).get(name, group_id)
@@ -0,0 +1,27 @@
+#
+# ec2 utilities - streaming image listing
+#
+
+import records
+from cache import IMAGE_FIELDS
+
+
+def iter_images(connection, image_ids=None, owners=None, filters=None):
+    """Describe images and yield each one as soon as it has been parsed.
+
+    The response body is parsed incrementally and every image element is
+    discarded once its record has been yielded, so memory does not grow
+    with the size of the catalog. Records are dicts with the same fields as
+    the ones kept by the image catalog cache; records.iter_images yields
+    lighter records with fewer fields.
+
+    @type   connection: EC2 connection
+    @param  connection: EC2 connection
+
+    @rtype Generator
+    @return image records
+    """
+    for image in records.iter_images(connection, image_ids, owners, filters,
+                                     IMAGE_FIELDS):
+        yield dict(zip(IMAGE_FIELDS, image))
+
@@ -0,0 +1,218 @@
+#
+# ec2 utilities - batched instance waiter
+#
+
+import time
+import random
+from boto.exception import EC2ResponseError
+
+# instances in these states will never reach running on their own
+TERMINAL_STATES = (u'shutting-down', u'terminated', u'stopping', u'stopped')
+# instance ids per DescribeInstances request
+BATCH_SIZE = 100
+
+
+class AdaptiveInterval(object):
+    """Polling interval that stays short while things change and backs off
+    while they don't.
+
+    The returned delays are jittered so that many waiters started together
+    do not poll the API in lock step.
+    """
+
+    def __init__(self, minimum=1.0, maximum=15.0, factor=1.5, jitter=0.2):
+        if minimum <= 0 or maximum < minimum:
+            raise ValueError("need 0 < minimum <= maximum")
+        if factor < 1:
+            raise ValueError("factor must be 1 or greater")
+        if not 0 <= jitter < 1:
+            raise ValueError("jitter must be in [0, 1)")
+        self.minimum = minimum
+        self.maximum = maximum
+        self.factor = factor
+        self.jitter = jitter
+        self.current = minimum
+
+    def next(self, changed):
+        """Delay before the next poll.
+        @type   changed: Boolean
+        @param  changed: whether the last poll saw any change
+
+        @rtype float
+        @return seconds to sleep
+        """
+        if changed:
+            self.current = self.minimum
+        else:
+            self.current = min(self.current * self.factor, self.maximum)
+        return self.current * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+
+class WaitResult(object):
+    """Outcome of wait_for_instances.
+
+    running and timed_out are lists of instance ids, failed maps the ids of
+    instances that reached a terminal state to that state and states holds
+    the last state seen for every instance.
+    """
+
+    def __init__(self):
+        self.running = []
+        self.failed = {}
+        self.timed_out = []
+        self.states = {}
+        self.polls = 0
+        self.elapsed = 0.0
+
+    @property
+    def ok(self):
+        return not self.failed and not self.timed_out
+
+    def __repr__(self):
+        return 'WaitResult(running=%d, failed=%d, timed_out=%d, polls=%d, elapsed=%.1fs)' % (
+            len(self.running), len(self.failed), len(self.timed_out),
+            self.polls, self.elapsed)
+
+
+def instance_targets(targets):
+    """Flatten reservations, instances and instance ids.
+    @type   targets: List
+    @param  targets: reservations, instances or instance id strings
+
+    @rtype Tuple
+    @return (list of instance ids, dict of id to instance object)
+    """
+    ids, seen, objects = [], set(), {}
+    for target in targets:
+        if hasattr(target, 'instances'):
+            instances = target.instances
+        else:
+            instances = [target]
+        for instance in instances:
+            if isinstance(instance, basestring):
+                instance_id = instance
+            else:
+                instance_id = instance.id
+                objects[instance_id] = instance
+            if instance_id not in seen:
+                seen.add(instance_id)
+                ids.append(instance_id)
+    return ids, objects
+
+
+def _describe_batch(ec2conn, batch):
+    try:
+        return ec2conn.get_only_instances(instance_ids=batch)
+    except EC2ResponseError as e:
+        if e.error_code != 'InvalidInstanceID.NotFound':
+            raise
+    # a filter on the ids describes the ones that exist, in one call
+    if len(batch) > 1:
+        return ec2conn.get_only_instances(filters={'instance-id': batch})
+    return []
+
+
+def describe_instances(ec2conn, instance_ids, batch_size=BATCH_SIZE, tries=3):
+    """Describe instances with one DescribeInstances call per batch.
+
+    Ids the service does not know about yet (new instances are eventually
+    consistent) are skipped instead of failing the whole batch. Every batch
+    is retried on its own, see ec2.ec2_retry.
+
+    @type   ec2conn: EC2 connection
+    @param  ec2conn: EC2 connection
+
+    @type   instance_ids: List
+    @param  instance_ids: instance ids
+
+    @type   tries: int
+    @param  tries: attempts per batch, 1 for callers retrying themselves
+
+    @rtype Generator
+    @return boto instances
+    """
+    from ec2 import ec2_retry
+    describe = ec2_retry(tries, deadline=60)(_describe_batch)
+    for i in range(0, len(instance_ids), batch_size):
+        instances = describe(ec2conn, instance_ids[i:i + batch_size])
+        for instance in instances:
+            yield instance
+
+
+def record_poll(result, pending, objects, instances, on_change=None):
+    """Account for the instances described by one poll.
+
+    Updates result (a WaitResult) and the pending set of ids, and the
+    instance objects the caller passed in.
+
+    @rtype Boolean
+    @return whether any instance changed state
+    """
+    changed = False
+    for instance in instances:
+        if instance.id not in pending:
+            continue
+        if instance.id in objects:
+            objects[instance.id]._update(instance)
+        old_state = result.states.get(instance.id)
+        state = instance.state
+        result.states[instance.id] = state
+        if state != old_state:
+            changed = True
+            if on_change is not None:
+                on_change(instance, old_state)
+        if state == u'running':
+            result.running.append(instance.id)
+            pending.discard(instance.id)
+        elif state in TERMINAL_STATES:
+            result.failed[instance.id] = state
+            pending.discard(instance.id)
+    return changed
+
+
+def wait_for_instances(ec2conn, targets, timeout, interval=None,
+                       on_change=None, batch_size=BATCH_SIZE):
+    """Wait till the instances are running, failed or timeout expires.
+
+    Every pass describes all pending instances in batches, so the cost of
+    a pass grows with the number of batches rather than of instances. The
+    wait stops as soon as no instance is pending. Instance objects passed
+    in (directly or through reservations) are updated in place.
+
+    @type   ec2conn: EC2 connection
+    @param  ec2conn: EC2 connection
+
+    @type   targets: List
+    @param  targets: reservations, instances or instance ids
+
+    @type   timeout: int
+    @param  timeout: timeout in seconds
+
+    @type   interval: AdaptiveInterval
+    @param  interval: polling interval policy
+
+    @type   on_change: callable
+    @param  on_change: called as on_change(instance, old_state) for every
+                       state transition seen
+
+    @rtype WaitResult
+    @return which instances are running, failed or timed out
+    """
+    if interval is None:
+        interval = AdaptiveInterval()
+    ids, objects = instance_targets(targets)
+    result = WaitResult()
+    pending = set(ids)
+    start = time.time()
+    while pending:
+        result.polls += 1
+        instances = describe_instances(ec2conn, [i for i in ids if i in pending],
+                                       batch_size)
+        changed = record_poll(result, pending, objects, instances, on_change)
+        remaining = timeout - (time.time() - start)
+        if not pending or remaining <= 0:
+            break
+        time.sleep(min(interval.next(changed), remaining))
+    result.timed_out = [i for i in ids if i in pending]
+    result.elapsed = time.time() - start
+    return result
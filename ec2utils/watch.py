@@ -0,0 +1,175 @@
+#
+# ec2 utilities - stream of instance changes
+#
+
+import sys
+import json
+import time
+import zlib
+
+from waiter import AdaptiveInterval, describe_instances, BATCH_SIZE
+from paginate import iter_instances
+
+# instances per page when watching the whole account or a filtered subset
+PAGE_SIZE = 1000
+# states an instance leaves on its own; polls stay short while any is seen
+TRANSITIONAL_STATES = (u'pending', u'shutting-down', u'stopping', u'rebooting')
+BUSY_MAXIMUM = 5.0
+
+
+def instance_fingerprint(instance):
+    """Compact (state, checksum) of what a watch reports on.
+
+    Only the state is kept as is, so transitions can be reported; address,
+    placement, type and tag changes are detected through the checksum.
+    """
+    details = '\0'.join([instance.private_ip_address or '',
+                         instance.ip_address or '', instance.placement or '',
+                         instance.instance_type or '', instance.key_name or '',
+                         repr(sorted((instance.tags or {}).items()))])
+    if isinstance(details, unicode):
+        details = details.encode('utf-8')
+    return instance.state, zlib.crc32(details) & 0xffffffff
+
+
+def _details(instance):
+    return {'zone': instance.placement, 'type': instance.instance_type,
+            'private_ip': instance.private_ip_address,
+            'public_ip': instance.ip_address,
+            'name': (instance.tags or {}).get('Name')}
+
+
+class InstanceWatcher(object):
+    """Poll instances and report what changed since the previous poll.
+
+    Watches the given instance ids (described in batches of batch_size) or,
+    without ids, every instance matching filters (described in pages of
+    PAGE_SIZE). Only a fingerprint per instance is remembered between polls.
+
+    Events are dicts with 'time', 'event', 'id' and 'state':
+      present   instance seen by the first poll
+      appeared  instance not seen before
+      state     state transition, with 'previous' state
+      updated   same state, but addresses, placement, type or tags changed
+      gone      instance no longer returned (ids: no longer known)
+    Every event but 'gone' also has zone, type, private_ip, public_ip and
+    name.
+    """
+
+    def __init__(self, ec2conn, instance_ids=None, filters=None,
+                 batch_size=BATCH_SIZE):
+        self.ec2conn = ec2conn
+        self.instance_ids = list(instance_ids or [])
+        self.filters = filters or None
+        self.batch_size = batch_size
+        self.fingerprints = None
+        self.polls = 0
+        self.busy = False
+
+    def _describe(self):
+        if self.instance_ids:
+            return describe_instances(self.ec2conn, self.instance_ids,
+                                      self.batch_size)
+        return iter_instances(self.ec2conn, filters=self.filters,
+                              page_size=PAGE_SIZE, prefetch=True)
+
+    def poll(self):
+        """Describe the instances once.
+        @rtype List
+        @return events, see the class documentation
+        """
+        now = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+        first = self.fingerprints is None
+        previous = self.fingerprints or {}
+        current = {}
+        events = []
+        self.busy = False
+        for instance in self._describe():
+            fingerprint = instance_fingerprint(instance)
+            current[instance.id] = fingerprint
+            if fingerprint[0] in TRANSITIONAL_STATES:
+                self.busy = True
+            old = previous.get(instance.id)
+            if old == fingerprint:
+                continue
+            event = {'time': now, 'id': instance.id, 'state': fingerprint[0]}
+            if first:
+                event['event'] = 'present'
+            elif old is None:
+                event['event'] = 'appeared'
+            elif old[0] != fingerprint[0]:
+                event['event'] = 'state'
+                event['previous'] = old[0]
+            else:
+                event['event'] = 'updated'
+            event.update(_details(instance))
+            events.append(event)
+        for instance_id in previous:
+            if instance_id not in current:
+                events.append({'time': now, 'event': 'gone', 'id': instance_id,
+                               'state': previous[instance_id][0]})
+        self.fingerprints = current
+        self.polls += 1
+        return events
+
+    def events(self, timeout=None, interval=None):
+        """Poll till timeout seconds have passed (forever when None),
+        yielding events as they are seen.
+
+        The delay between polls shrinks to interval.minimum after a poll saw
+        changes and grows towards interval.maximum while nothing changes; it
+        stays under BUSY_MAXIMUM while an instance is in a transitional
+        state, since that one is about to change.
+
+        @type   interval: AdaptiveInterval
+        @param  interval: polling interval policy
+        """
+        if interval is None:
+            interval = AdaptiveInterval(minimum=2.0, maximum=60.0)
+        start = time.time()
+        while True:
+            events = self.poll()
+            for event in events:
+                yield event
+            delay = interval.next(bool(events))
+            if self.busy:
+                delay = min(delay, BUSY_MAXIMUM)
+            if timeout is not None:
+                remaining = timeout - (time.time() - start)
+                if remaining <= 0:
+                    return
+                delay = min(delay, remaining)
+            time.sleep(delay)
+
+
+def format_event(event):
+    """One line of text describing an event."""
+    if event['event'] == 'state':
+        change = '{0} -> {1}'.format(event['previous'], event['state'])
+    else:
+        change = '{0} ({1})'.format(event['event'], event['state'])
+    line = '{0} {1} {2}'.format(event['time'], event['id'], change)
+    if event['event'] != 'gone':
+        extra = ' '.join('{0}={1}'.format(k, event[k]) for k in
+                         ('name', 'zone', 'private_ip', 'public_ip')
+                         if event.get(k))
+        if extra:
+            line += ' ' + extra
+    return line
+
+
+def write_events(events, fmt='text', out=None):
+    """Write events one per line as they come, as text or json.
+    @rtype int
+    @return number of events written
+    """
+    out = out or sys.stdout
+    count = 0
+    for event in events:
+        if fmt == 'json':
+            out.write(json.dumps(event, sort_keys=True) + '\n')
+        else:
+            out.write(format_event(event) + '\n')
+        out.flush()
+        count += 1
+    return count
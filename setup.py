@@ -8,9 +8,9 @@ setup(name='ec2utils',
       url='https://github.com/hoangnguyen177/ec2_utilities.git',
       packages=['ec2utils'],
       zip_safe=False,
-      data_files=[
-          ('/usr/local/bin', ['ec2utils/ec2utils'])
-      ],
+      entry_points={
+          'console_scripts': ['ec2utils = ec2utils.ec2utils:main']
+      },
       install_requires=[
         "boto==2.34.0",
         "tabulate>=0.7.4"